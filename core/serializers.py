@@ -2,6 +2,12 @@ from djoser.serializers import (
     UserSerializer as BaseUserSerializer,
     UserCreateSerializer as BaseUserCreateSerializer,
 )
+from rest_framework_simplejwt.serializers import (
+    TokenObtainPairSerializer as BaseTokenObtainPairSerializer,
+)
+
+from store.customers import CUSTOMER_ID_CLAIM, customer_id_for_user
+from store.models import Customer
 
 
 class UserCreateSerializer(BaseUserCreateSerializer):
@@ -12,3 +18,17 @@ class UserCreateSerializer(BaseUserCreateSerializer):
 class UserSerializer(BaseUserSerializer):
     class Meta(BaseUserSerializer.Meta):
         fields = ["id", "username", "email", "first_name", "last_name"]
+
+
+class TokenObtainPairSerializer(BaseTokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        # Claims of the refresh token are copied into every access token made
+        # from it, so refreshed tokens keep the customer id too.
+        token = super().get_token(user)
+        try:
+            token[CUSTOMER_ID_CLAIM] = customer_id_for_user(user.id)
+        except Customer.DoesNotExist:
+            # Left out, get_customer_id() then looks the customer up per request
+            pass
+        return token
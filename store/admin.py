@@ -1,6 +1,7 @@
 """
 A module that handles the admin section of the store by registering and customizing the data model.
 """
+
 from typing import Any
 from django.contrib import admin, messages
 from django.db.models import Count
@@ -11,6 +12,7 @@ from django.utils.http import urlencode
 from django.db.models.query import QuerySet
 
 from . import models
+from .caching import PRODUCTS, bump_versions, invalidate_inventories
 
 
 class InventoryFilter(admin.SimpleListFilter):
@@ -51,7 +53,10 @@ class ProductImageInline(admin.TabularInline):
 
     def thumbnail(self, instance: models.ProductImage):
         if instance.image.name != "":
-            return format_html(f"<img src='{instance.image.url}' class='thumbnail' />")
+            # The small derivative, the original until it was generated
+            return format_html(
+                "<img src='{}' class='thumbnail' />", instance.variant_url("small")
+            )
         return ""
 
 
@@ -121,7 +126,11 @@ class ProductAdmin(admin.ModelAdmin):
             request (HttpRequest): instance of request obj
             queryset (QuerySet): Queryset
         """
+        product_ids = list(queryset.values_list("pk", flat=True))
         updated_count = queryset.update(inventory=0)
+        # QuerySet.update() sends no post_save, so invalidate cached products here
+        bump_versions(PRODUCTS)
+        invalidate_inventories(product_ids)
         self.message_user(
             request=request,
             message=f"{updated_count} products were updated successfully",
@@ -197,12 +206,29 @@ class OrderAdmin(admin.ModelAdmin):
     Overridden options:
         list_display: display selected fields to the user
         list_per_page: product instances per page
+        readonly_fields: stored totals, computed from the order items
     """
 
     autocomplete_fields = ["customer"]
     inlines = [OrderItemInline]
-    list_display = ["id", "customer", "payment_status", "placed_at"]
+    list_display = [
+        "id",
+        "customer",
+        "payment_status",
+        "placed_at",
+        "total",
+        "item_count",
+    ]
     list_per_page = 10
+    readonly_fields = ["total", "item_count"]
+
+    def save_related(self, request, form, formsets, change):
+        """
+        Recompute the stored total and item count once the inline order items
+        are saved.
+        """
+        super().save_related(request, form, formsets, change)
+        models.Order.objects.refresh_totals([form.instance.id])
 
 
 @admin.register(models.Collection)
@@ -217,7 +243,6 @@ class CollectionAdmin(admin.ModelAdmin):
 
     Functions:
         products_count
-        get_queryset(overridden function)
     """
 
     autocomplete_fields = ["featured_product"]
@@ -241,6 +266,3 @@ class CollectionAdmin(admin.ModelAdmin):
             + urlencode({"collection__id": str(collection.id)})
         )
         return format_html('<a href="{}">{}</a>', url, collection.products_count)
-
-    def get_queryset(self, request: HttpRequest):
-        return super().get_queryset(request).annotate(products_count=Count("products"))
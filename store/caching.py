@@ -0,0 +1,350 @@
+"""
+A module that caches catalog API responses under versioned keys.
+
+Every cached response is stored under a key that embeds the current version of
+the namespaces it depends on (e.g. "products"). Model signal handlers bump those
+versions whenever the underlying rows change, which makes every older entry
+unreachable at once instead of waiting for its TTL to run out. The same
+versions, together with the time of the last bump, answer conditional GETs
+(If-None-Match / If-Modified-Since) without touching the database.
+
+Changes that concern a single product bump that product's namespace only (see
+product_namespace()), which its detail response and reviews depend on; lists
+pick them up within the TTL. Inventory, which every order changes, is not part
+of any cached response at all: it is read per product from short-lived entries
+that checkout drops (see get_inventories()), and has versions of its own that
+only go into the ETag.
+"""
+
+from hashlib import md5
+from time import time
+from uuid import UUID
+
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+PRODUCTS = "products"
+COLLECTIONS = "collections"
+REVIEWS = "reviews"
+# Only in ETags and Last-Modified, inventory has no cached responses
+INVENTORY = "inventory"
+
+VERSION_KEY = "store:version:{}"
+MODIFIED_KEY = "store:modified:{}"
+RESPONSE_KEY = "store:response:{}:{}"
+CART_SUMMARY_KEY = "store:cart-summary:{}"
+# Cart summaries are also invalidated on every cart item write; the TTL only
+# bounds how long a product price change takes to show up in them.
+CART_SUMMARY_TIMEOUT = 60
+INVENTORY_KEY = "store:inventory:{}"
+# Bounds how long a stale inventory written back by a concurrent read survives
+INVENTORY_TIMEOUT = 60
+# The ids of scoped namespaces come from URLs, so their keys must not be kept
+# forever. An expired one starts over from the clock (see _initial_version()).
+SCOPED_VERSION_TIMEOUT = 24 * 60 * 60
+
+
+def _initial_version():
+    # Start from the clock so a version key that was evicted never falls back
+    # to a number whose responses may still be in the cache.
+    return int(time() * 1000)
+
+
+def _version_timeout(namespace):
+    return SCOPED_VERSION_TIMEOUT if ":" in namespace else None
+
+
+def _scoped(namespace, object_id):
+    # Ids from URLs are normalized the way the database compares them
+    try:
+        object_id = int(object_id)
+    except (TypeError, ValueError):
+        pass
+    return f"{namespace}:{object_id}"
+
+
+def product_namespace(product_id):
+    """
+    Get the namespace of the responses that depend on one product only.
+
+    Args:
+        product_id (int): id of the product
+
+    Returns:
+        str: the namespace name
+    """
+    return _scoped(PRODUCTS, product_id)
+
+
+def review_namespace(product_id):
+    """
+    Get the namespace of the reviews of one product.
+
+    Args:
+        product_id (int): id of the product
+
+    Returns:
+        str: the namespace name
+    """
+    return _scoped(REVIEWS, product_id)
+
+
+def inventory_namespace(product_id):
+    """
+    Get the namespace of the inventory of one product.
+
+    Args:
+        product_id (int): id of the product
+
+    Returns:
+        str: the namespace name
+    """
+    return _scoped(INVENTORY, product_id)
+
+
+def get_versions(namespaces):
+    """
+    Get the current version of each namespace, creating missing ones.
+
+    Args:
+        namespaces (list): namespace names
+
+    Returns:
+        list: the versions, in the order of namespaces
+    """
+    keys = [VERSION_KEY.format(namespace) for namespace in namespaces]
+    versions = cache.get_many(keys)
+    for namespace, key in zip(namespaces, keys):
+        if key not in versions:
+            cache.add(key, _initial_version(), timeout=_version_timeout(namespace))
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def get_last_modified(namespaces):
+    """
+    Get the time of the last change in any of the namespaces.
+
+    Args:
+        namespaces (list): namespace names
+
+    Returns:
+        int: a unix timestamp, "now" when no change was recorded yet
+    """
+    keys = [MODIFIED_KEY.format(namespace) for namespace in namespaces]
+    modified = cache.get_many(keys)
+    for namespace, key in zip(namespaces, keys):
+        if key not in modified:
+            cache.add(key, time(), timeout=_version_timeout(namespace))
+            modified[key] = cache.get(key)
+    return int(max(modified.values()))
+
+
+def _bump(namespaces):
+    for namespace in namespaces:
+        key = VERSION_KEY.format(namespace)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _initial_version(), timeout=_version_timeout(namespace))
+        cache.set(
+            MODIFIED_KEY.format(namespace), time(), timeout=_version_timeout(namespace)
+        )
+
+
+def bump_versions(*namespaces):
+    """
+    Invalidate every cached response of the given namespaces.
+
+    The versions are bumped right away and once more after the surrounding
+    transaction commits: a request that read the old rows between the two
+    bumps then cached them under a version that is already abandoned.
+
+    Args:
+        namespaces (str): namespace names
+    """
+    _bump(namespaces)
+    transaction.on_commit(lambda: _bump(namespaces))
+
+
+def cart_summary_key(cart_id):
+    # Normalize, the id may come straight from the URL
+    return CART_SUMMARY_KEY.format(UUID(str(cart_id)))
+
+
+def invalidate_cart_summary(cart_id):
+    """
+    Drop the cached summary of a cart, now and after the surrounding
+    transaction commits (see bump_versions()).
+
+    Args:
+        cart_id (UUID): id of the cart
+    """
+    key = cart_summary_key(cart_id)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+def get_inventories(product_ids, load):
+    """
+    Get the inventory of products from their cache entries.
+
+    Args:
+        product_ids (list): ids of the products
+        load (callable): takes the ids that have no entry, returns their
+            inventory by id
+
+    Returns:
+        dict: the inventory by product id
+    """
+    keys = {INVENTORY_KEY.format(product_id): product_id for product_id in product_ids}
+    cached = cache.get_many(keys)
+    inventories = {keys[key]: inventory for key, inventory in cached.items()}
+    missing = [product_id for key, product_id in keys.items() if key not in cached]
+    if missing:
+        loaded = load(missing)
+        cache.set_many(
+            {
+                INVENTORY_KEY.format(product_id): inventory
+                for product_id, inventory in loaded.items()
+            },
+            INVENTORY_TIMEOUT,
+        )
+        inventories.update(loaded)
+    return inventories
+
+
+def _drop_inventories(keys, namespaces):
+    cache.delete_many(keys)
+    _bump(namespaces)
+
+
+def invalidate_inventories(product_ids):
+    """
+    Drop the cached inventory of products and bump its versions, now and after
+    the surrounding transaction commits (see bump_versions()).
+
+    Args:
+        product_ids (list): ids of the products
+    """
+    keys = [INVENTORY_KEY.format(product_id) for product_id in product_ids]
+    namespaces = [INVENTORY] + [
+        inventory_namespace(product_id) for product_id in product_ids
+    ]
+    _drop_inventories(keys, namespaces)
+    transaction.on_commit(lambda: _drop_inventories(keys, namespaces))
+
+
+def response_cache_key(request, namespaces):
+    """
+    Build the cache key of a request from its URL and namespace versions.
+
+    The query string is normalized (sorted by parameter name) so that
+    ?a=1&b=2 and ?b=2&a=1 share an entry.
+
+    Args:
+        request (Request): instance of request obj
+        namespaces (list): namespace names the response depends on
+
+    Returns:
+        str: the cache key
+    """
+    query = sorted((name, values) for name, values in request.query_params.lists())
+    url = f"{request.get_host()}{request.path}?{query}"
+    versions = ".".join(str(version) for version in get_versions(namespaces))
+    return RESPONSE_KEY.format(versions, md5(url.encode("utf-8")).hexdigest())
+
+
+class VersionedCacheMixin:
+    """
+    A viewset mixin that serves list() and retrieve() from the cache.
+
+    Only the serialized data is cached, so content negotiation and rendering
+    still happen per request. Responses carry an ETag derived from the cache key
+    and a Last-Modified from the last version bump, and matching conditional
+    requests get a 304 before any query runs.
+
+    Fields that change too often to be cached with the rest are filled into
+    the data per request by fill_volatile(). The versions of their namespaces
+    (see get_volatile_namespaces()) go into the ETag, not into the key.
+
+    Attributes:
+        cache_namespaces: namespaces whose version is part of the key
+        cache_timeout: TTL of the entries, as a backstop to the versions
+    """
+
+    cache_namespaces = []
+    cache_timeout = DEFAULT_TIMEOUT
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+    def get_cache_namespaces(self):
+        return self.cache_namespaces
+
+    def get_volatile_namespaces(self):
+        return []
+
+    def fill_volatile(self, data, fresh):
+        """
+        Fill the fields that are not cached into the data of a response.
+
+        Args:
+            data: the response data, changed in place
+            fresh (bool): whether the data was just read from the database
+        """
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        namespaces = self.get_cache_namespaces()
+        volatile = self.get_volatile_namespaces()
+        # Last-Modified is read before the versions, and the versions before the
+        # database, so that a concurrent write can only make a response look
+        # older than it is, never newer.
+        last_modified = get_last_modified(namespaces + volatile)
+        key = response_cache_key(request, namespaces)
+        volatile_versions = ".".join(str(version) for version in get_versions(volatile))
+        # The same data renders differently as JSON and in the browsable API
+        etag = quote_etag(
+            md5(
+                f"{key}:{volatile_versions}:{request.accepted_renderer.format}".encode()
+            ).hexdigest()
+        )
+
+        conditional = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if conditional is not None:
+            # 304 Not Modified, or 412 when an If-Match precondition failed
+            response = Response(status=conditional.status_code)
+        else:
+            response, fresh = self.fetch_response(
+                key, handler, request, *args, **kwargs
+            )
+            if volatile and response.status_code == status.HTTP_200_OK:
+                self.fill_volatile(response.data, fresh)
+
+        if response.status_code in (
+            status.HTTP_200_OK,
+            status.HTTP_304_NOT_MODIFIED,
+        ):
+            response["ETag"] = etag
+            response["Last-Modified"] = http_date(last_modified)
+        return response
+
+    def fetch_response(self, key, handler, request, *args, **kwargs):
+        data = cache.get(key)
+        if data is not None:
+            return Response(data), False
+
+        response = handler(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            cache.set(key, response.data, self.cache_timeout)
+        return response, True
@@ -0,0 +1,261 @@
+"""
+A module that keeps anonymous carts in Redis instead of the cart tables.
+
+When settings.STORE_CART_BACKEND is "redis", every cart is a Redis hash that maps
+product ids to quantities (plus a "created_at" field so that empty carts exist
+too). Cart writes only touch Redis and mark the cart as dirty; the persist_carts
+Celery task writes dirty carts behind to the Cart/CartItem tables in batches,
+and checkout persists the cart it is about to order synchronously.
+"""
+
+from time import perf_counter, time
+from uuid import UUID, uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from .caching import cart_summary_key
+from .models import Cart, CartItem, Product
+
+CART_KEY = "store:cart:{}"
+DIRTY_KEY = "store:carts:dirty"
+CREATED_AT = "created_at"
+# Carts nobody touched for this long expire from Redis on their own, like the
+# purge_abandoned_carts task deletes them from the tables
+CART_TTL = settings.STORE_ABANDONED_CART_DAYS * 24 * 60 * 60
+
+
+def redis_carts_enabled():
+    return settings.STORE_CART_BACKEND == "redis"
+
+
+class RedisCartStore:
+    """
+    A RedisCartStore class for reading and writing carts kept in Redis.
+
+    Functions:
+        create, exists, items, add, add_many, set, remove, delete
+        persist, persist_dirty
+    """
+
+    def __init__(self, client=None):
+        self.client = client or get_redis_connection("default")
+
+    def _key(self, cart_id):
+        return CART_KEY.format(cart_id)
+
+    def _touch(self, pipeline, cart_id):
+        pipeline.expire(self._key(cart_id), CART_TTL)
+        pipeline.sadd(DIRTY_KEY, str(cart_id))
+
+    def create(self):
+        cart_id = uuid4()
+        pipeline = self.client.pipeline()
+        pipeline.hset(self._key(cart_id), CREATED_AT, time())
+        self._touch(pipeline, cart_id)
+        pipeline.execute()
+        return cart_id
+
+    def exists(self, cart_id):
+        return bool(self.client.exists(self._key(cart_id)))
+
+    def items(self, cart_id):
+        """
+        Get the items of a cart.
+
+        Args:
+            cart_id (UUID): id of the cart
+
+        Returns:
+            dict: quantities by product id, or None when the cart does not exist
+        """
+        fields = self.client.hgetall(self._key(cart_id))
+        if not fields:
+            return None
+        return {
+            int(field): int(quantity)
+            for field, quantity in fields.items()
+            if field != CREATED_AT.encode()
+        }
+
+    def add(self, cart_id, product_id, quantity):
+        """
+        Atomically add to the quantity of a product in a cart.
+
+        Returns:
+            int: the new quantity
+        """
+        pipeline = self.client.pipeline()
+        pipeline.hincrby(self._key(cart_id), product_id, quantity)
+        self._touch(pipeline, cart_id)
+        return pipeline.execute()[0]
+
+    def add_many(self, cart_id, quantities):
+        """
+        Atomically add to the quantities of several products in a cart.
+
+        Args:
+            cart_id (UUID): id of the cart
+            quantities (dict): quantity to add by product id
+
+        Returns:
+            dict: the new quantities by product id
+        """
+        pipeline = self.client.pipeline()
+        for product_id, quantity in quantities.items():
+            pipeline.hincrby(self._key(cart_id), product_id, quantity)
+        self._touch(pipeline, cart_id)
+        totals = pipeline.execute()[: len(quantities)]
+        return dict(zip(quantities, totals))
+
+    def set(self, cart_id, product_id, quantity):
+        pipeline = self.client.pipeline()
+        pipeline.hset(self._key(cart_id), product_id, quantity)
+        self._touch(pipeline, cart_id)
+        pipeline.execute()
+
+    def remove(self, cart_id, product_id):
+        """
+        Remove a product from a cart.
+
+        Returns:
+            bool: whether the product was in the cart
+        """
+        pipeline = self.client.pipeline()
+        pipeline.hdel(self._key(cart_id), product_id)
+        self._touch(pipeline, cart_id)
+        return bool(pipeline.execute()[0])
+
+    def delete(self, cart_id):
+        pipeline = self.client.pipeline()
+        pipeline.delete(self._key(cart_id))
+        pipeline.sadd(DIRTY_KEY, str(cart_id))
+        pipeline.execute()
+
+    def persist(self, cart_id):
+        """
+        Write a cart through to the Cart and CartItem tables.
+
+        A cart that no longer exists in Redis is deleted from the tables.
+
+        Args:
+            cart_id (UUID): id of the cart
+        """
+        items = self.items(cart_id)
+        with transaction.atomic():
+            if items is None:
+                Cart.objects.filter(pk=cart_id).delete()
+                return
+
+            Cart.objects.update_or_create(
+                pk=cart_id, defaults={"touched_at": timezone.now()}
+            )
+            # Products deleted since they were added can not be referenced
+            known = set(
+                Product.objects.filter(id__in=items).values_list("id", flat=True)
+            )
+            items = {
+                product_id: quantity
+                for product_id, quantity in items.items()
+                if product_id in known
+            }
+            CartItem.objects.filter(cart_id=cart_id).exclude(
+                product_id__in=items
+            ).delete()
+
+            existing = {
+                item.product_id: item
+                for item in CartItem.objects.filter(cart_id=cart_id)
+            }
+            changed = []
+            for product_id, quantity in items.items():
+                item = existing.get(product_id)
+                if item is not None and item.quantity != quantity:
+                    item.quantity = quantity
+                    changed.append(item)
+            CartItem.objects.bulk_update(changed, ["quantity"])
+            CartItem.objects.bulk_create(
+                [
+                    CartItem(cart_id=cart_id, product_id=product_id, quantity=quantity)
+                    for product_id, quantity in items.items()
+                    if product_id not in existing
+                ]
+            )
+
+    def persist_dirty(self, batch_size=100):
+        """
+        Write behind the carts changed since the last run.
+
+        Args:
+            batch_size (int): number of carts popped from the dirty set per batch
+
+        Returns:
+            int: number of carts persisted
+        """
+        persisted = 0
+        while True:
+            cart_ids = self.client.spop(DIRTY_KEY, batch_size)
+            if not cart_ids:
+                return persisted
+            for i, cart_id in enumerate(cart_ids):
+                try:
+                    self.persist(UUID(cart_id.decode()))
+                except Exception:
+                    # Keep the unpersisted carts for the next run
+                    self.client.sadd(DIRTY_KEY, *cart_ids[i:])
+                    raise
+                persisted += 1
+
+
+def purge_carts(max_age, chunk_size=500):
+    """
+    Delete the carts nobody touched for max_age, chunk by chunk.
+
+    Every chunk is a short transaction over at most chunk_size carts, taken in
+    primary key order, so the purge never holds locks for long. The rows are
+    deleted without the ORM cascade, whose post_delete receivers would drop
+    the cart summaries one by one inside the transaction; they are dropped
+    together once it commits.
+
+    Args:
+        max_age (timedelta): how long a cart may stay untouched
+        chunk_size (int): number of carts deleted per transaction
+
+    Returns:
+        dict: carts and items deleted, and the seconds it took
+    """
+    started = perf_counter()
+    cutoff = timezone.now() - max_age
+    abandoned = Cart.objects.filter(touched_at__lt=cutoff)
+    purged = {"carts": 0, "items": 0}
+
+    last_id = None
+    while True:
+        chunk = abandoned.order_by("pk")
+        if last_id is not None:
+            chunk = chunk.filter(pk__gt=last_id)
+        ids = list(chunk.values_list("pk", flat=True)[:chunk_size])
+        if not ids:
+            break
+
+        last_id = ids[-1]
+
+        with transaction.atomic():
+            # Locked and filtered again: a cart touched since the SELECT is kept
+            ids = list(
+                abandoned.filter(pk__in=ids)
+                .select_for_update()
+                .values_list("pk", flat=True)
+            )
+            items = CartItem.objects.filter(cart_id__in=ids)
+            purged["items"] += items._raw_delete(items.db)
+            carts = Cart.objects.filter(pk__in=ids)
+            purged["carts"] += carts._raw_delete(carts.db)
+            keys = [cart_summary_key(cart_id) for cart_id in ids]
+            transaction.on_commit(lambda: cache.delete_many(keys))
+
+    purged["seconds"] = round(perf_counter() - started, 3)
+    return purged
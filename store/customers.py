@@ -0,0 +1,51 @@
+"""
+A module that resolves the Customer id of the user making a request.
+
+Access tokens issued through /auth/jwt/create/ carry the id as the customer_id
+claim, so most requests get it for free. Older tokens and session logins fall
+back to a cached user -> customer lookup, which is safe to cache for long since
+a user keeps the same customer for life.
+"""
+
+from django.core.cache import cache
+
+from .models import Customer
+
+CUSTOMER_ID_CLAIM = "customer_id"
+CUSTOMER_ID_KEY = "store:customer-id:{}"
+CUSTOMER_ID_TIMEOUT = 24 * 60 * 60
+
+
+def customer_id_for_user(user_id):
+    """
+    Get the Customer id of a user, from the cache when possible.
+
+    Raises:
+        Customer.DoesNotExist: when the user has no customer
+    """
+    key = CUSTOMER_ID_KEY.format(user_id)
+    customer_id = cache.get(key)
+    if customer_id is None:
+        customer_id = Customer.objects.values_list("id", flat=True).get(user_id=user_id)
+        cache.set(key, customer_id, CUSTOMER_ID_TIMEOUT)
+    return customer_id
+
+
+def get_customer_id(request):
+    """
+    Get the Customer id of the authenticated user of a request.
+
+    Args:
+        request (Request): instance of request obj
+
+    Returns:
+        int: the id, read from the access token when it carries the claim
+    """
+    token = request.auth
+    if token is not None and CUSTOMER_ID_CLAIM in token:
+        return token[CUSTOMER_ID_CLAIM]
+    return customer_id_for_user(request.user.id)
+
+
+def forget_customer_id(user_id):
+    cache.delete(CUSTOMER_ID_KEY.format(user_id))
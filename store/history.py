@@ -0,0 +1,120 @@
+"""
+A module that maintains the purchase history rollup of customers.
+
+Every order adds its items to CustomerProductHistory (one row per customer and
+product) and CustomerCollectionSpend (one row per customer and collection) when
+order_created is relayed, so reading the history of a customer is a scan of a
+few rows per product, however many orders are behind them.
+"""
+
+from django.db import transaction
+from django.db.models import F, Max, Sum
+
+from .models import (
+    CustomerCollectionSpend,
+    CustomerProductHistory,
+    OrderItem,
+    _money,
+)
+
+
+def record_order(order):
+    """
+    Add the items of a newly placed order to the history of its customer.
+
+    Args:
+        order (Order): instance of order
+    """
+    products = {}
+    collections = {}
+    for (
+        product_id,
+        collection_id,
+        quantity,
+        unit_price,
+    ) in order.order_items.values_list(
+        "product_id", "product__collection_id", "quantity", "unit_price"
+    ):
+        for totals, key in ((products, product_id), (collections, collection_id)):
+            total_quantity, total_spend = totals.get(key, (0, 0))
+            totals[key] = (
+                total_quantity + quantity,
+                total_spend + quantity * unit_price,
+            )
+
+    CustomerProductHistory.objects.add(
+        [
+            {
+                "customer": order.customer_id,
+                "product": product_id,
+                "quantity": quantity,
+                "spend": spend,
+                "last_purchased_at": order.placed_at,
+            }
+            for product_id, (quantity, spend) in products.items()
+        ],
+        unique=["customer", "product"],
+    )
+    CustomerCollectionSpend.objects.add(
+        [
+            {
+                "customer": order.customer_id,
+                "collection": collection_id,
+                "quantity": quantity,
+                "spend": spend,
+                "last_purchased_at": order.placed_at,
+            }
+            for collection_id, (quantity, spend) in collections.items()
+        ],
+        unique=["customer", "collection"],
+    )
+
+
+def rebuild_history(customer_ids):
+    """
+    Recompute the history of customers from all of their orders.
+
+    Args:
+        customer_ids (list): ids of the customers
+    """
+    items = OrderItem.objects.filter(order__customer_id__in=customer_ids).order_by()
+    # Aliased so that they do not shadow the quantity field in the spend
+    totals = dict(
+        total_quantity=Sum("quantity"),
+        total_spend=_money(Sum(F("quantity") * F("unit_price"))),
+        last=Max("order__placed_at"),
+    )
+    product_rows = items.values("order__customer_id", "product_id").annotate(**totals)
+    collection_rows = items.values(
+        "order__customer_id", "product__collection_id"
+    ).annotate(**totals)
+
+    with transaction.atomic():
+        CustomerProductHistory.objects.filter(customer_id__in=customer_ids).delete()
+        CustomerProductHistory.objects.bulk_create(
+            [
+                CustomerProductHistory(
+                    customer_id=row["order__customer_id"],
+                    product_id=row["product_id"],
+                    quantity=row["total_quantity"],
+                    spend=row["total_spend"],
+                    last_purchased_at=row["last"],
+                )
+                for row in product_rows
+            ],
+            batch_size=1000,
+        )
+        CustomerCollectionSpend.objects.filter(customer_id__in=customer_ids).delete()
+        CustomerCollectionSpend.objects.bulk_create(
+            [
+                CustomerCollectionSpend(
+                    customer_id=row["order__customer_id"],
+                    collection_id=row["product__collection_id"],
+                    quantity=row["total_quantity"],
+                    spend=row["total_spend"],
+                    last_purchased_at=row["last"],
+                )
+                for row in collection_rows
+            ],
+            batch_size=1000,
+        )
@@ -0,0 +1,146 @@
+"""
+A module that makes POST endpoints safe to retry with an Idempotency-Key header.
+
+The first successful response to a request carrying the header is kept in the
+cache for IDEMPOTENCY_TTL, and any retry with the same key (by the same user, on
+the same URL) gets that response back instead of running the view again. While
+the first request is still running, it holds a lock in Redis and retries wait
+for it for a few seconds rather than running alongside it.
+"""
+
+from functools import wraps
+from hashlib import md5
+import json
+from time import monotonic, sleep
+from uuid import uuid4
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from rest_framework import status
+from rest_framework.response import Response
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+RESULT_KEY = "store:idempotency:{}"
+LOCK_KEY = "store:idempotency-lock:{}"
+IDEMPOTENCY_TTL = 24 * 60 * 60
+# A request holding the lock longer than this is presumed dead
+LOCK_TIMEOUT = 30
+# How long a retry waits for the request holding the lock, so that a worker is
+# not tied up for all of LOCK_TIMEOUT
+LOCK_WAIT = 3
+LOCK_POLL_INTERVAL = 0.05
+MAX_KEY_LENGTH = 255
+# Deletes the lock only while it still holds the token of the request, which
+# may have outlived LOCK_TIMEOUT and lost it to a retry
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def _scope(request, key):
+    user = request.user.pk if request.user.is_authenticated else ""
+    return md5(f"{user}:{request.method}:{request.path}:{key}".encode()).hexdigest()
+
+
+def _fingerprint(request):
+    data = json.dumps(request.data, sort_keys=True, default=str)
+    return md5(data.encode()).hexdigest()
+
+
+def _replay(request, result):
+    if result["fingerprint"] != _fingerprint(request):
+        return Response(
+            {"detail": f"This {IDEMPOTENCY_HEADER} was used with another request."},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        )
+    return Response(
+        result["data"], status=result["status"], headers={REPLAYED_HEADER: "true"}
+    )
+
+
+def _acquire_lock(client, lock_key, result_key):
+    """
+    Take the lock, waiting up to LOCK_WAIT for the request that holds it.
+
+    Returns:
+        tuple: (the token that releases the lock, None when it was not taken;
+               the result stored by the request that held it, if any)
+    """
+    token = uuid4().hex
+    deadline = monotonic() + LOCK_WAIT
+    while not client.set(lock_key, token, nx=True, px=int(LOCK_TIMEOUT * 1000)):
+        result = cache.get(result_key)
+        if result is not None or monotonic() > deadline:
+            return None, result
+        sleep(LOCK_POLL_INTERVAL)
+    return token, None
+
+
+def _release_lock(client, lock_key, token):
+    client.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+
+
+def idempotent(handler):
+    """
+    Decorate a viewset method so that requests with an Idempotency-Key header
+    run at most once per key.
+
+    Only 2xx responses are stored: a failed request can be retried with the
+    same key. Reusing a key for a different payload returns 422, and a retry
+    that gave up waiting on the lock returns 409.
+    """
+
+    @wraps(handler)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return handler(self, request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response(
+                {"detail": f"{IDEMPOTENCY_HEADER} is too long."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        scope = _scope(request, key)
+        result_key, lock_key = RESULT_KEY.format(scope), LOCK_KEY.format(scope)
+        # Replays are served from the cache alone
+        result = cache.get(result_key)
+        if result is not None:
+            return _replay(request, result)
+
+        client = get_redis_connection("default")
+        token, result = _acquire_lock(client, lock_key, result_key)
+        if result is not None:
+            return _replay(request, result)
+        if token is None:
+            return Response(
+                {"detail": "A request with this key is still in progress."},
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        try:
+            # The request we waited for may have finished in the meantime
+            result = cache.get(result_key)
+            if result is not None:
+                return _replay(request, result)
+
+            response = handler(self, request, *args, **kwargs)
+            if status.is_success(response.status_code):
+                cache.set(
+                    result_key,
+                    {
+                        "fingerprint": _fingerprint(request),
+                        "status": response.status_code,
+                        "data": response.data,
+                    },
+                    IDEMPOTENCY_TTL,
+                )
+            return response
+        finally:
+            _release_lock(client, lock_key, token)
+
+    return wrapper
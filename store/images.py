@@ -0,0 +1,110 @@
+"""
+A module that generates the derivatives of product images.
+
+An uploaded ProductImage only stores the original. Once it is committed, the
+generate_image_variants Celery task renders a WebP thumbnail per size of SIZES
+with Pillow and stores it next to the original (store/images/shoe.jpg gets
+store/images/shoe_small.webp, ...). The storage names end up in
+ProductImage.variants, which the API and the admin read to serve kilobytes
+instead of the full originals.
+
+Originals are content addressed (see store.storage), so a derivative that
+exists already was rendered from the same pixels and is reused. Files are only
+deleted once no ProductImage refers to their blob anymore.
+"""
+
+from io import BytesIO
+import os
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from .models import ImageBlob, ProductImage
+
+# Longest side in pixels, the aspect ratio is kept
+SIZES = {
+    "small": 150,
+    "medium": 600,
+    "large": 1200,
+}
+WEBP_QUALITY = 80
+
+
+def variant_name(name, size):
+    stem, _ = os.path.splitext(name)
+    return f"{stem}_{size}.webp"
+
+
+def render_variant(image, size):
+    """
+    Render a WebP thumbnail of an image.
+
+    Args:
+        image (Image): the opened original
+        size (int): longest side of the thumbnail in pixels
+
+    Returns:
+        bytes: the encoded WebP
+    """
+    variant = image.copy()
+    # Never upscale, a thumbnail of a small original is the original size
+    variant.thumbnail((size, size), Image.LANCZOS)
+    output = BytesIO()
+    variant.save(output, "WEBP", quality=WEBP_QUALITY, method=4)
+    return output.getvalue()
+
+
+def generate_variants(product_image):
+    """
+    Generate and store the missing derivatives of a product image.
+
+    Args:
+        product_image (ProductImage): instance of product image
+
+    Returns:
+        dict: the storage names by size
+    """
+    storage = product_image.image.storage
+    variants = {size: variant_name(product_image.image.name, size) for size in SIZES}
+    missing = [size for size, name in variants.items() if not storage.exists(name)]
+
+    if missing:
+        with product_image.image.open("rb") as file:
+            image = Image.open(file)
+            # Phones store the orientation in EXIF instead of rotating the pixels
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        for size in missing:
+            storage.save_derivative(
+                variants[size], ContentFile(render_variant(image, SIZES[size]))
+            )
+
+    # update(): saving the instance would queue the task again
+    ProductImage.objects.filter(pk=product_image.pk).update(variants=variants)
+    product_image.variants = variants
+    return variants
+
+
+def delete_unreferenced(name):
+    """
+    Delete a stored original and its derivatives once nothing refers to them.
+
+    Args:
+        name (str): storage name of the original
+
+    Returns:
+        bool: whether the files were deleted
+    """
+    storage = ProductImage._meta.get_field("image").storage
+    with transaction.atomic():
+        # Checked under the lock: an upload of the same content counts itself
+        # before placing the file, and waits for the lock to do so
+        blob = ImageBlob.objects.select_for_update().filter(name=name).first()
+        if blob is None or blob.references > 0:
+            return False
+        blob.delete()
+        storage.delete(name)
+        for size in SIZES:
+            storage.delete(variant_name(name, size))
+    return True
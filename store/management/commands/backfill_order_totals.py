@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store.models import Order
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills in Order.total and Order.item_count from the order items, chunk by chunk"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of orders updated per transaction",
+        )
+
+    def handle(self, *args, **options):
+        orders = Order.objects.order_by("id").values_list("id", flat=True)
+        backfilled = 0
+        last_id = 0
+        while True:
+            ids = list(orders.filter(id__gt=last_id)[: options["chunk_size"]])
+            if not ids:
+                break
+
+            with transaction.atomic():
+                Order.objects.refresh_totals(ids)
+            backfilled += len(ids)
+            last_id = ids[-1]
+
+        self.stdout.write(f"Backfilled {backfilled} orders")
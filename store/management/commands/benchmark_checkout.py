@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.exceptions import ValidationError
+
+from store.models import Cart, CartItem, Collection, Order, OrderItem, Product
+from store.serializers import CreateOrderSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        "Checks out many carts of a single hot product concurrently and reports "
+        "the checkout throughput (run it against MySQL, not SQLite)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--carts", type=int, default=500)
+        parser.add_argument("--workers", type=int, default=16)
+        parser.add_argument(
+            "--inventory",
+            type=int,
+            default=None,
+            help="Starting inventory of the hot product, half the carts by default "
+            "so that the rest of the checkouts run out of stock",
+        )
+
+    def handle(self, *args, **options):
+        carts = options["carts"]
+        inventory = options["inventory"]
+        if inventory is None:
+            inventory = carts // 2
+
+        user = get_user_model().objects.create(
+            username=f"checkout-bench-{perf_counter()}"
+        )
+        collection = Collection.objects.create(title="Checkout benchmark")
+        product = Product.objects.create(
+            title="Hot product",
+            slug="hot-product",
+            unit_price=10,
+            inventory=inventory,
+            collection=collection,
+        )
+        cart_ids = [
+            cart.id for cart in Cart.objects.bulk_create(Cart() for _ in range(carts))
+        ]
+        CartItem.objects.bulk_create(
+            CartItem(cart_id=cart_id, product=product, quantity=1)
+            for cart_id in cart_ids
+        )
+
+        try:
+            started = perf_counter()
+            with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+                results = list(
+                    executor.map(
+                        lambda cart_id: self.checkout(cart_id, user.customer.id),
+                        cart_ids,
+                    )
+                )
+            elapsed = perf_counter() - started
+
+            ordered = results.count(True)
+            product.refresh_from_db()
+            self.stdout.write(
+                f"{carts} checkouts by {options['workers']} workers in {elapsed:.2f}s "
+                f"({carts / elapsed:.0f}/s): {ordered} ordered, "
+                f"{carts - ordered} out of stock, {product.inventory} left"
+            )
+            if product.inventory != inventory - ordered or product.inventory < 0:
+                self.stderr.write("Inventory does not match the orders placed")
+        finally:
+            orders = Order.objects.filter(customer__user=user)
+            OrderItem.objects.filter(order__in=orders).delete()
+            orders.delete()
+            Cart.objects.filter(pk__in=cart_ids).delete()
+            product.delete()
+            collection.delete()
+            user.delete()
+
+    def checkout(self, cart_id, customer_id):
+        try:
+            serializer = CreateOrderSerializer(
+                data={"cart_id": cart_id}, context={"customer_id": customer_id}
+            )
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+            return True
+        except ValidationError:
+            return False
+        finally:
+            # Every worker thread has its own connection
+            connection.close()
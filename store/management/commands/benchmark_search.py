@@ -0,0 +1,87 @@
+from statistics import mean
+from time import perf_counter
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from store.models import Product
+from store.search import ProductSearchFilter, rebuild_index, tokenize
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the indexed product search with the icontains scans "
+        "of DRF's SearchFilter on the current catalog"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "queries",
+            nargs="*",
+            default=["bread", "chick", "wine red", "sauce", "pepper"],
+        )
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument(
+            "--grow-to",
+            type=int,
+            default=0,
+            help="Copy existing products until the catalog has this many rows "
+            "(e.g. after seed_db) so the comparison runs on a large catalog",
+        )
+
+    def handle(self, *args, **options):
+        if options["grow_to"]:
+            self.grow_catalog(options["grow_to"])
+
+        self.stdout.write(f"Catalog size: {Product.objects.count()} products")
+        backend = ProductSearchFilter()
+        for query in options["queries"]:
+            # This is the queryset SearchFilter builds for
+            # search_fields = ["title", "description"].
+            like = Product.objects.all()
+            for word in query.split():
+                like = like.filter(
+                    Q(title__icontains=word) | Q(description__icontains=word)
+                )
+            indexed = backend.search(Product.objects.all(), tokenize(query))
+
+            like_ms = self.time(like, options["repeat"])
+            indexed_ms = self.time(indexed, options["repeat"])
+            self.stdout.write(
+                f"{query!r}: SearchFilter {like_ms:.2f}ms, "
+                f"index {indexed_ms:.2f}ms "
+                f"({like.count()} vs {indexed.count()} matches)"
+            )
+
+    def time(self, queryset, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = perf_counter()
+            list(queryset[:10])
+            timings.append((perf_counter() - started) * 1000)
+        return mean(timings)
+
+    def grow_catalog(self, size):
+        templates = list(Product.objects.order_by("id")[:1000])
+        missing = size - Product.objects.count()
+        if not templates or missing <= 0:
+            return
+
+        last_id = Product.objects.order_by("-id").values_list("id", flat=True)[0]
+        copies = []
+        for i in range(missing):
+            template = templates[i % len(templates)]
+            copies.append(
+                Product(
+                    title=template.title,
+                    slug=template.slug,
+                    description=template.description,
+                    unit_price=template.unit_price,
+                    inventory=template.inventory,
+                    collection_id=template.collection_id,
+                )
+            )
+        Product.objects.bulk_create(copies, batch_size=1000)
+        # bulk_create() skips post_save, so index the new rows explicitly.
+        rebuild_index(Product.objects.filter(id__gt=last_id))
+        call_command("reconcile_products_count")
@@ -0,0 +1,89 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store.caching import PRODUCTS, bump_versions
+from store.images import delete_unreferenced
+from store.models import ImageBlob, ProductImage
+from store.tasks import delay_on_commit, generate_image_variants
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the product images stored before content addressing to their "
+        "digest names, so that every distinct file is kept once"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of distinct file names read per query",
+        )
+
+    def handle(self, *args, **options):
+        storage = ProductImage._meta.get_field("image").storage
+        names = (
+            ProductImage.objects.exclude(image="")
+            .order_by("image")
+            .values_list("image", flat=True)
+            .distinct()
+        )
+        stats = {"files": 0, "duplicates": 0, "freed": 0, "missing": 0}
+
+        last_name = ""
+        while True:
+            chunk = list(names.filter(image__gt=last_name)[: options["chunk_size"]])
+            if not chunk:
+                break
+            for name in chunk:
+                if storage.is_digest_name(name):
+                    continue
+                if not storage.exists(name):
+                    stats["missing"] += 1
+                    continue
+                self.dedupe(storage, name, stats)
+            last_name = chunk[-1]
+
+        # Product responses embed the image URLs
+        bump_versions(PRODUCTS)
+        self.stdout.write(
+            f"Moved {stats['files']} files to digest names, {stats['duplicates']} "
+            f"were duplicates ({stats['freed']} bytes freed), "
+            f"{stats['missing']} were missing"
+        )
+
+    def dedupe(self, storage, name, stats):
+        size = storage.size(name)
+        with storage.open(name) as file:
+            # Counts one reference to the digest name
+            digest_name = storage.save(name, file)
+
+        with transaction.atomic():
+            ids = list(
+                ProductImage.objects.select_for_update()
+                .filter(image=name)
+                .values_list("id", flat=True)
+            )
+            # More than the reference storage.save() took above
+            duplicate = ImageBlob.objects.filter(
+                name=digest_name, references__gte=2
+            ).exists()
+            # update(): the signal handlers would count every row one by one
+            ProductImage.objects.filter(id__in=ids).update(
+                image=digest_name, variants={}
+            )
+            ImageBlob.objects.acquire(digest_name, len(ids) - 1)
+            ImageBlob.objects.update_or_create(name=name, defaults={"references": 0})
+            transaction.on_commit(lambda: delete_unreferenced(name))
+            if not ids:
+                # The rows moved on meanwhile, nothing keeps the digest name
+                transaction.on_commit(lambda: delete_unreferenced(digest_name))
+            for product_image_id in ids:
+                # Rendered once per digest, the other images reuse the files
+                delay_on_commit(generate_image_variants, product_image_id)
+
+        stats["files"] += 1
+        if duplicate:
+            stats["duplicates"] += 1
+            stats["freed"] += size
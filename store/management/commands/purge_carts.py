@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from store.carts import purge_carts
+
+
+class Command(BaseCommand):
+    help = "Deletes the carts nobody touched for a number of days"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.STORE_ABANDONED_CART_DAYS,
+            help="Age in days past which an untouched cart is abandoned",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of carts deleted per transaction",
+        )
+
+    def handle(self, *args, **options):
+        purged = purge_carts(
+            timedelta(days=options["days"]), chunk_size=options["chunk_size"]
+        )
+        self.stdout.write(
+            f"Purged {purged['carts']} carts ({purged['items']} items) "
+            f"in {purged['seconds']}s"
+        )
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from store.history import rebuild_history
+from store.models import Customer
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the purchase history rollup of every customer from their orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of customers rebuilt per transaction",
+        )
+
+    def handle(self, *args, **options):
+        customers = Customer.objects.order_by("id").values_list("id", flat=True)
+        rebuilt = 0
+        last_id = 0
+        while True:
+            ids = list(customers.filter(id__gt=last_id)[: options["chunk_size"]])
+            if not ids:
+                break
+
+            rebuild_history(ids)
+            rebuilt += len(ids)
+            last_id = ids[-1]
+
+        self.stdout.write(f"Rebuilt the history of {rebuilt} customers")
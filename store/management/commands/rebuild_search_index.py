@@ -0,0 +1,18 @@
+from time import perf_counter
+from django.core.management.base import BaseCommand
+
+from store.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the product search index from scratch"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        started = perf_counter()
+        indexed = rebuild_index(batch_size=options["batch_size"])
+        self.stdout.write(
+            f"Indexed {indexed} products in {perf_counter() - started:.2f}s"
+        )
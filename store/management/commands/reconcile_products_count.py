@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F
+
+from store.caching import COLLECTIONS, bump_versions
+from store.models import Collection
+
+
+class Command(BaseCommand):
+    help = "Repairs Collection.products_count where it drifted from the products table"
+
+    def handle(self, *args, **options):
+        # One GROUP BY over the products table finds every drifted counter
+        drifted = [
+            Collection(id=collection_id, products_count=actual)
+            for collection_id, actual in Collection.objects.annotate(
+                actual=Count("products")
+            )
+            .exclude(products_count=F("actual"))
+            .values_list("id", "actual")
+        ]
+        Collection.objects.bulk_update(drifted, ["products_count"], batch_size=500)
+        if drifted:
+            bump_versions(COLLECTIONS)
+
+        self.stdout.write(f"Reconciled {len(drifted)} collections")
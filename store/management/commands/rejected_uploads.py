@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from store.uploads import get_rejected_counts, reset_rejected_counts
+
+
+class Command(BaseCommand):
+    help = "Reports the image uploads that were rejected while streaming in"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reset",
+            action="store_true",
+            help="Reset the counters after reporting them",
+        )
+
+    def handle(self, *args, **options):
+        for reason, counts in get_rejected_counts().items():
+            self.stdout.write(
+                f"{reason}: {counts['uploads']} uploads, {counts['read']} of "
+                f"{counts['bytes']} bytes read"
+            )
+        if options["reset"]:
+            reset_rejected_counts()
@@ -1,3 +1,4 @@
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
 from django.db import connection
 from pathlib import Path
@@ -5,13 +6,18 @@ import os
 
 
 class Command(BaseCommand):
-    help = 'Populates the database with collections and products'
+    help = "Populates the database with collections and products"
 
     def handle(self, *args, **options):
-        print('Populating the database...')
+        print("Populating the database...")
         current_dir = os.path.dirname(__file__)
-        file_path = os.path.join(current_dir, 'seed.sql')
+        file_path = os.path.join(current_dir, "seed.sql")
         sql = Path(file_path).read_text()
 
         with connection.cursor() as cursor:
             cursor.execute(sql)
+
+        # The raw SQL bypasses the post_save handlers that keep the search index
+        # and the collection products counts up to date
+        call_command("rebuild_search_index")
+        call_command("reconcile_products_count")
@@ -0,0 +1,166 @@
+"""
+A module that serves the uploaded media files.
+
+Product images are stored under the digest of their content (see
+store.storage), and their derivatives under the digest of their source, so the
+URL of such a file never changes content. serve_media() marks those responses
+immutable for a year. Conditional and Range requests are answered here.
+
+The bytes themselves are not copied by Python workers. With
+settings.MEDIA_ACCEL_REDIRECT set, the response only carries an X-Accel-Redirect
+to that internal nginx location and nginx serves the file. Otherwise it is a
+FileResponse, whose file gunicorn hands to sendfile(): for a Range from the
+offset of the range and for Content-Length bytes.
+"""
+
+import mimetypes
+import os
+import re
+import stat
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.encoding import iri_to_uri
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from django.views.decorators.http import require_safe
+
+# <digest prefix>/<digest>.jpg, or <digest>_small.webp for a derivative
+DIGEST_PATH_RE = re.compile(r"(^|/)([0-9a-f]{2})/\2[0-9a-f]{62}(_\w+)?\.\w+$")
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Files stored before content addressing, until dedupe_images moved them
+CACHE_CONTROL = "public, max-age=3600"
+
+
+class RangeFile:
+    """
+    A file object that reads a byte range of an open file.
+
+    It keeps fileno() so that the WSGI server can still sendfile() it: the
+    file is positioned at the start of the range, and the Content-Length of the
+    response bounds how much is sent.
+    """
+
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(request, size, etag, last_modified):
+    """
+    Get the byte range a request asks for.
+
+    Only single ranges are supported, for anything else the whole file is
+    served, as RFC 7233 allows.
+
+    Args:
+        request (HttpRequest): instance of request obj
+        size (int): size of the file
+        etag (str): the quoted ETag of the file
+        last_modified (int): modification time of the file, unix timestamp
+
+    Returns:
+        tuple: first and last byte (inclusive), the first is past the end when
+            the range can not be satisfied; None to serve the whole file
+    """
+    match = RANGE_RE.match(request.META.get("HTTP_RANGE", ""))
+    if match is None:
+        return None
+
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if if_range is not None and if_range != etag:
+        # Either validator may be used, the range only holds for this version
+        if parse_http_date_safe(if_range) != last_modified:
+            return None
+
+    first, last = match.groups()
+    if first:
+        first = int(first)
+        if last and int(last) < first:
+            # Invalid, ignored rather than refused
+            return None
+        last = min(int(last), size - 1) if last else size - 1
+    elif last:
+        # A suffix: the last N bytes
+        first = max(size - int(last), 0)
+        last = size - 1
+    else:
+        return None
+    return first, last
+
+
+@require_safe
+def serve_media(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stats = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404
+    if not stat.S_ISREG(stats.st_mode):
+        raise Http404
+
+    last_modified = int(stats.st_mtime)
+    etag = quote_etag(f"{last_modified:x}-{stats.st_size:x}")
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = file_response(
+            request, path, full_path, stats.st_size, etag, last_modified
+        )
+
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Accept-Ranges"] = "bytes"
+    if DIGEST_PATH_RE.search(path):
+        response["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    else:
+        response["Cache-Control"] = CACHE_CONTROL
+    return response
+
+
+def file_response(request, path, full_path, size, etag, last_modified):
+    content_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+
+    if settings.MEDIA_ACCEL_REDIRECT:
+        # nginx answers Range requests itself
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = iri_to_uri(
+            f"{settings.MEDIA_ACCEL_REDIRECT.rstrip('/')}/{path}"
+        )
+        return response
+
+    byte_range = parse_range(request, size, etag, last_modified)
+    if byte_range is None:
+        return FileResponse(open(full_path, "rb"), content_type=content_type)
+
+    first, last = byte_range
+    if first >= size:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    length = last - first + 1
+    response = FileResponse(
+        RangeFile(open(full_path, "rb"), first, length),
+        status=206,
+        content_type=content_type,
+    )
+    response["Content-Length"] = length
+    response["Content-Range"] = f"bytes {first}-{last}/{size}"
+    return response
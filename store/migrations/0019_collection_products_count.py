@@ -0,0 +1,28 @@
+# Generated by Django 4.1b1 on 2026-10-18 03:41
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_products(apps, schema_editor):
+    Collection = apps.get_model("store", "Collection")
+    collections = Collection.objects.annotate(actual=Count("products"))
+    for collection in collections:
+        collection.products_count = collection.actual
+    Collection.objects.bulk_update(collections, ["products_count"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0018_productsearchterm"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collection",
+            name="products_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_products, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1b1 on 2026-10-18 03:49
+
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def touch_from_created_at(apps, schema_editor):
+    Cart = apps.get_model("store", "Cart")
+    Cart.objects.update(touched_at=F("created_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0019_collection_products_count"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="cart",
+            name="touched_at",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now
+            ),
+        ),
+        migrations.RunPython(touch_from_created_at, migrations.RunPython.noop),
+    ]
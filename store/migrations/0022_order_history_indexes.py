@@ -0,0 +1,25 @@
+# Generated by Django 4.1b1 on 2026-10-18 03:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0021_outboxevent"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(
+                fields=["customer", "placed_at"], name="store_order_custome_700a25_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(
+                fields=["placed_at"], name="store_order_placed__4c2ef7_idx"
+            ),
+        ),
+    ]
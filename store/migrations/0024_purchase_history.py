@@ -0,0 +1,86 @@
+# Generated by Django 4.1b1 on 2026-10-18 04:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0023_order_total_item_count"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CustomerCollectionSpend",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("quantity", models.PositiveIntegerField()),
+                ("spend", models.DecimalField(decimal_places=2, max_digits=12)),
+                ("last_purchased_at", models.DateTimeField()),
+                (
+                    "collection",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="store.collection",
+                    ),
+                ),
+                (
+                    "customer",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="collection_spend",
+                        to="store.customer",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("customer", "collection")},
+            },
+        ),
+        migrations.CreateModel(
+            name="CustomerProductHistory",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("quantity", models.PositiveIntegerField()),
+                ("spend", models.DecimalField(decimal_places=2, max_digits=12)),
+                ("last_purchased_at", models.DateTimeField()),
+                (
+                    "customer",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="product_history",
+                        to="store.customer",
+                    ),
+                ),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="store.product",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("customer", "product")},
+            },
+        ),
+    ]
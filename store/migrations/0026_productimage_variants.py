@@ -0,0 +1,18 @@
+# Generated by Django 4.1b1 on 2026-10-18 04:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0025_review_rating"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="productimage",
+            name="variants",
+            field=models.JSONField(default=dict, editable=False),
+        ),
+    ]
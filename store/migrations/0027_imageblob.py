@@ -0,0 +1,60 @@
+# Generated by Django 4.1b1 on 2026-10-18 04:10
+
+from django.db import migrations, models
+from django.db.models import Count
+import store.storage
+import store.validators
+
+
+def count_image_references(apps, schema_editor):
+    ImageBlob = apps.get_model("store", "ImageBlob")
+    ProductImage = apps.get_model("store", "ProductImage")
+    references = (
+        ProductImage.objects.exclude(image="")
+        .values("image")
+        .annotate(references=Count("id"))
+        .order_by()
+    )
+    ImageBlob.objects.bulk_create(
+        [
+            ImageBlob(name=row["image"], references=row["references"])
+            for row in references
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0026_productimage_variants"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImageBlob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=255, unique=True)),
+                ("references", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="productimage",
+            name="image",
+            field=models.ImageField(
+                storage=store.storage.ContentAddressedStorage(),
+                upload_to="store/images",
+                validators=[store.validators.validate_file_size],
+            ),
+        ),
+        migrations.RunPython(count_image_references, migrations.RunPython.noop),
+    ]
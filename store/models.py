@@ -1,12 +1,23 @@
-""" 
-This module provides the function to create a Product, Customer, Address, Collection... Data Model. 
 """
+This module provides the function to create a Product, Customer, Address, Collection... Data Model.
+"""
+
+from decimal import Decimal
 from uuid import uuid4
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import Count, F, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.conf import settings
 from django.contrib import admin
-from django.core.validators import MinValueValidator, FileExtensionValidator
-
+from django.core.validators import (
+    FileExtensionValidator,
+    MaxValueValidator,
+    MinValueValidator,
+)
+
+from store.caching import invalidate_cart_summary
+from store.storage import ContentAddressedStorage
 from store.validators import validate_file_size
 
 
@@ -31,11 +42,13 @@ class Collection(models.Model):
     Fields:
         title (str): The field for the title of the collection.
         featured_product (int): The field for connecting many collection to a product.
+        products_count (int): The field for the number of products in the collection, kept up to date by the product signal handlers.
     """
 
     featured_product = models.ForeignKey(
         to="Product", on_delete=models.SET_NULL, null=True, related_name="+"
     )
+    products_count = models.PositiveIntegerField(default=0, editable=False)
     title = models.CharField(max_length=255)
 
     def __str__(self):
@@ -45,6 +58,71 @@ class Collection(models.Model):
         ordering = ["title"]
 
 
+class OutOfStock(Exception):
+    """
+    Raised when there is not enough inventory left to reserve.
+
+    Attributes:
+        product_ids (list): ids of the products that ran out
+    """
+
+    def __init__(self, product_ids):
+        super().__init__(f"Not enough inventory for products {product_ids}")
+        self.product_ids = product_ids
+
+
+class ProductManager(models.Manager):
+    """
+    A ProductManager for reserving inventory without locking product rows up front.
+    """
+
+    def reserve_inventory(self, quantities):
+        """
+        Take quantities off the inventory of products with a single conditional
+        UPDATE ... SET inventory = inventory - q WHERE inventory >= q.
+
+        Concurrent checkouts of the same product queue on its row only for the
+        UPDATE itself, never read-modify-write, and can not oversell. The rows
+        are updated in id order (UPDATE ... ORDER BY on MySQL) so two carts can
+        not deadlock on each other. The UPDATE runs in a savepoint that is rolled
+        back when any product falls short, so a failure reserves nothing.
+
+        Args:
+            quantities (dict): quantity to reserve by product id
+
+        Raises:
+            OutOfStock: when any product has less inventory than asked for
+        """
+        if not quantities:
+            return
+
+        wanted = models.Case(
+            *[
+                models.When(pk=product_id, then=Value(quantity))
+                for product_id, quantity in quantities.items()
+            ],
+            output_field=models.IntegerField(),
+        )
+        try:
+            with transaction.atomic(using=self.db):
+                reserved = (
+                    self.filter(pk__in=quantities, inventory__gte=wanted)
+                    .order_by("pk")
+                    .update(inventory=F("inventory") - wanted)
+                )
+                if reserved < len(quantities):
+                    # Rolls the savepoint back
+                    raise OutOfStock([])
+        except OutOfStock:
+            raise OutOfStock(
+                list(
+                    self.filter(pk__in=quantities, inventory__lt=wanted)
+                    .order_by("pk")
+                    .values_list("pk", flat=True)
+                )
+            )
+
+
 class Product(models.Model):
     """
     A Product class for creating a Product obj.
@@ -73,6 +151,8 @@ class Product(models.Model):
         max_digits=6, decimal_places=2, validators=[MinValueValidator(1)]
     )
 
+    objects = ProductManager()
+
     def __str__(self):
         return self.title
 
@@ -80,19 +160,87 @@ class Product(models.Model):
         ordering = ["title"]
 
 
+class ProductSearchTerm(models.Model):
+    """
+    A ProductSearchTerm class for the inverted index used by product search.
+
+    Fields:
+        product (int): The field for connecting many search terms to a product.
+        term (str): The field for the lowercase word found in the product.
+        weight (int): The field for how much the term counts towards relevance.
+    """
+
+    product = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name="search_terms"
+    )
+    term = models.CharField(max_length=64)
+    weight = models.PositiveSmallIntegerField()
+
+    class Meta:
+        # The (term, product) index also serves the term LIKE 'abc%' prefix lookups.
+        unique_together = [["term", "product"]]
+
+
 class ProductImage(models.Model):
     product = models.ForeignKey(
         Product, on_delete=models.CASCADE, related_name="product_images"
     )
     image = models.ImageField(
         upload_to="store/images",
+        storage=ContentAddressedStorage(),
         validators=[validate_file_size],
     )
+    # Storage names of the generated derivatives by size, see store.images
+    variants = models.JSONField(default=dict, editable=False)
     # files = models.FileField(
     #     upload_to="store/files",
     #     validators=[FileExtensionValidator(allowed_extensions=["pdf"])],
     # )
 
+    def variant_url(self, size):
+        """
+        Get the URL of a derivative, or of the original until it exists.
+
+        Args:
+            size (str): a size of store.images.SIZES
+
+        Returns:
+            str: the URL
+        """
+        name = self.variants.get(size)
+        if name is None:
+            return self.image.url
+        return self.image.storage.url(name)
+
+
+class ImageBlobManager(models.Manager):
+    def acquire(self, name, references=1):
+        _upsert_adding(
+            self.model,
+            self.db,
+            [{"name": name, "references": references}],
+            unique=["name"],
+            add=["references"],
+        )
+
+    def release(self, name):
+        self.filter(name=name, references__gte=1).update(references=F("references") - 1)
+
+
+class ImageBlob(models.Model):
+    """
+    A ImageBlob class for counting the product images that share a stored file.
+
+    Fields:
+        name (str): The field for the storage name of the file (see store.storage).
+        references (int): The field for the number of product images referring to it.
+    """
+
+    name = models.CharField(max_length=255, unique=True)
+    references = models.PositiveIntegerField(default=0)
+
+    objects = ImageBlobManager()
+
 
 class Review(models.Model):
     product = models.ForeignKey(
@@ -101,6 +249,168 @@ class Review(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField()
     date = models.DateTimeField(auto_now_add=True)
+    # Null for the reviews written before ratings existed
+    rating = models.PositiveSmallIntegerField(
+        null=True, validators=[MinValueValidator(1), MaxValueValidator(5)]
+    )
+
+    class Meta:
+        # Review pages of a product, newest first
+        indexes = [models.Index(fields=["product", "date"])]
+
+
+class ProductRatingManager(models.Manager):
+    """
+    A ProductRatingManager for counting ratings in and out of the aggregates.
+    """
+
+    def add_rating(self, product_id, rating):
+        stars = {f"stars_{n}": int(n == rating) for n in range(1, 6)}
+        _upsert_adding(
+            self.model,
+            self.db,
+            [{"product": product_id, "count": 1, "total": rating, **stars}],
+            unique=["product"],
+            add=["count", "total", *stars],
+        )
+
+    def remove_rating(self, product_id, rating):
+        column = f"stars_{rating}"
+        self.filter(pk=product_id, **{f"{column}__gte": 1}).update(
+            count=F("count") - 1,
+            total=F("total") - rating,
+            **{column: F(column) - 1},
+        )
+
+
+class ProductRating(models.Model):
+    """
+    A ProductRating class for the rating aggregates of a product, kept up to date by the review signal handlers.
+
+    Fields:
+        product (int): The field for connecting the aggregates to their product.
+        count (int): The field for the number of rated reviews.
+        total (int): The field for the sum of the ratings.
+        stars_1 ... stars_5 (int): The fields for the number of reviews per rating (the histogram).
+    """
+
+    product = models.OneToOneField(
+        Product, on_delete=models.CASCADE, primary_key=True, related_name="rating"
+    )
+    count = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    stars_1 = models.PositiveIntegerField(default=0)
+    stars_2 = models.PositiveIntegerField(default=0)
+    stars_3 = models.PositiveIntegerField(default=0)
+    stars_4 = models.PositiveIntegerField(default=0)
+    stars_5 = models.PositiveIntegerField(default=0)
+
+    objects = ProductRatingManager()
+
+    @property
+    def average(self):
+        if not self.count:
+            return None
+        return round(Decimal(self.total) / self.count, 2)
+
+    @property
+    def histogram(self):
+        return {stars: getattr(self, f"stars_{stars}") for stars in range(1, 6)}
+
+
+def _money(expression):
+    return models.ExpressionWrapper(
+        expression, output_field=models.DecimalField(max_digits=12, decimal_places=2)
+    )
+
+
+def _upsert_adding(model, using, rows, unique, add=(), latest=()):
+    """
+    Insert rows with a single INSERT ... upsert statement. When a row with the
+    same unique fields exists, the add fields are added to it and the latest
+    fields keep the greater value, all in the database, so concurrent writers
+    never lose an update.
+
+    Args:
+        model (Model): the model to write to
+        using (str): the database alias
+        rows (list): dicts of field name to value, all with the same fields
+        unique (list): names of the fields the rows are unique by
+        add (list): names of the fields to add up
+        latest (list): names of the fields to keep the greatest value of
+    """
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    fields = [model._meta.get_field(name) for name in rows[0]]
+
+    def column(name):
+        return quote(model._meta.get_field(name).column)
+
+    params = [
+        field.get_db_prep_save(row[field.name], connection)
+        for row in rows
+        for field in fields
+    ]
+    row_sql = f"({', '.join(['%s'] * len(fields))})"
+    sql = (
+        f"INSERT INTO {table} ({', '.join(quote(field.column) for field in fields)}) "
+        f"VALUES {', '.join([row_sql] * len(rows))} "
+    )
+    if connection.vendor == "mysql":
+        updates = [
+            f"{column(name)} = {column(name)} + VALUES({column(name)})" for name in add
+        ]
+        updates += [
+            f"{column(name)} = GREATEST({column(name)}, VALUES({column(name)}))"
+            for name in latest
+        ]
+        sql += f"ON DUPLICATE KEY UPDATE {', '.join(updates)}"
+    else:
+        # SQLite and PostgreSQL
+        greatest = "MAX" if connection.vendor == "sqlite" else "GREATEST"
+        updates = [
+            f"{column(name)} = {table}.{column(name)} + excluded.{column(name)}"
+            for name in add
+        ]
+        updates += [
+            f"{column(name)} = {greatest}({table}.{column(name)}, excluded.{column(name)})"
+            for name in latest
+        ]
+        sql += (
+            f"ON CONFLICT ({', '.join(column(name) for name in unique)}) "
+            f"DO UPDATE SET {', '.join(updates)}"
+        )
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+class CartManager(models.Manager):
+    """
+    A CartManager for computing cart totals in the database.
+    """
+
+    def with_totals(self):
+        """
+        Annotate carts with total_price = SUM(quantity * unit_price) of their items
+        (0 for an empty cart), item_count and total_quantity.
+        """
+        return self.annotate(
+            total_price=Coalesce(
+                _money(Sum(F("items__quantity") * F("items__product__unit_price"))),
+                Value(Decimal(0)),
+                output_field=models.DecimalField(max_digits=12, decimal_places=2),
+            ),
+            item_count=Count("items"),
+            total_quantity=Coalesce(Sum("items__quantity"), 0),
+        )
+
+    def touch(self, cart_id):
+        """
+        Record that a cart is still in use, so it is not purged as abandoned.
+        """
+        self.filter(pk=cart_id).update(touched_at=timezone.now())
 
 
 class Cart(models.Model):
@@ -109,10 +419,56 @@ class Cart(models.Model):
 
     Field:
         created_at = The field for noting the day and time a cart obj is created.
+        touched_at = The field for noting the last time the cart or its items changed.
     """
 
     id = models.UUIDField(primary_key=True, default=uuid4)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Indexed for the purge of abandoned carts (store.carts.purge_carts)
+    touched_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = CartManager()
+
+
+class CartItemManager(models.Manager):
+    """
+    A CartItemManager for adding to cart item quantities without a read-modify-write.
+    """
+
+    def with_totals(self):
+        """
+        Annotate cart items with total_price = quantity * unit_price.
+        """
+        return self.annotate(
+            total_price=_money(F("quantity") * F("product__unit_price"))
+        )
+
+    def add_quantities(self, cart_id, quantities):
+        """
+        Add quantities to the items of a cart with a single INSERT ... upsert
+        statement: missing items are created, existing ones are incremented in
+        place, so concurrent adds never lose an update or hit unique_together.
+
+        Args:
+            cart_id (UUID): id of the cart
+            quantities (dict): quantity to add by product id
+        """
+        if not quantities:
+            return
+
+        _upsert_adding(
+            self.model,
+            self.db,
+            [
+                {"cart": cart_id, "product": product_id, "quantity": quantity}
+                for product_id, quantity in quantities.items()
+            ],
+            unique=["cart", "product"],
+            add=["quantity"],
+        )
+        # Raw SQL sends no post_save, so do what the CartItem handlers would
+        Cart.objects.touch(cart_id)
+        invalidate_cart_summary(cart_id)
 
 
 class CartItem(models.Model):
@@ -129,6 +485,8 @@ class CartItem(models.Model):
     product = models.ForeignKey(to=Product, on_delete=models.CASCADE)
     quantity = models.PositiveSmallIntegerField(validators=[MinValueValidator(1)])
 
+    objects = CartItemManager()
+
     class Meta:
         unique_together = [["cart", "product"]]
 
@@ -177,6 +535,37 @@ class Customer(models.Model):
         permissions = [("view_history", "Can view history")]
 
 
+class OrderManager(models.Manager):
+    """
+    An OrderManager for keeping the stored order totals in step with the items.
+    """
+
+    def refresh_totals(self, order_ids):
+        """
+        Recompute total = SUM(quantity * unit_price) and item_count of orders
+        from their items, with a single UPDATE.
+
+        Args:
+            order_ids (list): ids of the orders
+        """
+        items = OrderItem.objects.filter(order=models.OuterRef("pk")).values("order")
+        self.filter(pk__in=order_ids).update(
+            total=Coalesce(
+                models.Subquery(
+                    items.annotate(
+                        total=_money(Sum(F("quantity") * F("unit_price")))
+                    ).values("total")
+                ),
+                Value(Decimal(0)),
+                output_field=models.DecimalField(max_digits=12, decimal_places=2),
+            ),
+            item_count=Coalesce(
+                models.Subquery(items.annotate(count=Count("id")).values("count")),
+                0,
+            ),
+        )
+
+
 class Order(models.Model):
     """
     A Order class for creating an order obj.
@@ -184,6 +573,8 @@ class Order(models.Model):
     Fields:
         placed_at (int): The field for adding the date and time at which an order is placed.
         payment_status (int): The field for adding the status of the payment
+        total (float): The field for the sum of quantity * unit_price over the order items.
+        item_count (int): The field for the number of order items.
     """
 
     PAYMENT_STATUS_PENDING = "P"
@@ -199,9 +590,21 @@ class Order(models.Model):
     payment_status = models.CharField(
         max_length=1, choices=PAYMENT_STATUS_CHOICES, default=PAYMENT_STATUS_PENDING
     )
+    # Stored so that listings and revenue reports never aggregate order items
+    total = models.DecimalField(
+        max_digits=12, decimal_places=2, default=0, editable=False
+    )
+    item_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = OrderManager()
 
     class Meta:
         permissions = [("cancel_order", "Can cancel order")]
+        # Order history pages, per customer and for staff
+        indexes = [
+            models.Index(fields=["customer", "placed_at"]),
+            models.Index(fields=["placed_at"]),
+        ]
 
 
 class Address(models.Model):
@@ -239,3 +642,103 @@ class OrderItem(models.Model):
     )
     quantity = models.PositiveSmallIntegerField()
     unit_price = models.DecimalField(max_digits=6, decimal_places=2)
+
+
+class OutboxEvent(models.Model):
+    """
+    An OutboxEvent class for recording an event in the transaction that caused it.
+
+    Fields:
+        key (str): The field for the unique key of the event, so it is recorded once.
+        name (str): The field for the kind of event, e.g. order_created.
+        payload (dict): The field for the data the event is published with.
+        created_at (int): The field for noting the day and time the event happened.
+        dispatched_at (int): The field for noting when the event reached its receivers (null until then).
+    """
+
+    key = models.CharField(max_length=255, unique=True)
+    name = models.CharField(max_length=64)
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Indexed for the relay, which scans the undispatched events
+    dispatched_at = models.DateTimeField(null=True, db_index=True)
+
+
+class PurchaseHistoryManager(models.Manager):
+    """
+    A PurchaseHistoryManager for adding orders to a purchase history rollup.
+    """
+
+    def add(self, rows, unique):
+        """
+        Add quantity and spend to the rollup rows, creating missing ones, and
+        move last_purchased_at forward, with a single upsert statement.
+
+        Args:
+            rows (list): dicts with the unique fields, quantity, spend and
+                last_purchased_at
+            unique (list): names of the fields that identify a rollup row
+        """
+        if rows:
+            _upsert_adding(
+                self.model,
+                self.db,
+                rows,
+                unique=unique,
+                add=["quantity", "spend"],
+                latest=["last_purchased_at"],
+            )
+
+
+class CustomerProductHistory(models.Model):
+    """
+    A CustomerProductHistory class for the purchase history of a customer, one row per product bought.
+
+    Fields:
+        customer (int): The field for connecting many history rows to a customer.
+        product (int): The field for connecting many history rows to a product.
+        quantity (int): The field for the number of units bought over all orders.
+        spend (float): The field for the amount spent on the product over all orders.
+        last_purchased_at (int): The field for the date and time of the last order with the product.
+    """
+
+    customer = models.ForeignKey(
+        to=Customer, on_delete=models.CASCADE, related_name="product_history"
+    )
+    product = models.ForeignKey(to=Product, on_delete=models.CASCADE, related_name="+")
+    quantity = models.PositiveIntegerField()
+    spend = models.DecimalField(max_digits=12, decimal_places=2)
+    last_purchased_at = models.DateTimeField()
+
+    objects = PurchaseHistoryManager()
+
+    class Meta:
+        unique_together = [["customer", "product"]]
+
+
+class CustomerCollectionSpend(models.Model):
+    """
+    A CustomerCollectionSpend class for the purchase history of a customer, one row per collection bought from.
+
+    Fields:
+        customer (int): The field for connecting many spend rows to a customer.
+        collection (int): The field for connecting many spend rows to a collection.
+        quantity (int): The field for the number of units bought from the collection.
+        spend (float): The field for the amount spent on the collection over all orders.
+        last_purchased_at (int): The field for the date and time of the last order from the collection.
+    """
+
+    customer = models.ForeignKey(
+        to=Customer, on_delete=models.CASCADE, related_name="collection_spend"
+    )
+    collection = models.ForeignKey(
+        to=Collection, on_delete=models.CASCADE, related_name="+"
+    )
+    quantity = models.PositiveIntegerField()
+    spend = models.DecimalField(max_digits=12, decimal_places=2)
+    last_purchased_at = models.DateTimeField()
+
+    objects = PurchaseHistoryManager()
+
+    class Meta:
+        unique_together = [["customer", "collection"]]
@@ -0,0 +1,108 @@
+"""
+A module that publishes store events through a transactional outbox.
+
+Instead of calling the receivers of a signal such as order_created inside the
+transaction that creates the order, publish() records an OutboxEvent row in that
+same transaction. Once it commits, the relay_events Celery task sends the
+recorded events to their receivers in batches, so checkout does not wait for
+them and a rolled back order is never announced.
+
+Delivery is at-least-once: a relay that dies between sending a batch and
+marking it dispatched sends it again on the next run, and so does the
+scheduled relay_events run for an event that a receiver failed on or that was
+never queued because the broker was down. Receivers get the event_id keyword
+argument to recognize such repeats. Each event is sent in a savepoint, so the
+database writes of its receivers are kept or rolled back together with it.
+"""
+
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Order, OutboxEvent
+from .signals import order_created
+
+logger = logging.getLogger(__name__)
+
+ORDER_CREATED = "order_created"
+
+
+def publish(name, key, **payload):
+    """
+    Record an event in the current transaction and relay it once that commits.
+
+    Args:
+        name (str): the kind of event, e.g. ORDER_CREATED
+        key (str): identifies the event, publishing the same key twice is a no-op
+        payload: JSON serializable data of the event
+    """
+    from .tasks import delay_on_commit, relay_events
+
+    # INSERT IGNORE / ON CONFLICT DO NOTHING: a single statement either way
+    OutboxEvent.objects.bulk_create(
+        [OutboxEvent(key=f"{name}:{key}", name=name, payload=payload)],
+        ignore_conflicts=True,
+    )
+    # Unqueued, the event waits for the scheduled run
+    delay_on_commit(relay_events)
+
+
+def send_order_created(events):
+    orders = Order.objects.in_bulk([event.payload["order_id"] for event in events])
+    failed = []
+    for event in events:
+        order = orders.get(event.payload["order_id"])
+        if order is None:
+            continue
+        try:
+            with transaction.atomic():
+                order_created.send(sender=Order, order=order, event_id=event.id)
+        except Exception:
+            logger.exception("Sending event %s failed, it is sent again", event.id)
+            failed.append(event)
+    return failed
+
+
+# Each sender takes the events of its name and returns those it failed on
+SENDERS = {ORDER_CREATED: send_order_created}
+
+
+def relay_events(batch_size=100):
+    """
+    Send the undispatched events to their receivers, batch by batch.
+
+    Each batch is locked with SELECT ... FOR UPDATE SKIP LOCKED, so relays that
+    run at the same time share the work instead of sending an event twice.
+    Events that a receiver failed on stay undispatched for the next run.
+
+    Args:
+        batch_size (int): number of events sent per transaction
+
+    Returns:
+        int: number of events sent
+    """
+    relayed = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            events = list(
+                OutboxEvent.objects.filter(dispatched_at=None, id__gt=last_id)
+                .order_by("id")
+                .select_for_update(skip_locked=True)[:batch_size]
+            )
+            if not events:
+                return relayed
+            # Past the failed events too, they wait for the next run
+            last_id = events[-1].id
+
+            by_name = {}
+            for event in events:
+                by_name.setdefault(event.name, []).append(event)
+            failed = set()
+            for name, named_events in by_name.items():
+                failed.update(event.id for event in SENDERS[name](named_events))
+
+            sent = [event.id for event in events if event.id not in failed]
+            OutboxEvent.objects.filter(id__in=sent).update(dispatched_at=timezone.now())
+        relayed += len(sent)
@@ -1,5 +1,289 @@
-from rest_framework.pagination import PageNumberPagination
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 
 class ProductPagination(PageNumberPagination):
+    """
+    Page number pagination for the product catalog.
+
+    Passing ?count=false skips the COUNT(*) over the filtered queryset: one extra
+    row is fetched to find out whether there is a next page and "count" is left
+    out of the response.
+    """
+
+    page_size = 10
+    count_query_param = "count"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.with_count = request.query_params.get(self.count_query_param) != "false"
+        if self.with_count:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        try:
+            self.page_number = int(request.query_params.get(self.page_query_param, 1))
+        except ValueError:
+            self.page_number = 0
+        if self.page_number < 1:
+            raise NotFound(self.invalid_page_message)
+
+        offset = (self.page_number - 1) * self.page_size
+        results = list(queryset[offset : offset + self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        return results[: self.page_size]
+
+    def get_paginated_response(self, data):
+        if self.with_count:
+            return super().get_paginated_response(data)
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data),
+                ]
+            )
+        )
+
+    def get_next_link(self):
+        if self.with_count:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.page_query_param, self.page_number + 1)
+
+    def get_previous_link(self):
+        if self.with_count:
+            return super().get_previous_link()
+        if self.page_number == 1:
+            return None
+        url = self.request.build_absolute_uri()
+        if self.page_number == 2:
+            return remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.page_query_param, self.page_number - 1)
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination.
+
+    Instead of OFFSET n, each page is fetched with a WHERE clause on the values of
+    the last row seen, e.g. (unit_price, id) > (9.99, 42), so deep pages cost the
+    same as the first one and no COUNT(*) is ever run. The ordering comes from the
+    view's OrderingFilter (default: the model ordering) and id is always appended
+    as a tiebreaker so rows with equal sort values are never skipped or repeated.
+    """
+
     page_size = 10
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+    tiebreaker = "id"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = self.get_ordering(request, queryset, view)
+        values, reverse = self.decode_cursor(request)
+        if values is not None:
+            values = self.convert_values(queryset, values)
+
+        ordering = self.ordering
+        if reverse:
+            ordering = [self._invert(field) for field in ordering]
+        queryset = queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self._keyset_filter(ordering, values))
+
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+        if reverse:
+            results.reverse()
+
+        # Moving backwards means there is always a next page (the one we came
+        # from), and vice versa.
+        if reverse:
+            self.has_next = values is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = values is not None
+
+        self.first = results[0] if results else None
+        self.last = results[-1] if results else None
+        return results
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data),
+                ]
+            )
+        )
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True},
+                "previous": {"type": "string", "nullable": True},
+                "results": schema,
+            },
+        }
+
+    def get_next_link(self):
+        if not self.has_next or self.last is None:
+            return None
+        return self.encode_cursor(self.last, reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or self.first is None:
+            return None
+        return self.encode_cursor(self.first, reverse=True)
+
+    def get_ordering(self, request, queryset, view):
+        ordering = None
+        for backend in getattr(view, "filter_backends", []):
+            if issubclass(backend, OrderingFilter):
+                ordering = backend().get_ordering(request, queryset, view)
+                break
+        if not ordering:
+            ordering = queryset.query.order_by or queryset.model._meta.ordering
+
+        ordering = [field for field in ordering if field.lstrip("-") != self.tiebreaker]
+        return ordering + [self.tiebreaker]
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+
+        try:
+            cursor = json.loads(b64decode(encoded.encode("ascii")).decode("utf-8"))
+            values, reverse = cursor["v"], bool(cursor["r"])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return values, reverse
+
+    def convert_values(self, queryset, values):
+        """
+        Convert the decoded cursor values with the fields they are compared to,
+        so that a tampered cursor is a 404 instead of a database error.
+
+        Args:
+            queryset (QuerySet): the queryset being paginated
+            values (list): the decoded values, in the order of self.ordering
+
+        Returns:
+            list: the converted values
+        """
+        converted = []
+        for field, value in zip(self.ordering, values):
+            model_field = self._model_field(queryset, field.lstrip("-"))
+            try:
+                if model_field is not None:
+                    value = model_field.to_python(value)
+            except (ValidationError, TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+            if value is None or isinstance(value, (list, dict)):
+                raise NotFound(self.invalid_cursor_message)
+            converted.append(value)
+        return converted
+
+    def encode_cursor(self, instance, reverse):
+        values = [
+            self._field_value(instance, field.lstrip("-")) for field in self.ordering
+        ]
+        cursor = json.dumps({"v": values, "r": int(reverse)}, separators=(",", ":"))
+        encoded = b64encode(cursor.encode("utf-8")).decode("ascii")
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def _field_value(self, instance, field):
+        value = instance
+        for attr in field.split("__"):
+            value = getattr(value, attr)
+        if hasattr(value, "isoformat"):
+            return value.isoformat()
+        if isinstance(value, (int, str)):
+            return value
+        return str(value)
+
+    def _model_field(self, queryset, name):
+        annotation = queryset.query.annotations.get(name)
+        if annotation is not None:
+            return annotation.output_field
+        model_field = None
+        model = queryset.model
+        try:
+            for attr in name.split("__"):
+                model_field = model._meta.get_field(attr)
+                model = model_field.related_model
+        except (AttributeError, FieldDoesNotExist):
+            return None
+        return model_field
+
+    def _invert(self, field):
+        return field[1:] if field.startswith("-") else "-" + field
+
+    def _keyset_filter(self, ordering, values):
+        """
+        Build the row-value comparison (a, b, id) > (x, y, z) as
+        a > x OR (a = x AND b > y) OR (a = x AND b = y AND id > z),
+        honouring the direction of every field in the ordering.
+        """
+        condition = Q()
+        for i, field in enumerate(ordering):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            branch = Q(**{f"{name}__{lookup}": values[i]})
+            for previous, value in zip(ordering[:i], values[:i]):
+                branch &= Q(**{previous.lstrip("-"): value})
+            condition |= branch
+        return condition
+
+
+class ProductCursorPagination(KeysetPagination):
+    # The ordering comes from ?ordering=, see KeysetPagination.get_ordering()
+    pass
+
+
+class FixedCursorPagination(KeysetPagination):
+    """
+    Keyset pagination in a fixed ordering, newest first by default.
+
+    Every field of the ordering runs in the same direction, with id last, so a
+    page is a single range scan of an index on those fields.
+
+    Attributes:
+        ordering: the fields to order by, id included
+    """
+
+    ordering = ["-id"]
+
+    def get_ordering(self, request, queryset, view):
+        return list(self.ordering)
+
+
+class OrderCursorPagination(FixedCursorPagination):
+    # Backed by the (customer_id, placed_at) and placed_at indexes
+    ordering = ["-placed_at", "-id"]
+
+
+class ReviewCursorPagination(FixedCursorPagination):
+    # Backed by the (product_id, date) index
+    ordering = ["-date", "-id"]
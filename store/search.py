@@ -0,0 +1,165 @@
+"""
+A module that provides the inverted index used to search the product catalog.
+
+Every product is split into lowercase terms that are stored in ProductSearchTerm
+with a weight (title words count more than description words). A search then
+becomes indexed prefix lookups (term LIKE 'abc%') on that table instead of
+LIKE '%abc%' scans over the product title and description.
+"""
+
+import re
+
+from django.db import transaction
+from django.db.models import IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from rest_framework.filters import BaseFilterBackend
+
+from .models import Product, ProductSearchTerm
+
+TERM_RE = re.compile(r"\w+")
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 8
+TITLE_WEIGHT = 5
+DESCRIPTION_WEIGHT = 1
+
+
+def tokenize(text):
+    """
+    Split text into lowercase search terms.
+
+    Args:
+        text (str): the text to split, may be None
+
+    Returns:
+        list: the terms in the order they appear
+    """
+    if not text:
+        return []
+    return [
+        term[:MAX_TERM_LENGTH]
+        for term in TERM_RE.findall(text.lower())
+        if len(term) >= MIN_TERM_LENGTH
+    ]
+
+
+def build_terms(product):
+    """
+    Build the unsaved ProductSearchTerm rows of a product.
+
+    Args:
+        product (Product): instance of product
+
+    Returns:
+        list: ProductSearchTerm instances, one per distinct term
+    """
+    weights = {}
+    for term in tokenize(product.title):
+        weights[term] = weights.get(term, 0) + TITLE_WEIGHT
+    for term in tokenize(product.description):
+        weights[term] = weights.get(term, 0) + DESCRIPTION_WEIGHT
+
+    return [
+        ProductSearchTerm(product_id=product.id, term=term, weight=min(weight, 32767))
+        for term, weight in weights.items()
+    ]
+
+
+def index_product(product):
+    """
+    Replace the indexed terms of a single product.
+
+    Args:
+        product (Product): instance of product
+    """
+    with transaction.atomic():
+        ProductSearchTerm.objects.filter(product_id=product.id).delete()
+        ProductSearchTerm.objects.bulk_create(build_terms(product))
+
+
+def rebuild_index(queryset=None, batch_size=500):
+    """
+    Rebuild the index for many products, batch by batch.
+
+    Args:
+        queryset (QuerySet): products to index, all products by default
+        batch_size (int): number of products handled per transaction
+
+    Returns:
+        int: number of products indexed
+    """
+    if queryset is None:
+        queryset = Product.objects.all()
+    queryset = queryset.only("id", "title", "description").order_by("id")
+
+    indexed = 0
+    last_id = 0
+    while True:
+        products = list(queryset.filter(id__gt=last_id)[:batch_size])
+        if not products:
+            return indexed
+
+        ids = [product.id for product in products]
+        terms = [term for product in products for term in build_terms(product)]
+        with transaction.atomic():
+            ProductSearchTerm.objects.filter(product_id__in=ids).delete()
+            ProductSearchTerm.objects.bulk_create(terms, batch_size=1000)
+
+        indexed += len(products)
+        last_id = ids[-1]
+
+
+class ProductSearchFilter(BaseFilterBackend):
+    """
+    A filter backend that searches products through the inverted index.
+
+    Every word of ?search= must prefix-match a term of the product, and the
+    results are ranked by the summed weight of the matching terms unless the
+    client asks for another ordering. The annotation is exposed as search_rank.
+    """
+
+    search_param = "search"
+
+    def get_search_terms(self, request):
+        return tokenize(request.query_params.get(self.search_param, ""))[
+            :MAX_QUERY_TERMS
+        ]
+
+    def filter_queryset(self, request, queryset, view):
+        return self.search(queryset, self.get_search_terms(request))
+
+    def search(self, queryset, terms):
+        """
+        Restrict and rank a product queryset by search terms.
+
+        Args:
+            queryset (QuerySet): products to search
+            terms (list): terms as returned by tokenize()
+
+        Returns:
+            QuerySet: matching products ordered by relevance
+        """
+        if not terms:
+            return queryset
+
+        # Terms are stored lowercase, so istartswith matches the same rows. On
+        # MySQL it compiles to a plain LIKE, which can range scan the term
+        # index, while startswith compiles to LIKE BINARY, which can not.
+        any_term = Q()
+        for term in terms:
+            queryset = queryset.filter(
+                id__in=ProductSearchTerm.objects.filter(term__istartswith=term).values(
+                    "product_id"
+                )
+            )
+            any_term |= Q(term__istartswith=term)
+
+        rank = (
+            ProductSearchTerm.objects.filter(any_term, product_id=OuterRef("pk"))
+            .values("product_id")
+            .annotate(rank=Sum("weight"))
+            .values("rank")
+        )
+        return queryset.annotate(
+            search_rank=Coalesce(Subquery(rank, output_field=IntegerField()), Value(0))
+        ).order_by("-search_rank", "id")
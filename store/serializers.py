@@ -1,21 +1,77 @@
 from decimal import Decimal
-from django.db import transaction
+from django.db import IntegrityError, connection, transaction
 from rest_framework import serializers
+from rest_framework.exceptions import NotFound
 
-from .signals import order_created
+from .caching import invalidate_inventories
+from .carts import RedisCartStore, redis_carts_enabled
+from .images import SIZES
+from .outbox import ORDER_CREATED, publish
 from .models import (
     Cart,
     CartItem,
     Customer,
+    CustomerCollectionSpend,
+    CustomerProductHistory,
     Order,
     OrderItem,
+    OutOfStock,
     Product,
+    ProductRating,
     Collection,
     ProductImage,
     Review,
 )
 
 
+def sparse_fields(request, fields):
+    """
+    Pick the fields a GET request asked for with ?fields= or ?omit=.
+
+    Both take comma separated field names; unknown names are ignored.
+
+    Args:
+        request (Request): instance of request obj, may be None
+        fields (list): every field the serializer can render
+
+    Returns:
+        list: the fields to render, in their original order
+    """
+    if request is None or request.method != "GET":
+        return list(fields)
+
+    params = request.query_params
+    if params.get("fields"):
+        wanted = set(params["fields"].split(","))
+        fields = [field for field in fields if field in wanted]
+    if params.get("omit"):
+        unwanted = set(params["omit"].split(","))
+        fields = [field for field in fields if field not in unwanted]
+    return list(fields)
+
+
+class SparseFieldsMixin:
+    """
+    A serializer mixin that only renders the fields selected by sparse_fields().
+
+    Attributes:
+        sparse_dependencies: field -> another field rendered along with it,
+            which the view needs and strips again
+    """
+
+    sparse_dependencies = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        wanted = set(sparse_fields(self.context.get("request"), self.fields))
+        for field, needed in self.sparse_dependencies.items():
+            if field in wanted:
+                wanted.add(needed)
+        for field in list(self.fields):
+            if field not in wanted:
+                self.fields.pop(field)
+
+
 class CollectionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Collection
@@ -25,17 +81,30 @@ class CollectionSerializer(serializers.ModelSerializer):
 
 
 class ProductImageSerializer(serializers.ModelSerializer):
+    variants = serializers.SerializerMethodField()
+
     class Meta:
         model = ProductImage
-        fields = ["id", "image"]
+        fields = ["id", "image", "variants"]
+
+    def get_variants(self, product_image: ProductImage):
+        # Size -> URL, the original stands in until the derivatives exist
+        request = self.context.get("request")
+        urls = {}
+        for size in SIZES:
+            url = product_image.variant_url(size)
+            urls[size] = request.build_absolute_uri(url) if request else url
+        return urls
 
     def create(self, validated_data):
         product_id = self.context["product_id"]
         return ProductImage.objects.create(product_id=product_id, **validated_data)
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     product_images = ProductImageSerializer(many=True, read_only=True)
+    # The inventory is filled in by id, see ProductViewSet.fill_volatile()
+    sparse_dependencies = {"inventory": "id"}
 
     class Meta:
         model = Product
@@ -48,16 +117,49 @@ class ProductSerializer(serializers.ModelSerializer):
             "unit_price",
             "price_with_tax",
             "collection",
+            "rating",
             "product_images",
         ]
 
     price_with_tax = serializers.SerializerMethodField(
         method_name="calculate_price_with_tax"
     )
+    rating = serializers.SerializerMethodField()
 
     def calculate_price_with_tax(self, product: Product):
         return product.unit_price * Decimal(1.1)
 
+    def get_rating(self, product: Product):
+        # Read from the ProductRating row, never from the reviews
+        try:
+            rating = product.rating
+        except ProductRating.DoesNotExist:
+            rating = ProductRating(product=product)
+        return {
+            "count": rating.count,
+            "average": rating.average,
+            "histogram": rating.histogram,
+        }
+
+
+MAX_BULK_IDS = 250
+
+
+class ProductIdsSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=MAX_BULK_IDS,
+    )
+
+
+class PriceBucketsSerializer(serializers.Serializer):
+    bounds = serializers.ListField(
+        child=serializers.DecimalField(max_digits=6, decimal_places=2, min_value=0),
+        allow_empty=False,
+        max_length=20,
+    )
+
 
 class SimpleProductSerializer(serializers.ModelSerializer):
     class Meta:
@@ -68,7 +170,7 @@ class SimpleProductSerializer(serializers.ModelSerializer):
 class ReviewSerializer(serializers.ModelSerializer):
     class Meta:
         model = Review
-        fields = ["id", "date", "name", "description"]
+        fields = ["id", "date", "name", "description", "rating"]
 
     def create(self, validated_data):
         product_id = self.context["product_id"]
@@ -82,6 +184,9 @@ class CartItemSerializer(serializers.ModelSerializer):
     )
 
     def get_total_price(self, cart_item: CartItem):
+        # Annotated by CartItem.objects.with_totals()
+        if hasattr(cart_item, "total_price"):
+            return cart_item.total_price
         return cart_item.product.unit_price * cart_item.quantity
 
     class Meta:
@@ -89,9 +194,63 @@ class CartItemSerializer(serializers.ModelSerializer):
         fields = ["id", "product", "quantity", "total_price"]
 
 
+def add_cart_items(cart_id, quantities):
+    """
+    Add quantities to the items of a cart, letting the foreign keys check that
+    the cart and the products exist instead of querying for them first.
+
+    Args:
+        cart_id (UUID): id of the cart
+        quantities (dict): quantity to add by product id
+
+    Raises:
+        NotFound: the cart does not exist
+        ValidationError: a product does not exist
+    """
+    try:
+        # Its own transaction (or savepoint), so a failed upsert leaves the
+        # surrounding one usable; SQLite only checks the keys on commit
+        with transaction.atomic():
+            CartItem.objects.add_quantities(cart_id, quantities)
+    except IntegrityError:
+        # Only on failure: find out which key did not hold
+        if not Cart.objects.filter(pk=cart_id).exists():
+            raise NotFound("Cart not found.")
+        missing = set(quantities) - set(
+            Product.objects.filter(pk__in=quantities).values_list("id", flat=True)
+        )
+        if not missing:
+            raise
+        raise serializers.ValidationError(
+            {
+                "product_id": [
+                    f"Products with ID {', '.join(map(str, sorted(missing)))} "
+                    "do not exist."
+                ]
+            }
+        )
+
+
 class AddCartItemSerializer(serializers.ModelSerializer):
     product_id = serializers.IntegerField()
 
+    class Meta:
+        model = CartItem
+        fields = ["id", "product_id", "quantity"]
+
+    def save(self, **kwargs):
+        cart_id = self.context["cart_id"]
+        product_id = self.validated_data["product_id"]
+        quantity = self._validated_data["quantity"]
+        add_cart_items(cart_id, {product_id: quantity})
+        self.instance = CartItem.objects.get(cart_id=cart_id, product_id=product_id)
+
+        return self.instance
+
+
+class RedisAddCartItemSerializer(AddCartItemSerializer):
+    # Redis carts only reach the database in persist_carts, so there is no
+    # foreign key to refuse a product that does not exist
     def validate_product_id(self, value):
         if not Product.objects.filter(pk=value).exists():
             raise serializers.ValidationError(
@@ -99,25 +258,51 @@ class AddCartItemSerializer(serializers.ModelSerializer):
             )
         return value
 
-    class Meta:
-        model = CartItem
-        fields = ["id", "product_id", "quantity"]
+
+class CartItemQuantitySerializer(serializers.Serializer):
+    product_id = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=1, max_value=32767)
+
+
+class BulkAddCartItemSerializer(serializers.Serializer):
+    max_items = 100
+
+    items = CartItemQuantitySerializer(many=True, allow_empty=False)
+
+    def validate_items(self, items):
+        if len(items) > self.max_items:
+            raise serializers.ValidationError(
+                f"No more than {self.max_items} items can be added at once."
+            )
+
+        # One query for every product id instead of one per item
+        product_ids = {item["product_id"] for item in items}
+        missing = product_ids - set(
+            Product.objects.filter(pk__in=product_ids).values_list("id", flat=True)
+        )
+        if missing:
+            raise serializers.ValidationError(
+                f"Products with ID {', '.join(map(str, sorted(missing)))} do not exist."
+            )
+        return items
+
+    def get_quantities(self):
+        # The same product may be listed more than once
+        quantities = {}
+        for item in self.validated_data["items"]:
+            product_id = item["product_id"]
+            quantities[product_id] = quantities.get(product_id, 0) + item["quantity"]
+        return quantities
 
     def save(self, **kwargs):
         cart_id = self.context["cart_id"]
-        product_id = self.validated_data["product_id"]
-        quantity = self._validated_data["quantity"]
-        try:
-            cart_item = CartItem.objects.get(cart_id=cart_id, product_id=product_id)
-            cart_item.quantity += quantity
-            cart_item.save()
-            self.instance = cart_item
-        except CartItem.DoesNotExist:
-            self.instance = CartItem.objects.create(
-                cart_id=cart_id, **self.validated_data
+        quantities = self.get_quantities()
+        add_cart_items(cart_id, quantities)
+        return list(
+            CartItem.objects.select_related("product").filter(
+                cart_id=cart_id, product_id__in=quantities
             )
-
-        return self.instance
+        )
 
 
 class UpdateCartItemSerializer(serializers.ModelSerializer):
@@ -134,6 +319,9 @@ class CartSerializer(serializers.ModelSerializer):
     )
 
     def get_total_price(self, cart: Cart):
+        # Annotated by Cart.objects.with_totals()
+        if hasattr(cart, "total_price"):
+            return cart.total_price
         return sum(item.quantity * item.product.unit_price for item in cart.items.all())
 
     class Meta:
@@ -141,6 +329,18 @@ class CartSerializer(serializers.ModelSerializer):
         fields = ["id", "items", "total_price"]
 
 
+class CartSummarySerializer(serializers.ModelSerializer):
+    item_count = serializers.IntegerField(read_only=True)
+    total_quantity = serializers.IntegerField(read_only=True)
+    total_price = serializers.DecimalField(
+        max_digits=12, decimal_places=2, read_only=True
+    )
+
+    class Meta:
+        model = Cart
+        fields = ["id", "item_count", "total_quantity", "total_price"]
+
+
 class CustomerSerializer(serializers.ModelSerializer):
     user_id = serializers.IntegerField(read_only=True)
 
@@ -149,6 +349,45 @@ class CustomerSerializer(serializers.ModelSerializer):
         fields = ["id", "user_id", "birth_date", "phone", "membership"]
 
 
+class CustomerProductHistorySerializer(serializers.ModelSerializer):
+    product = SimpleProductSerializer()
+
+    class Meta:
+        model = CustomerProductHistory
+        fields = ["product", "quantity", "spend", "last_purchased_at"]
+
+
+class CustomerCollectionSpendSerializer(serializers.ModelSerializer):
+    collection = serializers.SerializerMethodField()
+
+    class Meta:
+        model = CustomerCollectionSpend
+        fields = ["collection", "quantity", "spend", "last_purchased_at"]
+
+    def get_collection(self, spend: CustomerCollectionSpend):
+        return {"id": spend.collection_id, "title": spend.collection.title}
+
+
+class CustomerHistorySerializer(serializers.ModelSerializer):
+    products = CustomerProductHistorySerializer(many=True, source="product_history")
+    collections = CustomerCollectionSpendSerializer(
+        many=True, source="collection_spend"
+    )
+    total_spend = serializers.SerializerMethodField()
+    last_purchased_at = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Customer
+        fields = ["id", "total_spend", "last_purchased_at", "collections", "products"]
+
+    def get_total_spend(self, customer: Customer):
+        return sum((row.spend for row in customer.collection_spend.all()), Decimal(0))
+
+    def get_last_purchased_at(self, customer: Customer):
+        dates = [row.last_purchased_at for row in customer.collection_spend.all()]
+        return max(dates) if dates else None
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
     product = SimpleProductSerializer()
 
@@ -167,10 +406,25 @@ class OrderSerializer(serializers.ModelSerializer):
             "customer_id",
             "placed_at",
             "payment_status",
+            "total",
+            "item_count",
             "order_items",
         ]
 
 
+class OrderSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Order
+        fields = [
+            "id",
+            "customer_id",
+            "placed_at",
+            "payment_status",
+            "total",
+            "item_count",
+        ]
+
+
 class UpdateOrderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
@@ -182,25 +436,40 @@ class CreateOrderSerializer(serializers.Serializer):
 
     # To create a custom validate_field_name...There must be a field to customized a validation
     def validate_cart_id(self, cart_id):
-        if not Cart.objects.filter(pk=cart_id).exists():
-            raise serializers.ValidationError(
-                detail="No cart with the given ID was found."
-            )
-        if CartItem.objects.filter(cart_id=cart_id).count() == 0:
-            raise serializers.ValidationError(detail="The cart is empty")
-
+        if redis_carts_enabled():
+            # Check out what the customer sees, not the last write-behind
+            RedisCartStore().persist(cart_id)
         return cart_id
 
-    def save(self, **kwargs):
-        with transaction.atomic():
-            customer = Customer.objects.get(user_id=self.context["user_id"])
+    def validate(self, attrs):
+        # The items are both the validation and what save() orders, so a
+        # checkout reads the cart exactly once
+        cart_items = list(
+            CartItem.objects.select_related("product").filter(cart_id=attrs["cart_id"])
+        )
+        if not cart_items:
+            # Only a failed checkout pays for telling the two errors apart
+            if not Cart.objects.filter(pk=attrs["cart_id"]).exists():
+                raise serializers.ValidationError(
+                    {"cart_id": ["No cart with the given ID was found."]}
+                )
+            raise serializers.ValidationError({"cart_id": ["The cart is empty"]})
 
-            order = Order.objects.create(customer=customer)
+        attrs["cart_items"] = cart_items
+        return attrs
 
-            # Get cart items of the created cart_id
-            cart_items = CartItem.objects.select_related("product").filter(
-                cart_id=self.validated_data["cart_id"]
+    def save(self, **kwargs):
+        cart_id = self.validated_data["cart_id"]
+        cart_items = self.validated_data["cart_items"]
+        with transaction.atomic():
+            order = Order.objects.create(
+                customer_id=self.context["customer_id"],
+                total=sum(
+                    item.quantity * item.product.unit_price for item in cart_items
+                ),
+                item_count=len(cart_items),
             )
+
             # Convert the cart items to order items using list comphren.
             order_items = [
                 OrderItem(
@@ -213,11 +482,46 @@ class CreateOrderSerializer(serializers.Serializer):
             ]
             # Save the order items using bulk create to save the list of order items at once
             OrderItem.objects.bulk_create(order_items)
-
-            # Delete the cart id after creating an order
-            Cart.objects.filter(pk=self.validated_data["cart_id"]).delete()
-
-            # self.__class__ -> magic method to get the class of the current instance. Difference between send and send_robust is that send_robust will not raise an exception if no receiver is connected to the signal. We can also pass optional arguments to the signal receiver like the order instance that is created.
-            order_created.send_robust(sender=self.__class__, order=order)
-
-            return order
+            if not connection.features.can_return_rows_from_bulk_insert:
+                # MySQL does not hand back the ids of bulk inserted rows
+                ids = dict(
+                    OrderItem.objects.filter(order=order).values_list(
+                        "product_id", "id"
+                    )
+                )
+                for order_item in order_items:
+                    order_item.id = ids[order_item.product_id]
+
+            # Reserve the inventory last, so the row locks of hot products are
+            # held for as little of the transaction as possible
+            try:
+                Product.objects.reserve_inventory(
+                    {item.product_id: item.quantity for item in cart_items}
+                )
+            except OutOfStock as error:
+                raise serializers.ValidationError(
+                    {
+                        "cart_id": [
+                            "Not enough inventory for products "
+                            f"{', '.join(str(id) for id in error.product_ids)}."
+                        ]
+                    },
+                    code="out_of_stock",
+                )
+            # update() sends no post_save to invalidate the cached inventory.
+            # It is not part of the cached responses, so those are kept.
+            invalidate_inventories([item.product_id for item in cart_items])
+
+            # Delete the cart id after creating an order (an unsaved instance
+            # skips selecting the cart before deleting it)
+            Cart(pk=cart_id).delete()
+            if redis_carts_enabled():
+                transaction.on_commit(lambda: RedisCartStore().delete(cart_id))
+
+            # The order_created receivers run after the commit, from the outbox
+            publish(ORDER_CREATED, order.id, order_id=order.id)
+
+        # Serializing the order reads its items from here instead of querying
+        # them and their products again
+        order._prefetched_objects_cache = {"order_items": order_items}
+        return order
@@ -1,8 +1,41 @@
 from django.dispatch import receiver
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_init,
+    post_save,
+    pre_save,
+)
 
-from ..models import Customer
+from ..caching import (
+    COLLECTIONS,
+    PRODUCTS,
+    bump_versions,
+    invalidate_cart_summary,
+    invalidate_inventories,
+    product_namespace,
+    review_namespace,
+)
+from . import order_created
+from ..customers import forget_customer_id
+from ..history import record_order
+from ..images import delete_unreferenced
+from ..models import (
+    Cart,
+    CartItem,
+    Collection,
+    Customer,
+    ImageBlob,
+    Product,
+    ProductImage,
+    ProductRating,
+    Promotion,
+    Review,
+)
+from ..search import index_product
 
 
 # Signal handler
@@ -16,3 +49,187 @@ def create_customer_from_new_user(sender, **kwargs):
     #  5 - Others: any other keyword arguments passed to the save() method
     if kwargs["created"]:
         Customer.objects.create(user=kwargs["instance"])
+
+
+@receiver(order_created)
+def record_purchase_history(sender, order, **kwargs):
+    # The outbox relay sends order_created in the transaction that marks the
+    # event dispatched, so a redelivered event never adds an order twice. A
+    # failure here rolls back the savepoint of the event, which is then sent
+    # again instead of leaving half of the order recorded.
+    record_order(order)
+
+
+@receiver(post_delete, sender=Customer)
+def forget_deleted_customer_id(sender, instance, **kwargs):
+    forget_customer_id(instance.user_id)
+
+
+@receiver(post_init, sender=Product)
+def remember_product_collection(sender, instance, **kwargs):
+    # Read from __dict__ so that a deferred collection_id is not loaded here
+    instance._loaded_collection_id = instance.__dict__.get("collection_id")
+
+
+@receiver(post_save, sender=Product)
+def update_collection_products_count(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    # When collection_id was deferred on load the previous collection is unknown;
+    # the reconcile_products_count command repairs any resulting drift.
+    previous = instance._loaded_collection_id
+    if created:
+        _change_products_count(instance.collection_id, 1)
+    elif previous is not None and previous != instance.collection_id:
+        _change_products_count(previous, -1)
+        _change_products_count(instance.collection_id, 1)
+    instance._loaded_collection_id = instance.collection_id
+
+
+@receiver(post_delete, sender=Product)
+def decrement_collection_products_count(sender, instance, **kwargs):
+    _change_products_count(instance.collection_id, -1)
+
+
+def _change_products_count(collection_id, delta):
+    collections = Collection.objects.filter(pk=collection_id)
+    if delta < 0:
+        collections = collections.filter(products_count__gte=-delta)
+    collections.update(products_count=F("products_count") + delta)
+
+
+@receiver(post_save, sender=Product)
+def index_product_for_search(sender, **kwargs):
+    # Deleted products need no handler: their search terms go with them through
+    # the ON DELETE CASCADE of ProductSearchTerm.product.
+    if not kwargs["raw"]:
+        index_product(kwargs["instance"])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_responses(sender, instance, **kwargs):
+    # Collections are invalidated too because they embed products_count.
+    bump_versions(PRODUCTS, COLLECTIONS)
+    invalidate_inventories([instance.pk])
+
+
+@receiver(post_init, sender=ProductImage)
+def remember_image_name(sender, instance, **kwargs):
+    # The raw name when loaded from a row, before the descriptor wraps it
+    image = instance.__dict__.get("image")
+    instance._loaded_image = getattr(image, "name", image) or None
+
+
+@receiver(pre_save, sender=ProductImage)
+def remember_image_upload(sender, instance, **kwargs):
+    # A file that is not committed yet is stored by this save, and the storage
+    # counts its reference itself (see store.storage)
+    instance._image_counted = bool(instance.image) and not instance.image._committed
+
+
+@receiver(post_save, sender=ProductImage)
+def count_image_references(sender, instance, created, raw=False, **kwargs):
+    from ..tasks import delay_on_commit, generate_image_variants
+
+    # A new instance may have been built from a File, whose name is not stored
+    previous = None if created else instance._loaded_image
+    current = instance.image.name or None
+    instance._loaded_image = current
+    if previous == current and instance._image_counted:
+        # The same content again, which the row already held a reference to
+        ImageBlob.objects.release(current)
+    if raw or previous == current:
+        return
+    if current is not None:
+        if not instance._image_counted:
+            ImageBlob.objects.acquire(current)
+        # The worker must see the row and the stored file. Until it ran, the
+        # original is served in place of the variants.
+        delay_on_commit(generate_image_variants, instance.id)
+    if previous is not None:
+        release_image(previous)
+
+
+@receiver(post_delete, sender=ProductImage)
+def remove_image_reference(sender, instance, **kwargs):
+    if instance._loaded_image is not None:
+        release_image(instance._loaded_image)
+
+
+def release_image(name):
+    ImageBlob.objects.release(name)
+    transaction.on_commit(lambda: delete_unreferenced(name))
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=Promotion)
+@receiver(post_delete, sender=Promotion)
+@receiver(m2m_changed, sender=Product.promotions.through)
+def invalidate_product_details(sender, **kwargs):
+    bump_versions(PRODUCTS)
+
+
+@receiver(post_save, sender=Collection)
+@receiver(post_delete, sender=Collection)
+def invalidate_collection_responses(sender, **kwargs):
+    bump_versions(COLLECTIONS)
+
+
+@receiver(post_init, sender=Review)
+def remember_review_rating(sender, instance, **kwargs):
+    instance._loaded_rating = (
+        instance.__dict__.get("product_id"),
+        instance.__dict__.get("rating"),
+    )
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_review_responses(sender, instance, **kwargs):
+    # The product embeds its rating aggregates. Product lists pick them up
+    # within the TTL rather than being thrown away for every review. Connected
+    # before update_product_rating(), which forgets the previous product.
+    product_ids = {instance.product_id, instance._loaded_rating[0]} - {None}
+    bump_versions(
+        *[review_namespace(product_id) for product_id in product_ids],
+        *[product_namespace(product_id) for product_id in product_ids],
+    )
+
+
+@receiver(post_save, sender=Review)
+def update_product_rating(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    previous = instance._loaded_rating
+    current = (instance.product_id, instance.rating)
+    if not created and previous != current and previous[1] is not None:
+        ProductRating.objects.remove_rating(*previous)
+    if (created or previous != current) and instance.rating is not None:
+        ProductRating.objects.add_rating(*current)
+    instance._loaded_rating = current
+
+
+@receiver(post_delete, sender=Review)
+def remove_product_rating(sender, instance, **kwargs):
+    if instance.rating is not None:
+        ProductRating.objects.remove_rating(instance.product_id, instance.rating)
+
+
+@receiver(post_save, sender=CartItem)
+@receiver(post_delete, sender=CartItem)
+def invalidate_cart_item_summary(sender, instance, **kwargs):
+    invalidate_cart_summary(instance.cart_id)
+
+
+@receiver(post_save, sender=CartItem)
+def touch_cart(sender, instance, raw=False, **kwargs):
+    # Not on post_delete: purging a cart would then update it once per item
+    if not raw:
+        Cart.objects.touch(instance.cart_id)
+
+
+@receiver(post_delete, sender=Cart)
+def invalidate_deleted_cart_summary(sender, instance, **kwargs):
+    invalidate_cart_summary(instance.id)
@@ -0,0 +1,112 @@
+"""
+A module that stores product images by the digest of their content.
+
+ContentAddressedStorage hashes a file while it streams it to a temporary file,
+then moves it to <upload_to>/<first two hex digits>/<sha256><extension>. The
+same content always ends up under the same name, so an image uploaded for many
+products is kept on disk once; ImageBlob counts the ProductImage rows that
+refer to each name and the file is deleted with the last of them. The storage
+takes the reference of a saved file itself, before the file is placed, so a
+concurrent deletion of the same name can not remove it from under the upload.
+Names never change content, which also lets derivatives and HTTP caches be
+keyed by them.
+"""
+
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+
+DIGEST_NAME_RE = re.compile(r"(^|/)(?P<prefix>[0-9a-f]{2})/(?P=prefix)[0-9a-f]{62}\.")
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    A FileSystemStorage that names every saved file after the digest of its
+    content. save() returns that name and counts a reference to it in
+    ImageBlob; storing content that exists already does not add a file.
+
+    Functions:
+        digest_name, is_digest_name, save_derivative
+    """
+
+    hash_algorithm = "sha256"
+
+    def get_available_name(self, name, max_length=None):
+        # _save() replaces the name anyway, and the same name means the same
+        # content, so there is nothing to make unique
+        return name
+
+    def digest_name(self, name, digest):
+        directory, filename = posixpath.split(name)
+        extension = posixpath.splitext(filename)[1].lower()
+        return posixpath.join(directory, digest[:2], f"{digest}{extension}")
+
+    def is_digest_name(self, name):
+        return DIGEST_NAME_RE.search(name) is not None
+
+    def _save(self, name, content):
+        from .models import ImageBlob
+
+        digest = hashlib.new(self.hash_algorithm)
+        temp_path = self._write(posixpath.dirname(name), content, digest)
+        name = self.digest_name(name, digest.hexdigest())
+        try:
+            # Counted before the file is placed: a delete_unreferenced() that
+            # holds the blob row makes this wait until it removed the old file,
+            # one that comes later finds the reference
+            ImageBlob.objects.acquire(name)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self._place(temp_path, name)
+        return name
+
+    def save_derivative(self, name, content):
+        """
+        Store a file derived from a stored one under the exact name given.
+
+        Derivatives are named after their source (see store.images), not
+        after their own content, so they are not hashed.
+
+        Args:
+            name (str): storage name of the derivative
+            content (File): the content
+
+        Returns:
+            str: the name
+        """
+        self._place(self._write(posixpath.dirname(name), content), name)
+        return name
+
+    def _write(self, directory, content, digest=None):
+        # Streamed to a temporary file in the target directory, so the final
+        # os.replace() never crosses file systems
+        directory = self.path(directory)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".upload")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for chunk in content.chunks():
+                    if digest is not None:
+                        digest.update(chunk)
+                    file.write(chunk)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return temp_path
+
+    def _place(self, temp_path, name):
+        path = self.path(name)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(temp_path, self.file_permissions_mode or 0o644)
+            # Atomic, and rewriting an existing name writes the same bytes: a
+            # blob deleted concurrently with a new upload of it comes back
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
@@ -0,0 +1,74 @@
+from datetime import timedelta
+import logging
+
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+
+from . import outbox
+from .caching import bump_versions, product_namespace
+from .carts import RedisCartStore, purge_carts, redis_carts_enabled
+
+logger = logging.getLogger(__name__)
+
+
+def delay_on_commit(task, *args):
+    """
+    Queue a task once the surrounding transaction commits.
+
+    The transaction is committed by then, so a broker that can not be reached
+    is logged rather than raised: failing the request would only make the
+    client retry something that already happened.
+
+    Args:
+        task (Task): the Celery task
+        args: arguments of the task
+    """
+
+    def delay():
+        try:
+            task.delay(*args)
+        except Exception:
+            logger.exception("Could not queue %s%r", task.name, args)
+
+    transaction.on_commit(delay)
+
+
+@shared_task
+def persist_carts():
+    # Write behind the carts changed in Redis since the last run
+    if not redis_carts_enabled():
+        return 0
+    return RedisCartStore().persist_dirty()
+
+
+@shared_task
+def purge_abandoned_carts():
+    purged = purge_carts(timedelta(days=settings.STORE_ABANDONED_CART_DAYS))
+    logger.info(
+        "Purged %(carts)s abandoned carts (%(items)s items) in %(seconds)ss", purged
+    )
+    return purged
+
+
+@shared_task
+def relay_events():
+    # Queued after every commit that published events, and on a schedule for
+    # whatever an earlier run could not send
+    return outbox.relay_events()
+
+
+@shared_task
+def generate_image_variants(product_image_id):
+    from .images import generate_variants
+    from .models import ProductImage
+
+    product_image = ProductImage.objects.filter(pk=product_image_id).first()
+    if product_image is None:
+        # Deleted before the worker got to it
+        return None
+    variants = generate_variants(product_image)
+    # The cached detail response still points at the original, lists pick the
+    # variants up within the TTL
+    bump_versions(product_namespace(product_image.product_id))
+    return variants
@@ -1,4 +1,5 @@
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from rest_framework.test import APIClient
 import pytest
 
@@ -14,3 +15,9 @@ def authenticate(api_client):
         return api_client.force_authenticate(user=User(is_staff=is_staff))
 
     return do_authenticate
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # Cached responses and their versions must not leak between tests
+    cache.clear()
@@ -0,0 +1,453 @@
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from django.core.management import call_command
+from django.utils import timezone
+from model_bakery import baker
+from rest_framework import status
+from rest_framework.test import APIRequestFactory
+import pytest
+
+from store import idempotency
+from store.caching import cart_summary_key
+from store.carts import RedisCartStore, purge_carts
+from store.models import Cart, CartItem, Order, Product
+from store.serializers import CreateOrderSerializer
+from store.tasks import persist_carts
+from store.views import RedisCartItemViewSet, RedisCartViewSet
+
+
+@pytest.fixture
+def redis_carts(settings):
+    settings.STORE_CART_BACKEND = "redis"
+
+
+@pytest.fixture
+def cart_view():
+    # The cart viewsets are picked when the URLconf loads, so the Redis ones
+    # are called directly here.
+    factory = APIRequestFactory()
+
+    def do_cart_view(viewset, actions, method, data=None, **kwargs):
+        request = getattr(factory, method)("/", data, format="json")
+        return viewset.as_view(actions)(request, **kwargs)
+
+    return do_cart_view
+
+
+@pytest.mark.django_db
+class TestRedisCarts:
+    def test_if_items_are_added_returns_summed_quantity_and_total(
+        self, redis_carts, cart_view, django_assert_num_queries
+    ):
+        product = baker.make(Product, unit_price=Decimal("2.50"))
+        cart_id = cart_view(RedisCartViewSet, {"post": "create"}, "post").data["id"]
+        add_item = {"product_id": product.id, "quantity": 2}
+        cart_view(
+            RedisCartItemViewSet, {"post": "create"}, "post", add_item, cart_pk=cart_id
+        )
+        added = cart_view(
+            RedisCartItemViewSet, {"post": "create"}, "post", add_item, cart_pk=cart_id
+        )
+
+        # Only the products are read from the database
+        with django_assert_num_queries(1):
+            cart = cart_view(RedisCartViewSet, {"get": "retrieve"}, "get", pk=cart_id)
+
+        assert added.data["quantity"] == 4
+        assert cart.data["items"][0]["quantity"] == 4
+        assert cart.data["total_price"] == Decimal("10.00")
+        assert not Cart.objects.filter(pk=cart_id).exists()
+
+    def test_if_product_does_not_exist_returns_400(self, redis_carts, cart_view):
+        cart_id = cart_view(RedisCartViewSet, {"post": "create"}, "post").data["id"]
+
+        response = cart_view(
+            RedisCartItemViewSet,
+            {"post": "create"},
+            "post",
+            {"product_id": 999999, "quantity": 1},
+            cart_pk=cart_id,
+        )
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert RedisCartStore().items(cart_id) == {}
+
+    def test_if_carts_are_persisted_tables_match_redis(self, redis_carts):
+        kept, removed = baker.make(Product, _quantity=2)
+        store = RedisCartStore()
+        cart_id = store.create()
+        store.add(cart_id, kept.id, 3)
+        store.add(cart_id, removed.id, 1)
+        persist_carts()
+
+        store.remove(cart_id, removed.id)
+        store.set(cart_id, kept.id, 5)
+        persist_carts()
+
+        assert list(
+            CartItem.objects.filter(cart_id=cart_id).values_list(
+                "product_id", "quantity"
+            )
+        ) == [(kept.id, 5)]
+
+    def test_if_items_are_added_in_bulk_returns_new_quantities(
+        self, redis_carts, cart_view
+    ):
+        product = baker.make(Product)
+        store = RedisCartStore()
+        cart_id = store.create()
+        store.add(cart_id, product.id, 1)
+
+        response = cart_view(
+            RedisCartItemViewSet,
+            {"post": "bulk"},
+            "post",
+            {"items": [{"product_id": product.id, "quantity": 4}]},
+            cart_pk=cart_id,
+        )
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data[0]["quantity"] == 5
+
+    def test_if_cart_does_not_exist_returns_404(self, redis_carts, cart_view):
+        response = cart_view(
+            RedisCartItemViewSet,
+            {"get": "list"},
+            "get",
+            cart_pk="3f0c6a2e-1b7e-4a8e-9a57-0d1f4c2b9e11",
+        )
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    def test_if_checking_out_orders_what_is_in_redis(self, redis_carts):
+        product = baker.make(Product, inventory=10)
+        user = baker.make(get_user_model())
+        store = RedisCartStore()
+        cart_id = store.create()
+        store.add(cart_id, product.id, 2)
+
+        serializer = CreateOrderSerializer(
+            data={"cart_id": cart_id}, context={"customer_id": user.customer.id}
+        )
+        serializer.is_valid(raise_exception=True)
+        order = serializer.save()
+
+        assert Order.objects.get(pk=order.id).order_items.get().quantity == 2
+        assert not Cart.objects.filter(pk=cart_id).exists()
+
+
+@pytest.fixture
+def cart():
+    return Cart.objects.create()
+
+
+@pytest.mark.django_db
+class TestAddCartItems:
+    def test_if_product_is_added_twice_returns_summed_quantity(self, api_client, cart):
+        product = baker.make(Product)
+        url = f"/api/v1/store/carts/{cart.id}/items/"
+
+        api_client.post(url, {"product_id": product.id, "quantity": 2})
+        response = api_client.post(url, {"product_id": product.id, "quantity": 3})
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert response.data["quantity"] == 5
+        assert CartItem.objects.get(cart=cart, product=product).quantity == 5
+
+    def test_if_items_are_added_in_bulk_returns_200(
+        self, api_client, cart, django_assert_num_queries
+    ):
+        first, second = baker.make(Product, _quantity=2)
+        CartItem.objects.create(cart=cart, product=first, quantity=1)
+
+        # Product validation, the upsert, touching the cart and reading the
+        # items back, plus the savepoint around the upsert that only exists
+        # because the test runs inside a transaction
+        with django_assert_num_queries(6):
+            response = api_client.post(
+                f"/api/v1/store/carts/{cart.id}/items/bulk/",
+                {
+                    "items": [
+                        {"product_id": first.id, "quantity": 2},
+                        {"product_id": second.id, "quantity": 1},
+                        {"product_id": second.id, "quantity": 1},
+                    ]
+                },
+                format="json",
+            )
+
+        assert response.status_code == status.HTTP_200_OK
+        quantities = dict(
+            CartItem.objects.filter(cart=cart).values_list("product_id", "quantity")
+        )
+        assert quantities == {first.id: 3, second.id: 2}
+
+    def test_if_a_product_does_not_exist_returns_400(self, api_client, cart):
+        product = baker.make(Product)
+
+        response = api_client.post(
+            f"/api/v1/store/carts/{cart.id}/items/bulk/",
+            {
+                "items": [
+                    {"product_id": product.id, "quantity": 1},
+                    {"product_id": 999999, "quantity": 1},
+                ]
+            },
+            format="json",
+        )
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert not CartItem.objects.filter(cart=cart).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+class TestAddCartItemsForeignKeys:
+    # Not inside a test transaction: SQLite checks the foreign keys on commit
+    def test_if_cart_does_not_exist_bulk_returns_404(self, api_client):
+        product = baker.make(Product)
+
+        response = api_client.post(
+            "/api/v1/store/carts/00000000-0000-0000-0000-000000000000/items/bulk/",
+            {"items": [{"product_id": product.id, "quantity": 1}]},
+            format="json",
+        )
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+        assert not CartItem.objects.exists()
+
+    def test_if_product_does_not_exist_returns_400(self, api_client):
+        cart = baker.make(Cart)
+
+        response = api_client.post(
+            f"/api/v1/store/carts/{cart.id}/items/",
+            {"product_id": 999999, "quantity": 1},
+        )
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "999999" in response.data["product_id"][0]
+        assert not CartItem.objects.exists()
+
+
+@pytest.mark.django_db
+class TestCartTotals:
+    def test_if_cart_is_retrieved_returns_totals_in_two_queries(
+        self, api_client, cart, django_assert_num_queries
+    ):
+        first = baker.make(Product, unit_price=Decimal("1.50"))
+        second = baker.make(Product, unit_price=Decimal("4.00"))
+        CartItem.objects.create(cart=cart, product=first, quantity=2)
+        CartItem.objects.create(cart=cart, product=second, quantity=1)
+
+        with django_assert_num_queries(2):
+            response = api_client.get(f"/api/v1/store/carts/{cart.id}/")
+
+        assert response.data["total_price"] == Decimal("7.00")
+        totals = {
+            item["product"]["id"]: item["total_price"]
+            for item in response.data["items"]
+        }
+        assert totals == {first.id: Decimal("3.00"), second.id: Decimal("4.00")}
+
+    def test_if_summary_is_cached_until_items_change(
+        self, api_client, cart, django_assert_num_queries
+    ):
+        product = baker.make(Product, unit_price=Decimal("2.00"))
+        url = f"/api/v1/store/carts/{cart.id}/summary/"
+        api_client.post(
+            f"/api/v1/store/carts/{cart.id}/items/",
+            {"product_id": product.id, "quantity": 1},
+        )
+        api_client.get(url)
+
+        with django_assert_num_queries(0):
+            cached = api_client.get(url)
+        api_client.post(
+            f"/api/v1/store/carts/{cart.id}/items/",
+            {"product_id": product.id, "quantity": 2},
+        )
+        updated = api_client.get(url)
+
+        assert cached.data["total_price"] == Decimal("2.00")
+        assert updated.data["item_count"] == 1
+        assert updated.data["total_quantity"] == 3
+        assert updated.data["total_price"] == Decimal("6.00")
+
+    def test_if_cart_does_not_exist_summary_returns_404(self, api_client):
+        response = api_client.get(
+            "/api/v1/store/carts/3f0c6a2e-1b7e-4a8e-9a57-0d1f4c2b9e11/summary/"
+        )
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+class TestPurgeCarts:
+    def test_if_cart_is_abandoned_deletes_it_with_its_items(self):
+        old = baker.make(Cart)
+        baker.make(CartItem, cart=old, quantity=1, _quantity=3)
+        Cart.objects.filter(pk=old.id).update(
+            touched_at=timezone.now() - timedelta(days=40)
+        )
+        fresh = baker.make(Cart)
+
+        purged = purge_carts(timedelta(days=30), chunk_size=2)
+
+        assert purged["carts"] == 1
+        assert purged["items"] == 3
+        assert list(Cart.objects.values_list("id", flat=True)) == [fresh.id]
+
+    def test_if_cart_is_purged_drops_its_summary_after_commit(
+        self, api_client, django_capture_on_commit_callbacks
+    ):
+        cart = baker.make(Cart)
+        url = f"/api/v1/store/carts/{cart.id}/summary/"
+        api_client.get(url)
+        Cart.objects.filter(pk=cart.id).update(
+            touched_at=timezone.now() - timedelta(days=40)
+        )
+
+        with django_capture_on_commit_callbacks(execute=True) as callbacks:
+            purge_carts(timedelta(days=30))
+
+        assert len(callbacks) == 1
+        assert cache.get(cart_summary_key(cart.id)) is None
+        assert api_client.get(url).status_code == status.HTTP_404_NOT_FOUND
+
+    def test_if_item_is_added_cart_is_kept(self, api_client):
+        cart = baker.make(Cart, touched_at=timezone.now() - timedelta(days=40))
+        product = baker.make(Product)
+
+        api_client.post(
+            f"/api/v1/store/carts/{cart.id}/items/",
+            {"product_id": product.id, "quantity": 1},
+        )
+        purge_carts(timedelta(days=30))
+
+        assert Cart.objects.filter(pk=cart.id).exists()
+
+    def test_if_purged_in_chunks_deletes_every_abandoned_cart(self):
+        baker.make(Cart, touched_at=timezone.now() - timedelta(days=40), _quantity=5)
+        out = StringIO()
+
+        call_command("purge_carts", "--days=30", "--chunk-size=2", stdout=out)
+
+        assert not Cart.objects.exists()
+        assert out.getvalue().startswith("Purged 5 carts (0 items)")
+
+
+@pytest.mark.django_db
+class TestIdempotentCartItems:
+    def test_if_add_is_retried_with_same_key_adds_once(
+        self, api_client, cart, django_assert_num_queries
+    ):
+        product = baker.make(Product)
+        url = f"/api/v1/store/carts/{cart.id}/items/"
+        data = {"product_id": product.id, "quantity": 2}
+        first = api_client.post(url, data, HTTP_IDEMPOTENCY_KEY="add-1")
+
+        with django_assert_num_queries(0):
+            retry = api_client.post(url, data, HTTP_IDEMPOTENCY_KEY="add-1")
+
+        assert retry.status_code == first.status_code == status.HTTP_201_CREATED
+        assert retry.data == first.data
+        assert retry["Idempotent-Replayed"] == "true"
+        assert CartItem.objects.get().quantity == 2
+
+    def test_if_key_is_reused_for_other_payload_returns_422(self, api_client, cart):
+        product = baker.make(Product)
+        url = f"/api/v1/store/carts/{cart.id}/items/"
+        api_client.post(
+            url, {"product_id": product.id, "quantity": 1}, HTTP_IDEMPOTENCY_KEY="k"
+        )
+
+        response = api_client.post(
+            url, {"product_id": product.id, "quantity": 5}, HTTP_IDEMPOTENCY_KEY="k"
+        )
+
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    def test_if_first_request_failed_retry_runs_again(self, api_client, cart):
+        product = baker.make(Product)
+        url = f"/api/v1/store/carts/{cart.id}/items/"
+        api_client.post(
+            url, {"product_id": product.id, "quantity": 0}, HTTP_IDEMPOTENCY_KEY="k"
+        )
+
+        response = api_client.post(
+            url, {"product_id": product.id, "quantity": 0}, HTTP_IDEMPOTENCY_KEY="k"
+        )
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "Idempotent-Replayed" not in response
+
+    def test_if_key_is_in_progress_waits_then_returns_409(
+        self, api_client, cart, monkeypatch
+    ):
+        monkeypatch.setattr(idempotency, "LOCK_WAIT", 0.2)
+        monkeypatch.setattr(idempotency, "_scope", lambda request, key: key)
+        product = baker.make(Product)
+        url = f"/api/v1/store/carts/{cart.id}/items/"
+        # Another request with the key holds the lock
+        client = get_redis_connection("default")
+        client.set(idempotency.LOCK_KEY.format("k"), "other", ex=10)
+
+        response = api_client.post(
+            url, {"product_id": product.id, "quantity": 1}, HTTP_IDEMPOTENCY_KEY="k"
+        )
+
+        assert response.status_code == status.HTTP_409_CONFLICT
+        assert not CartItem.objects.exists()
+        assert client.get(idempotency.LOCK_KEY.format("k")) == b"other"
+
+    def test_if_key_finishes_while_waiting_replays_its_response(
+        self, api_client, cart, monkeypatch
+    ):
+        monkeypatch.setattr(idempotency, "_scope", lambda request, key: key)
+        product = baker.make(Product)
+        url = f"/api/v1/store/carts/{cart.id}/items/"
+        data = {"product_id": product.id, "quantity": 1}
+        api_client.post(url, data, HTTP_IDEMPOTENCY_KEY="k")
+        # Back to while the first request was still running
+        result_key = idempotency.RESULT_KEY.format("k")
+        result = cache.get(result_key)
+        cache.delete(result_key)
+        lock_key = idempotency.LOCK_KEY.format("k")
+        get_redis_connection("default").set(lock_key, "first", ex=10)
+
+        def finish_first(seconds):
+            cache.set(result_key, result)
+
+        monkeypatch.setattr(idempotency, "sleep", finish_first)
+
+        retry = api_client.post(url, data, HTTP_IDEMPOTENCY_KEY="k")
+
+        assert retry.status_code == status.HTTP_201_CREATED
+        assert retry["Idempotent-Replayed"] == "true"
+        assert CartItem.objects.get().quantity == 1
+
+    def test_if_lock_was_taken_over_keeps_it(self, api_client, cart, monkeypatch):
+        monkeypatch.setattr(idempotency, "_scope", lambda request, key: key)
+        client = get_redis_connection("default")
+        lock_key = idempotency.LOCK_KEY.format("k")
+        add_quantities = CartItem.objects.add_quantities
+
+        def outlive_the_lock(*args, **kwargs):
+            # The lock expired and a retry took it while this one was running
+            client.set(lock_key, "retry", ex=10)
+            return add_quantities(*args, **kwargs)
+
+        monkeypatch.setattr(CartItem.objects, "add_quantities", outlive_the_lock)
+        product = baker.make(Product)
+
+        response = api_client.post(
+            f"/api/v1/store/carts/{cart.id}/items/",
+            {"product_id": product.id, "quantity": 1},
+            HTTP_IDEMPOTENCY_KEY="k",
+        )
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert client.get(lock_key) == b"retry"
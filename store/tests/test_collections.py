@@ -1,8 +1,10 @@
+from io import StringIO
+from django.core.management import call_command
 from model_bakery import baker
 from rest_framework import status
 import pytest
 
-from store.models import Collection
+from store.models import Collection, Product
 
 
 @pytest.fixture
@@ -162,3 +164,38 @@ class TestDeleteCollection:
         response = delete_collection(collection.id)
 
         assert response.status_code == status.HTTP_204_NO_CONTENT
+
+
+@pytest.mark.django_db
+class TestCollectionProductsCount:
+    def test_if_products_are_added_and_moved_count_follows(self, api_client):
+        clothing, shoes = baker.make(Collection, _quantity=2)
+        product = baker.make(Product, collection=clothing)
+        baker.make(Product, collection=clothing)
+
+        product.collection = shoes
+        product.save()
+
+        clothing.refresh_from_db()
+        shoes.refresh_from_db()
+        assert clothing.products_count == 1
+        assert shoes.products_count == 1
+
+    def test_if_product_is_deleted_count_decreases(self, api_client):
+        collection = baker.make(Collection)
+        product = baker.make(Product, collection=collection)
+
+        product.delete()
+
+        response = api_client.get(f"/api/v1/store/collections/{collection.id}/")
+        assert response.data["products_count"] == 0
+
+    def test_if_count_drifted_reconcile_repairs_it(self):
+        collection = baker.make(Collection)
+        baker.make(Product, collection=collection, _quantity=3)
+        Collection.objects.filter(pk=collection.id).update(products_count=7)
+
+        call_command("reconcile_products_count", stdout=StringIO())
+
+        collection.refresh_from_db()
+        assert collection.products_count == 3
@@ -0,0 +1,199 @@
+from decimal import Decimal
+from io import StringIO
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from model_bakery import baker
+from rest_framework import status
+from rest_framework_simplejwt.tokens import AccessToken
+import pytest
+
+from store.models import (
+    Cart,
+    CartItem,
+    Collection,
+    Customer,
+    CustomerProductHistory,
+    Order,
+    OutboxEvent,
+    Product,
+)
+from store import history
+from store.customers import CUSTOMER_ID_CLAIM
+from store.outbox import relay_events
+from store.signals import handlers
+from store.serializers import CreateOrderSerializer
+
+
+@pytest.fixture
+def user(db):
+    return get_user_model().objects.create_user(username="ann", password="s3cret!pw")
+
+
+@pytest.fixture
+def access_token(api_client, user):
+    response = api_client.post(
+        "/auth/jwt/create/", {"username": "ann", "password": "s3cret!pw"}
+    )
+    return response.data["access"]
+
+
+@pytest.mark.django_db
+class TestCustomerIdClaim:
+    def test_if_token_has_customer_id_skips_customer_lookup(
+        self, api_client, user, access_token, django_assert_num_queries
+    ):
+        api_client.credentials(HTTP_AUTHORIZATION=f"JWT {access_token}")
+
+        # The user loaded by JWTAuthentication and the page of orders, whose
+        # (empty) items are not prefetched
+        with django_assert_num_queries(2):
+            response = api_client.get("/api/v1/store/orders/")
+
+        assert response.status_code == status.HTTP_200_OK
+
+    def test_if_token_is_refreshed_keeps_customer_id(self, api_client, user):
+        tokens = api_client.post(
+            "/auth/jwt/create/", {"username": "ann", "password": "s3cret!pw"}
+        ).data
+        access = api_client.post(
+            "/auth/jwt/refresh/", {"refresh": tokens["refresh"]}
+        ).data["access"]
+        api_client.credentials(HTTP_AUTHORIZATION=f"JWT {access}")
+
+        response = api_client.get("/api/v1/store/customer/me/")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data["id"] == Customer.objects.get(user=user).id
+
+    def test_if_user_has_no_customer_logs_in_without_claim(self, api_client, user):
+        Customer.objects.filter(user=user).delete()
+
+        response = api_client.post(
+            "/auth/jwt/create/", {"username": "ann", "password": "s3cret!pw"}
+        )
+
+        assert response.status_code == status.HTTP_200_OK
+        token = AccessToken(response.data["access"])
+        assert CUSTOMER_ID_CLAIM not in token
+
+    def test_if_token_has_no_claim_caches_lookup(
+        self, api_client, user, django_assert_num_queries
+    ):
+        api_client.force_authenticate(user=user)
+        api_client.get("/api/v1/store/orders/")
+
+        # Only the page of orders
+        with django_assert_num_queries(1):
+            response = api_client.get("/api/v1/store/orders/")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert not Order.objects.exists()
+
+
+@pytest.fixture
+def place_order():
+    def do_place_order(customer, *items):
+        cart = Cart.objects.create()
+        for product, quantity in items:
+            CartItem.objects.create(cart=cart, product=product, quantity=quantity)
+        serializer = CreateOrderSerializer(
+            data={"cart_id": cart.id}, context={"customer_id": customer.id}
+        )
+        serializer.is_valid(raise_exception=True)
+        return serializer.save()
+
+    return do_place_order
+
+
+@pytest.fixture
+def get_history(api_client):
+    staff = get_user_model().objects.create_superuser("staff", "s@shop.com", "pw")
+    api_client.force_authenticate(user=staff)
+
+    def do_get_history(customer):
+        return api_client.get(f"/api/v1/store/customer/{customer.id}/history/")
+
+    return do_get_history
+
+
+@pytest.mark.django_db
+class TestCustomerHistory:
+    def test_if_orders_are_relayed_returns_rolled_up_history(
+        self, user, place_order, get_history, django_assert_max_num_queries
+    ):
+        books, toys = baker.make(Collection, _quantity=2)
+        novel = baker.make(
+            Product, collection=books, unit_price=Decimal("10.00"), inventory=10
+        )
+        atlas = baker.make(
+            Product, collection=books, unit_price=Decimal("5.00"), inventory=10
+        )
+        kite = baker.make(
+            Product, collection=toys, unit_price=Decimal("3.00"), inventory=10
+        )
+        place_order(user.customer, (novel, 1), (kite, 2))
+        last = place_order(user.customer, (novel, 2), (atlas, 1))
+        relay_events()
+
+        # The permission check, the customer and the two rollups
+        with django_assert_max_num_queries(5):
+            response = get_history(user.customer)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data["total_spend"] == Decimal("41.00")
+        assert response.data["last_purchased_at"] == last.placed_at
+        spend = {
+            row["collection"]["id"]: row["spend"]
+            for row in response.data["collections"]
+        }
+        assert spend == {books.id: Decimal("35.00"), toys.id: Decimal("6.00")}
+        bought = {
+            row["product"]["id"]: row["quantity"] for row in response.data["products"]
+        }
+        assert bought == {novel.id: 3, atlas.id: 1, kite.id: 2}
+
+    def test_if_history_is_rebuilt_matches_incremental_history(self, user, place_order):
+        product = baker.make(Product, unit_price=Decimal("2.50"), inventory=10)
+        place_order(user.customer, (product, 2))
+        place_order(user.customer, (product, 1))
+        relay_events()
+        incremental = list(CustomerProductHistory.objects.values())
+
+        call_command("rebuild_purchase_history", stdout=StringIO())
+
+        rebuilt = list(CustomerProductHistory.objects.values())
+        for row in incremental + rebuilt:
+            del row["id"]
+        assert rebuilt == incremental
+        assert rebuilt[0]["quantity"] == 3
+        assert rebuilt[0]["spend"] == Decimal("7.50")
+
+    def test_if_recording_fails_order_is_recorded_once_on_retry(
+        self, user, place_order, monkeypatch
+    ):
+        calls = []
+
+        def record_then_fail_once(order):
+            calls.append(order.id)
+            history.record_order(order)
+            if len(calls) == 1:
+                raise RuntimeError("Lost the connection")
+
+        monkeypatch.setattr(handlers, "record_order", record_then_fail_once)
+        product = baker.make(Product, unit_price=Decimal("2.50"), inventory=10)
+        place_order(user.customer, (product, 2))
+
+        assert relay_events() == 0
+        assert not CustomerProductHistory.objects.exists()
+        assert relay_events() == 1
+
+        assert len(calls) == 2
+        assert CustomerProductHistory.objects.get().quantity == 2
+        assert not OutboxEvent.objects.filter(dispatched_at=None).exists()
+
+    def test_if_user_lacks_permission_returns_403(self, api_client, user):
+        api_client.force_authenticate(user=user)
+
+        response = api_client.get(f"/api/v1/store/customer/{user.customer.id}/history/")
+
+        assert response.status_code == status.HTTP_403_FORBIDDEN
@@ -0,0 +1,337 @@
+from io import BytesIO, StringIO
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from kombu.exceptions import OperationalError
+from model_bakery import baker
+from PIL import Image
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+import pytest
+
+from store import tasks
+from store.images import delete_unreferenced
+from store.models import ImageBlob, Product, ProductImage
+from store.uploads import NOT_IMAGE, TOO_LARGE, ImageUploadHandler, get_rejected_counts
+
+
+@pytest.fixture(autouse=True)
+def media_root(settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    return tmp_path
+
+
+def make_upload(name="shoe.jpg", size=(800, 400), format="JPEG"):
+    content = BytesIO()
+    Image.new("RGB", size, "red").save(content, format)
+    return SimpleUploadedFile(name, content.getvalue(), content_type="image/jpeg")
+
+
+@pytest.fixture
+def upload_image(api_client, django_capture_on_commit_callbacks):
+    def do_upload_image(product, upload=None):
+        with django_capture_on_commit_callbacks(execute=True):
+            return api_client.post(
+                f"/api/v1/store/products/{product.id}/images/",
+                {"image": upload or make_upload()},
+                format="multipart",
+            )
+
+    return do_upload_image
+
+
+@pytest.mark.django_db
+class TestImageVariants:
+    def test_if_image_is_uploaded_generates_webp_variants(
+        self, upload_image, media_root
+    ):
+        product = baker.make(Product)
+
+        response = upload_image(product)
+
+        assert response.status_code == status.HTTP_201_CREATED
+        product_image = ProductImage.objects.get()
+        assert set(product_image.variants) == {"small", "medium", "large"}
+        with Image.open(media_root / product_image.variants["small"]) as small:
+            assert small.format == "WEBP"
+            assert small.size == (150, 75)
+        # Never upscaled past the original
+        with Image.open(media_root / product_image.variants["large"]) as large:
+            assert large.size == (800, 400)
+
+    def test_if_product_is_retrieved_returns_variant_urls(
+        self, api_client, upload_image
+    ):
+        product = baker.make(Product)
+        upload_image(product)
+
+        response = api_client.get(f"/api/v1/store/products/{product.id}/")
+
+        image = response.data["product_images"][0]
+        stem = image["image"].rsplit(".", 1)[0]
+        assert image["variants"]["small"] == f"{stem}_small.webp"
+        assert image["variants"]["medium"] == f"{stem}_medium.webp"
+
+    def test_if_variants_are_generated_other_products_stay_cached(
+        self, api_client, upload_image, django_assert_num_queries
+    ):
+        product, other = baker.make(Product, _quantity=2)
+        upload_image(product)
+        url = f"/api/v1/store/products/{other.id}/"
+        api_client.get(url)
+
+        tasks.generate_image_variants(ProductImage.objects.get().id)
+
+        with django_assert_num_queries(0):
+            api_client.get(url)
+
+    def test_if_broker_is_down_keeps_upload_without_variants(
+        self, upload_image, monkeypatch
+    ):
+        def delay(product_image_id):
+            raise OperationalError("Connection refused")
+
+        monkeypatch.setattr(tasks.generate_image_variants, "delay", delay)
+
+        response = upload_image(baker.make(Product))
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert ProductImage.objects.get().variants == {}
+
+    def test_if_variants_are_missing_falls_back_to_original(self):
+        product_image = baker.make(ProductImage, image="store/images/shoe.jpg")
+
+        assert product_image.variant_url("small") == "/media/store/images/shoe.jpg"
+
+    def test_if_image_is_deleted_deletes_variants(
+        self, upload_image, media_root, django_capture_on_commit_callbacks
+    ):
+        product = baker.make(Product)
+        upload_image(product)
+        product_image = ProductImage.objects.get()
+
+        with django_capture_on_commit_callbacks(execute=True):
+            product_image.delete()
+
+        assert not (media_root / product_image.variants["small"]).exists()
+
+
+@pytest.mark.django_db
+class TestStreamingUploadValidation:
+    def test_if_upload_is_too_large_aborts_before_reading_it(self, upload_image):
+        product = baker.make(Product)
+        upload = SimpleUploadedFile("big.jpg", b"\xff\xd8\xff" + b"0" * 200 * 1024)
+
+        response = upload_image(product, upload)
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "50KB" in response.data["image"][0]
+        counts = get_rejected_counts()[TOO_LARGE]
+        assert counts["uploads"] == 1
+        assert counts["bytes"] > 200 * 1024
+        assert counts["read"] == 0
+        assert not ProductImage.objects.exists()
+
+    def test_if_stream_exceeds_limit_stops_at_the_limit(self):
+        handler = ImageUploadHandler()
+        handler.handle_raw_input(None, {}, 30 * 1024, b"boundary")
+        handler.new_file("image", "big.jpg", "image/jpeg", None)
+        chunk = b"\xff\xd8\xff" + b"0" * (handler.chunk_size - 3)
+
+        with pytest.raises(ValidationError):
+            for start in range(0, 100 * 1024, handler.chunk_size):
+                handler.receive_data_chunk(chunk, start)
+
+        assert handler.read <= 50 * 1024 + handler.chunk_size
+
+    def test_if_magic_bytes_are_not_an_image_returns_400(self, upload_image):
+        product = baker.make(Product)
+        upload = SimpleUploadedFile("fake.jpg", b"%PDF-1.4 " + b"0" * 1024)
+
+        response = upload_image(product, upload)
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert get_rejected_counts()[NOT_IMAGE]["uploads"] == 1
+        assert not ProductImage.objects.exists()
+
+    def test_if_image_is_valid_returns_201(self, upload_image):
+        product = baker.make(Product)
+
+        response = upload_image(product, make_upload(format="PNG", name="a.png"))
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert get_rejected_counts()[NOT_IMAGE]["uploads"] == 0
+
+
+@pytest.mark.django_db
+class TestContentAddressedImages:
+    def test_if_same_image_is_uploaded_twice_stores_it_once(
+        self, upload_image, media_root, django_capture_on_commit_callbacks
+    ):
+        first, second = baker.make(Product, _quantity=2)
+        upload = make_upload()
+        upload_image(first, upload)
+        upload.seek(0)
+        upload_image(second, SimpleUploadedFile("copy.jpg", upload.read()))
+
+        names = {image.image.name for image in ProductImage.objects.all()}
+        assert len(names) == 1
+        name = names.pop()
+        assert ImageBlob.objects.get(name=name).references == 2
+
+        with django_capture_on_commit_callbacks(execute=True):
+            ProductImage.objects.filter(product=first).get().delete()
+        assert (media_root / name).exists()
+
+        with django_capture_on_commit_callbacks(execute=True):
+            ProductImage.objects.get().delete()
+        assert not (media_root / name).exists()
+        assert not ImageBlob.objects.exists()
+
+    def test_if_upload_is_storing_a_blob_being_deleted_keeps_it(
+        self, upload_image, media_root, django_capture_on_commit_callbacks
+    ):
+        upload_image(baker.make(Product))
+        product_image = ProductImage.objects.get()
+        name = product_image.image.name
+        with django_capture_on_commit_callbacks():
+            product_image.delete()
+        storage = ProductImage._meta.get_field("image").storage
+
+        # Stored, but its row not saved yet, when the deletion runs
+        assert storage.save("store/images/again.jpg", make_upload()) == name
+        deleted = delete_unreferenced(name)
+
+        assert not deleted
+        assert (media_root / name).exists()
+        assert ImageBlob.objects.get(name=name).references == 1
+
+    def test_if_same_content_is_saved_again_counts_it_once(self, upload_image):
+        upload_image(baker.make(Product))
+        product_image = ProductImage.objects.get()
+
+        product_image.image = make_upload(name="again.jpg")
+        product_image.save()
+
+        assert ImageBlob.objects.get().references == 1
+
+    def test_if_some_files_are_unique_dedupe_images_counts_only_duplicates(
+        self, media_root, django_capture_on_commit_callbacks
+    ):
+        directory = media_root / "store" / "images"
+        directory.mkdir(parents=True)
+        duplicated = make_upload().read()
+        unique = make_upload(size=(10, 10)).read()
+        for name, content in (("a.jpg", duplicated), ("b.jpg", duplicated)):
+            (directory / name).write_bytes(content)
+        (directory / "c.jpg").write_bytes(unique)
+        for name in ("a.jpg", "b.jpg", "c.jpg"):
+            baker.make(ProductImage, image=f"store/images/{name}")
+        stdout = StringIO()
+
+        with django_capture_on_commit_callbacks(execute=True):
+            call_command("dedupe_images", stdout=stdout)
+
+        assert stdout.getvalue().strip() == (
+            "Moved 3 files to digest names, 1 were duplicates "
+            f"({len(duplicated)} bytes freed), 0 were missing"
+        )
+
+    def test_if_media_has_duplicates_dedupe_images_merges_them(
+        self, media_root, django_capture_on_commit_callbacks
+    ):
+        directory = media_root / "store" / "images"
+        directory.mkdir(parents=True)
+        content = make_upload().read()
+        for name in ("a.jpg", "b.jpg"):
+            (directory / name).write_bytes(content)
+        images = [
+            baker.make(ProductImage, image=f"store/images/{name}")
+            for name in ("a.jpg", "b.jpg")
+        ]
+
+        with django_capture_on_commit_callbacks(execute=True):
+            call_command("dedupe_images", stdout=StringIO())
+
+        names = {image.image.name for image in ProductImage.objects.all()}
+        assert len(names) == 1
+        name = names.pop()
+        assert (media_root / name).read_bytes() == content
+        assert not (directory / "a.jpg").exists()
+        assert not (directory / "b.jpg").exists()
+        assert list(ImageBlob.objects.values_list("name", "references")) == [(name, 2)]
+        images[0].refresh_from_db()
+        assert images[0].variants["small"] == name.replace(".jpg", "_small.webp")
+
+
+@pytest.mark.django_db
+class TestServeMedia:
+    @pytest.fixture
+    def image_url(self, upload_image):
+        upload_image(baker.make(Product))
+        return ProductImage.objects.get().image.url
+
+    def test_if_name_is_a_digest_returns_immutable_file(
+        self, api_client, image_url, media_root
+    ):
+        response = api_client.get(image_url)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response["Cache-Control"] == "public, max-age=31536000, immutable"
+        assert response["Content-Type"] == "image/jpeg"
+        name = ProductImage.objects.get().image.name
+        assert b"".join(response.streaming_content) == (media_root / name).read_bytes()
+
+    def test_if_range_is_requested_returns_206(self, api_client, image_url):
+        response = api_client.get(image_url, HTTP_RANGE="bytes=2-11")
+
+        assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+        assert response["Content-Length"] == "10"
+        assert response["Content-Range"].startswith("bytes 2-11/")
+        assert len(b"".join(response.streaming_content)) == 10
+
+    def test_if_range_is_past_the_end_returns_416(self, api_client, image_url):
+        response = api_client.get(image_url, HTTP_RANGE="bytes=99999999-")
+
+        assert response.status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+
+    def test_if_if_range_is_stale_returns_whole_file(self, api_client, image_url):
+        response = api_client.get(
+            image_url, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"stale"'
+        )
+
+        assert response.status_code == status.HTTP_200_OK
+
+    def test_if_etag_matches_returns_304(self, api_client, image_url):
+        etag = api_client.get(image_url)["ETag"]
+
+        response = api_client.get(image_url, HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert "immutable" in response["Cache-Control"]
+
+    def test_if_accel_redirect_is_set_hands_off_to_nginx(
+        self, api_client, image_url, settings
+    ):
+        settings.MEDIA_ACCEL_REDIRECT = "/protected-media/"
+
+        response = api_client.get(image_url)
+
+        name = ProductImage.objects.get().image.name
+        assert response["X-Accel-Redirect"] == f"/protected-media/{name}"
+        assert response.content == b""
+
+    def test_if_name_is_not_a_digest_returns_short_lived_file(
+        self, api_client, media_root
+    ):
+        (media_root / "legacy.jpg").write_bytes(b"\xff\xd8\xff")
+
+        response = api_client.get("/media/legacy.jpg")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response["Cache-Control"] == "public, max-age=3600"
+
+    def test_if_path_escapes_media_root_returns_404(self, api_client):
+        response = api_client.get("/media/../manage.py")
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
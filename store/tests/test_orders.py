@@ -0,0 +1,340 @@
+from decimal import Decimal
+from io import StringIO
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from kombu.exceptions import OperationalError
+from model_bakery import baker
+from rest_framework import status
+import pytest
+
+from store.models import (
+    Cart,
+    CartItem,
+    Customer,
+    Order,
+    OrderItem,
+    OutboxEvent,
+    Product,
+)
+from store import tasks
+from store.outbox import relay_events
+from store.signals import order_created
+
+
+@pytest.fixture
+def user(api_client):
+    user = baker.make(get_user_model())
+    api_client.force_authenticate(user=user)
+    return user
+
+
+@pytest.fixture
+def create_order(api_client, user):
+
+    def do_create_order(cart_id):
+        return api_client.post("/api/v1/store/orders/", {"cart_id": cart_id})
+
+    return do_create_order
+
+
+@pytest.fixture
+def cart_with(db):
+    def do_cart_with(*items):
+        cart = Cart.objects.create()
+        for product, quantity in items:
+            CartItem.objects.create(cart=cart, product=product, quantity=quantity)
+        return cart
+
+    return do_cart_with
+
+
+@pytest.fixture
+def received():
+    events = []
+
+    def receiver(sender, order, event_id, **kwargs):
+        events.append((order.id, event_id))
+
+    order_created.connect(receiver)
+    yield events
+    order_created.disconnect(receiver)
+
+
+@pytest.mark.django_db
+class TestCreateOrder:
+    def test_if_inventory_suffices_returns_200_and_reserves_it(
+        self, create_order, cart_with
+    ):
+        product = baker.make(Product, inventory=5)
+
+        response = create_order(cart_with((product, 3)).id)
+
+        assert response.status_code == status.HTTP_200_OK
+        last_update = product.last_update
+        product.refresh_from_db()
+        assert product.inventory == 2
+        # A purchase is not an edit of the product
+        assert product.last_update == last_update
+        order = Order.objects.get()
+        assert order.total == product.unit_price * 3
+        assert order.item_count == 1
+        assert response.data["total"] == order.total
+
+    def test_if_product_is_out_of_stock_returns_400_and_rolls_back(
+        self, create_order, cart_with
+    ):
+        available = baker.make(Product, inventory=5)
+        scarce = baker.make(Product, inventory=1)
+        cart = cart_with((available, 2), (scarce, 2))
+
+        response = create_order(cart.id)
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert str(scarce.id) in response.data["cart_id"][0]
+        assert not Order.objects.exists()
+        assert Cart.objects.filter(pk=cart.id).exists()
+        assert Product.objects.get(pk=available.id).inventory == 5
+
+    def test_if_inventory_changes_product_cache_is_invalidated(
+        self, api_client, create_order, cart_with
+    ):
+        product = baker.make(Product, inventory=5)
+        url = f"/api/v1/store/products/{product.id}/"
+        api_client.get(url)
+
+        create_order(cart_with((product, 5)).id)
+
+        assert api_client.get(url).data["inventory"] == 0
+
+    def test_if_order_is_created_keeps_cached_product_responses(
+        self, api_client, create_order, cart_with, django_assert_num_queries
+    ):
+        product = baker.make(Product, inventory=5)
+        url = f"/api/v1/store/products/{product.id}/"
+        etag = api_client.get(url)["ETag"]
+
+        create_order(cart_with((product, 2)).id)
+
+        # Only the inventory is read again
+        with django_assert_num_queries(1):
+            response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data["inventory"] == 3
+        assert response["ETag"] != etag
+
+    def test_if_order_is_retried_with_same_key_creates_one_order(
+        self, api_client, create_order, cart_with
+    ):
+        product = baker.make(Product, inventory=5)
+        cart = cart_with((product, 1))
+        data = {"cart_id": cart.id}
+        first = api_client.post("/api/v1/store/orders/", data, HTTP_IDEMPOTENCY_KEY="o")
+
+        retry = api_client.post("/api/v1/store/orders/", data, HTTP_IDEMPOTENCY_KEY="o")
+
+        assert retry.status_code == status.HTTP_200_OK
+        assert retry.data == first.data
+        assert Order.objects.count() == 1
+
+    def test_if_cart_is_empty_returns_400(self, create_order, cart_with):
+        response = create_order(cart_with().id)
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.data["cart_id"] == ["The cart is empty"]
+
+    def test_if_cart_does_not_exist_returns_400(self, create_order):
+        response = create_order("3f0c6a2e-1b7e-4a8e-9a57-0d1f4c2b9e11")
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.data["cart_id"] == ["No cart with the given ID was found."]
+
+    @pytest.mark.parametrize("products", [1, 5])
+    def test_if_order_is_created_stays_within_query_budget(
+        self, create_order, cart_with, django_assert_num_queries, products
+    ):
+        items = [
+            (product, 2)
+            for product in baker.make(Product, inventory=10, _quantity=products)
+        ]
+        cart = cart_with(*items)
+
+        # The cart items with their products, the customer id, the order, its
+        # items, the inventory, the cart (selecting and deleting its items,
+        # then itself), the outbox event and the savepoint around it all, plus
+        # the savepoint around the inventory, whatever the cart holds
+        with django_assert_num_queries(13):
+            response = create_order(cart.id)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert [
+            (item["product"]["id"], item["quantity"])
+            for item in response.data["order_items"]
+        ] == [(product.id, 2) for product, _ in items]
+        assert all(item["id"] for item in response.data["order_items"])
+
+
+@pytest.mark.django_db
+class TestOrderCreatedOutbox:
+    def test_if_order_is_created_receivers_run_after_commit(
+        self, create_order, cart_with, received, django_capture_on_commit_callbacks
+    ):
+        product = baker.make(Product, inventory=5)
+
+        with django_capture_on_commit_callbacks(execute=True):
+            response = create_order(cart_with((product, 1)).id)
+            assert received == []
+
+        event = OutboxEvent.objects.get()
+        assert received == [(response.data["id"], event.id)]
+        assert event.dispatched_at is not None
+
+    def test_if_events_were_relayed_does_not_send_them_again(
+        self, create_order, cart_with, received
+    ):
+        for product in baker.make(Product, inventory=5, _quantity=3):
+            create_order(cart_with((product, 1)).id)
+
+        relayed = relay_events(batch_size=2)
+        relay_events()
+
+        assert relayed == 3
+        assert len(received) == 3
+
+    def test_if_broker_is_down_order_is_created_and_relayed_later(
+        self,
+        create_order,
+        cart_with,
+        received,
+        monkeypatch,
+        django_capture_on_commit_callbacks,
+    ):
+        def delay():
+            raise OperationalError("Connection refused")
+
+        monkeypatch.setattr(tasks.relay_events, "delay", delay)
+        product = baker.make(Product, inventory=5)
+
+        with django_capture_on_commit_callbacks(execute=True):
+            response = create_order(cart_with((product, 1)).id)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert received == []
+        assert relay_events() == 1
+        assert received == [(response.data["id"], OutboxEvent.objects.get().id)]
+
+    def test_if_receiver_fails_event_is_sent_again(
+        self, create_order, cart_with, received
+    ):
+        calls = []
+
+        def fail_once(sender, order, **kwargs):
+            calls.append(order.id)
+            if len(calls) == 1:
+                raise RuntimeError("Receiver down")
+
+        order_created.connect(fail_once)
+        try:
+            product = baker.make(Product, inventory=5)
+            create_order(cart_with((product, 1)).id)
+
+            assert relay_events() == 0
+            assert OutboxEvent.objects.get().dispatched_at is None
+            assert relay_events() == 1
+        finally:
+            order_created.disconnect(fail_once)
+
+        assert len(calls) == 2
+        assert OutboxEvent.objects.get().dispatched_at is not None
+
+    def test_if_order_is_rolled_back_no_event_is_recorded(
+        self, create_order, cart_with, received
+    ):
+        product = baker.make(Product, inventory=0)
+
+        create_order(cart_with((product, 1)).id)
+        relay_events()
+
+        assert not OutboxEvent.objects.exists()
+        assert received == []
+
+
+@pytest.fixture
+def place_orders():
+    def do_place_orders(customer, count, items=2):
+        orders = baker.make(Order, customer=customer, _quantity=count)
+        for order in orders:
+            baker.make(
+                OrderItem,
+                order=order,
+                quantity=2,
+                unit_price=Decimal("1.50"),
+                _quantity=items,
+            )
+        Order.objects.refresh_totals([order.id for order in orders])
+        return orders
+
+    return do_place_orders
+
+
+@pytest.mark.django_db
+class TestListOrders:
+    def test_if_customer_lists_orders_returns_only_theirs_newest_first(
+        self, api_client, user, place_orders, django_assert_num_queries
+    ):
+        orders = place_orders(Customer.objects.get(user=user), 3)
+        place_orders(baker.make(get_user_model()).customer, 2)
+
+        # The customer, the page of orders and their items with the products,
+        # however many orders and items there are
+        with django_assert_num_queries(3):
+            response = api_client.get("/api/v1/store/orders/")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert [order["id"] for order in response.data["results"]] == [
+            order.id for order in reversed(orders)
+        ]
+        assert len(response.data["results"][0]["order_items"]) == 2
+
+    def test_if_staff_pages_through_orders_sees_each_once(
+        self, api_client, authenticate, place_orders
+    ):
+        authenticate(is_staff=True)
+        orders = place_orders(baker.make(get_user_model()).customer, 15, items=1)
+
+        response = api_client.get("/api/v1/store/orders/")
+        seen = [order["id"] for order in response.data["results"]]
+        while response.data["next"]:
+            response = api_client.get(response.data["next"])
+            seen += [order["id"] for order in response.data["results"]]
+
+        assert seen == [order.id for order in reversed(orders)]
+
+    def test_if_summary_is_requested_returns_totals_without_items(
+        self, api_client, user, place_orders, django_assert_num_queries
+    ):
+        place_orders(Customer.objects.get(user=user), 2)
+
+        with django_assert_num_queries(2):
+            response = api_client.get("/api/v1/store/orders/", {"summary": "true"})
+
+        order = response.data["results"][0]
+        assert "order_items" not in order
+        assert order["total"] == Decimal("6.00")
+        assert order["item_count"] == 2
+
+
+@pytest.mark.django_db
+class TestBackfillOrderTotals:
+    def test_if_totals_are_missing_fills_them_in_chunks(self):
+        customer = baker.make(get_user_model()).customer
+        orders = baker.make(Order, customer=customer, _quantity=3)
+        for order in orders[:2]:
+            baker.make(OrderItem, order=order, quantity=3, unit_price=Decimal("2.00"))
+        out = StringIO()
+
+        call_command("backfill_order_totals", "--chunk-size=2", stdout=out)
+
+        totals = list(Order.objects.order_by("id").values_list("total", "item_count"))
+        assert totals == [(Decimal("6.00"), 1), (Decimal("6.00"), 1), (0, 0)]
+        assert out.getvalue() == "Backfilled 3 orders\n"
@@ -1 +1,411 @@
 # TODO: Write all tests for Product endpoints
+from base64 import b64encode
+from decimal import Decimal
+import json
+from django.core.cache import cache
+from model_bakery import baker
+from rest_framework import status
+import pytest
+
+from store.models import Collection, Product, Review
+
+
+@pytest.fixture
+def list_products(api_client):
+    def do_list_products(params=None, url="/api/v1/store/products/", **headers):
+        return api_client.get(url, params, **headers)
+
+    return do_list_products
+
+
+@pytest.mark.django_db
+class TestListProducts:
+    def test_if_count_is_disabled_returns_200_without_count(self, list_products):
+        baker.make(Product, _quantity=12)
+
+        response = list_products({"count": "false"})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert "count" not in response.data
+        assert len(response.data["results"]) == 10
+        assert response.data["next"] is not None
+        assert response.data["previous"] is None
+
+    def test_if_cursor_pagination_walks_all_products_once(self, list_products):
+        collection = baker.make(Collection)
+        # Equal prices force the id tiebreaker to do the work.
+        baker.make(
+            Product, collection=collection, unit_price=Decimal("5.00"), _quantity=25
+        )
+
+        response = list_products({"pagination": "cursor", "ordering": "unit_price"})
+        seen = [product["id"] for product in response.data["results"]]
+        while response.data["next"]:
+            response = list_products(url=response.data["next"])
+            seen += [product["id"] for product in response.data["results"]]
+
+        assert response.status_code == status.HTTP_200_OK
+        assert "count" not in response.data
+        assert seen == sorted(Product.objects.values_list("id", flat=True))
+
+    def test_if_cursor_previous_link_returns_previous_page(self, list_products):
+        baker.make(Product, _quantity=15)
+
+        first = list_products({"pagination": "cursor", "ordering": "-last_update"})
+        second = list_products(url=first.data["next"])
+        previous = list_products(url=second.data["previous"])
+
+        assert previous.status_code == status.HTTP_200_OK
+        assert previous.data["results"] == first.data["results"]
+        assert previous.data["previous"] is None
+
+    def test_if_cursor_is_invalid_returns_404(self, list_products):
+        response = list_products({"cursor": "not-a-cursor"})
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    def test_if_cursor_values_do_not_fit_the_ordering_returns_404(self, list_products):
+        baker.make(Product)
+        cursor = b64encode(json.dumps({"v": ["abc", 1], "r": 0}).encode()).decode()
+
+        response = list_products({"cursor": cursor, "ordering": "unit_price"})
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+class TestSearchProducts:
+    def test_if_prefix_matches_returns_products_ranked_by_title(self, list_products):
+        in_description = baker.make(
+            Product, title="Mug", description="Holds fresh coffee"
+        )
+        in_title = baker.make(Product, title="Coffee Beans", description="Roasted")
+        baker.make(Product, title="Tea", description="Green")
+
+        response = list_products({"search": "coff"})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert [product["id"] for product in response.data["results"]] == [
+            in_title.id,
+            in_description.id,
+        ]
+
+    def test_if_every_word_must_match(self, list_products):
+        product = baker.make(Product, title="Red Wine", description=None)
+        baker.make(Product, title="Red Apple", description=None)
+
+        response = list_products({"search": "red wi"})
+
+        assert [p["id"] for p in response.data["results"]] == [product.id]
+
+    def test_if_product_is_updated_index_follows(self, list_products):
+        product = baker.make(Product, title="Old Name", description=None)
+        product.title = "New Name"
+        product.save()
+
+        assert list_products({"search": "old"}).data["results"] == []
+        assert len(list_products({"search": "new"}).data["results"]) == 1
+
+    def test_if_filters_apply_to_search_results(self, list_products):
+        collection = baker.make(Collection)
+        product = baker.make(Product, title="Bread", collection=collection)
+        baker.make(Product, title="Bread")
+
+        response = list_products({"search": "bread", "collection__in": collection.id})
+
+        assert [p["id"] for p in response.data["results"]] == [product.id]
+
+
+@pytest.mark.django_db
+class TestCachedProducts:
+    def test_if_product_is_cached_returns_same_response_without_queries(
+        self, api_client, django_assert_num_queries
+    ):
+        product = baker.make(Product)
+        url = f"/api/v1/store/products/{product.id}/"
+        first = api_client.get(url)
+
+        with django_assert_num_queries(0):
+            second = api_client.get(url)
+
+        assert second.status_code == status.HTTP_200_OK
+        assert second.data == first.data
+
+    def test_if_price_changes_returns_new_price(self, api_client, list_products):
+        product = baker.make(Product, unit_price=Decimal("10.00"))
+        list_products()
+        api_client.get(f"/api/v1/store/products/{product.id}/")
+
+        product.unit_price = Decimal("12.50")
+        product.save()
+
+        detail = api_client.get(f"/api/v1/store/products/{product.id}/")
+        listing = list_products()
+        assert detail.data["unit_price"] == Decimal("12.50")
+        assert listing.data["results"][0]["unit_price"] == Decimal("12.50")
+
+    def test_if_query_params_are_reordered_hits_same_entry(
+        self, list_products, django_assert_num_queries
+    ):
+        baker.make(Product, _quantity=3)
+        list_products({"ordering": "unit_price", "page": 1})
+
+        with django_assert_num_queries(0):
+            response = list_products({"page": 1, "ordering": "unit_price"})
+
+        assert response.status_code == status.HTTP_200_OK
+
+
+@pytest.mark.django_db
+class TestSparseFieldsets:
+    def test_if_fields_are_requested_returns_only_them(self, list_products):
+        baker.make(Product)
+
+        response = list_products({"fields": "id,title,unit_price"})
+
+        assert list(response.data["results"][0]) == ["id", "title", "unit_price"]
+
+    def test_if_fields_are_omitted_returns_the_rest(self, list_products):
+        product = baker.make(Product)
+
+        response = list_products(
+            {"omit": "description,product_images"},
+            url=f"/api/v1/store/products/{product.id}/",
+        )
+
+        assert "description" not in response.data
+        assert "product_images" not in response.data
+        assert "price_with_tax" in response.data
+
+    @pytest.mark.parametrize("params", [{"fields": "inventory"}, {"omit": "id"}])
+    def test_if_inventory_is_requested_without_id_returns_inventory(
+        self, list_products, params
+    ):
+        product = baker.make(Product, inventory=7)
+        urls = ["/api/v1/store/products/", f"/api/v1/store/products/{product.id}/"]
+
+        # Rendered, then served from the cache
+        for url in urls * 2:
+            response = list_products(params, url=url)
+            data = response.data.get("results", [response.data])[0]
+            assert response.status_code == status.HTTP_200_OK
+            assert "id" not in data
+            assert data["inventory"] == 7
+
+        bulk = list_products({**params, "ids": product.id})
+        assert bulk.data["results"][0]["inventory"] == 7
+        assert "id" not in bulk.data["results"][0]
+
+    def test_if_images_are_not_requested_skips_prefetch(
+        self, list_products, django_assert_num_queries
+    ):
+        baker.make(Product, _quantity=3)
+
+        # COUNT(*) and the product page, without the product_images prefetch
+        with django_assert_num_queries(2):
+            list_products({"fields": "id,title"})
+
+
+@pytest.mark.django_db
+class TestBulkRetrieveProducts:
+    def test_if_ids_are_given_returns_products_in_request_order(
+        self, list_products, django_assert_num_queries
+    ):
+        first, second = baker.make(Product, _quantity=2)
+
+        # The products and their images, no COUNT(*)
+        with django_assert_num_queries(2):
+            response = list_products({"ids": f"{second.id},999999,{first.id}"})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert [p["id"] for p in response.data["results"]] == [second.id, first.id]
+        assert response.data["missing"] == [999999]
+
+    def test_if_ids_are_posted_returns_200(self, api_client):
+        product = baker.make(Product)
+
+        response = api_client.post(
+            "/api/v1/store/products/bulk-get/",
+            {"ids": [product.id, product.id]},
+            format="json",
+        )
+
+        assert response.status_code == status.HTTP_200_OK
+        assert [p["id"] for p in response.data["results"]] == [product.id]
+        assert response.data["missing"] == []
+
+    def test_if_too_many_ids_returns_400(self, api_client):
+        response = api_client.post(
+            "/api/v1/store/products/bulk-get/",
+            {"ids": list(range(1, 300))},
+            format="json",
+        )
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_if_ids_are_invalid_returns_400(self, list_products):
+        response = list_products({"ids": "1,abc"})
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+class TestConditionalGet:
+    def test_if_etag_matches_returns_304_without_queries(
+        self, api_client, django_assert_num_queries
+    ):
+        product = baker.make(Product)
+        url = f"/api/v1/store/products/{product.id}/"
+        etag = api_client.get(url)["ETag"]
+
+        with django_assert_num_queries(0):
+            response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert response["ETag"] == etag
+
+    @pytest.mark.parametrize("query", ["", "?ids={id}", "?fields=id,inventory"])
+    def test_if_response_is_not_cached_returns_304_without_queries(
+        self, api_client, django_assert_num_queries, query
+    ):
+        product = baker.make(Product)
+        url = "/api/v1/store/products/" + query.format(id=product.id)
+        etag = api_client.get(url)["ETag"]
+        cache.delete_pattern("store:response:*")
+
+        with django_assert_num_queries(0):
+            response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    def test_if_product_changed_returns_200(self, api_client):
+        product = baker.make(Product)
+        url = f"/api/v1/store/products/{product.id}/"
+        etag = api_client.get(url)["ETag"]
+
+        product.title = "Renamed"
+        product.save()
+        response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response["ETag"] != etag
+
+    def test_if_not_modified_since_returns_304(self, list_products):
+        baker.make(Product)
+        last_modified = list_products()["Last-Modified"]
+
+        response = list_products(HTTP_IF_MODIFIED_SINCE=last_modified)
+
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    def test_if_review_is_added_review_etag_changes(self, api_client):
+        product = baker.make(Product)
+        url = f"/api/v1/store/products/{product.id}/reviews/"
+        etag = api_client.get(url)["ETag"]
+
+        api_client.post(url, {"name": "Ann", "description": "Great"})
+        response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == status.HTTP_200_OK
+
+    def test_if_review_is_added_other_products_stay_cached(
+        self, api_client, django_assert_num_queries
+    ):
+        reviewed, other = baker.make(Product, _quantity=2)
+        url = f"/api/v1/store/products/{other.id}/"
+        etag = api_client.get(url)["ETag"]
+
+        api_client.post(
+            f"/api/v1/store/products/{reviewed.id}/reviews/",
+            {"name": "Ann", "description": "Great"},
+        )
+        with django_assert_num_queries(0):
+            response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+
+@pytest.mark.django_db
+class TestProductFacets:
+    def test_if_filters_apply_returns_counts_per_collection_and_price(
+        self, list_products, django_assert_max_num_queries
+    ):
+        books, toys = baker.make(Collection, _quantity=2)
+        baker.make(Product, collection=books, unit_price=Decimal("5.00"))
+        baker.make(Product, collection=books, unit_price=Decimal("30.00"))
+        baker.make(Product, collection=toys, unit_price=Decimal("120.00"))
+        baker.make(Product, collection=toys, unit_price=Decimal("500.00"))
+
+        with django_assert_max_num_queries(2):
+            response = list_products(
+                {"unit_price__lt": "200", "price_buckets": "0,20,100"},
+                url="/api/v1/store/products/facets/",
+            )
+
+        assert response.status_code == status.HTTP_200_OK
+        counts = {row["id"]: row["count"] for row in response.data["collections"]}
+        assert counts == {books.id: 2, toys.id: 1}
+        assert [row["count"] for row in response.data["unit_price"]] == [1, 1, 1]
+        assert response.data["unit_price"][-1]["max"] is None
+
+    def test_if_price_buckets_are_invalid_returns_400(self, list_products):
+        response = list_products(
+            {"price_buckets": "0,cheap"}, url="/api/v1/store/products/facets/"
+        )
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+class TestProductRatings:
+    def test_if_reviews_change_rating_follows(self, api_client):
+        product = baker.make(Product)
+        url = f"/api/v1/store/products/{product.id}/reviews/"
+        for rating in (5, 4, 4):
+            api_client.post(url, {"name": "Ann", "description": "Ok", "rating": rating})
+        first = Review.objects.order_by("id").first()
+
+        api_client.patch(f"{url}{first.id}/", {"rating": 2})
+        api_client.delete(f"{url}{Review.objects.order_by('id').last().id}/")
+        response = api_client.get(f"/api/v1/store/products/{product.id}/")
+
+        assert response.data["rating"] == {
+            "count": 2,
+            "average": Decimal("3.00"),
+            "histogram": {1: 0, 2: 1, 3: 0, 4: 1, 5: 0},
+        }
+
+    def test_if_products_are_listed_reviews_are_not_queried(
+        self, list_products, django_assert_num_queries
+    ):
+        for product in baker.make(Product, _quantity=3):
+            baker.make(Review, product=product, rating=3, _quantity=2)
+
+        # COUNT(*), the products joined with their ratings and the images
+        with django_assert_num_queries(3) as queries:
+            response = list_products()
+
+        assert "store_review" not in " ".join(
+            q["sql"] for q in queries.captured_queries
+        )
+        assert [p["rating"]["count"] for p in response.data["results"]] == [2, 2, 2]
+
+    def test_if_product_has_no_reviews_returns_empty_rating(self, list_products):
+        baker.make(Product)
+
+        response = list_products()
+
+        assert response.data["results"][0]["rating"]["count"] == 0
+        assert response.data["results"][0]["rating"]["average"] is None
+
+    def test_if_reviews_are_listed_pages_newest_first(self, api_client):
+        product = baker.make(Product)
+        reviews = baker.make(Review, product=product, rating=5, _quantity=12)
+        url = f"/api/v1/store/products/{product.id}/reviews/"
+
+        first = api_client.get(url)
+        second = api_client.get(first.data["next"])
+
+        ids = [r["id"] for r in first.data["results"] + second.data["results"]]
+        assert ids == [review.id for review in reversed(reviews)]
+        assert second.data["next"] is None
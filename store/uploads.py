@@ -0,0 +1,146 @@
+"""
+A module that validates product image uploads while they stream in.
+
+validate_file_size only runs once Django has received and buffered the whole
+request body. ImageUploadHandler sits in front of Django's upload handlers on
+the image endpoint instead: it refuses a request whose Content-Length is
+already too large before reading it, checks the magic bytes of the first chunk
+and aborts as soon as more than MAX_IMAGE_SIZE_KB arrived. Rejections are
+counted in the cache (uploads, declared body bytes and bytes actually read, per
+reason) so that all workers share the numbers; see get_rejected_counts().
+"""
+
+import logging
+
+from django.core.cache import cache
+from django.core.files.uploadhandler import FileUploadHandler
+from rest_framework.exceptions import ValidationError
+
+from .validators import MAX_IMAGE_SIZE_KB
+
+logger = logging.getLogger(__name__)
+
+TOO_LARGE = "too_large"
+NOT_IMAGE = "not_image"
+REASONS = [TOO_LARGE, NOT_IMAGE]
+COUNTERS = ["uploads", "bytes", "read"]
+REJECTED_KEY = "store:uploads:rejected:{}:{}"
+
+MAX_SIZE = MAX_IMAGE_SIZE_KB * 1024
+# Room for the boundaries and part headers around the file
+MULTIPART_OVERHEAD = 2 * 1024
+MAGIC_LENGTH = 12
+
+
+def is_image_header(head):
+    """
+    Tell whether the first bytes of a file belong to a web image format.
+
+    Args:
+        head (bytes): at least MAGIC_LENGTH bytes, unless the file is shorter
+
+    Returns:
+        bool: True for JPEG, PNG, GIF and WebP
+    """
+    return (
+        head.startswith(b"\xff\xd8\xff")
+        or head.startswith(b"\x89PNG\r\n\x1a\n")
+        or head[:6] in (b"GIF87a", b"GIF89a")
+        or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")
+    )
+
+
+def count_rejected(reason, declared, read):
+    counts = {"uploads": 1, "bytes": declared, "read": read}
+    for counter, delta in counts.items():
+        key = REJECTED_KEY.format(reason, counter)
+        cache.add(key, 0, timeout=None)
+        cache.incr(key, delta)
+
+
+def get_rejected_counts():
+    """
+    Get the counters of rejected uploads.
+
+    Returns:
+        dict: {reason: {"uploads": int, "bytes": int, "read": int}}, where
+            bytes is the declared size of the rejected request bodies and read
+            the part of it that was received before the upload was aborted
+    """
+    keys = {
+        (reason, counter): REJECTED_KEY.format(reason, counter)
+        for reason in REASONS
+        for counter in COUNTERS
+    }
+    values = cache.get_many(keys.values())
+    counts = {reason: {} for reason in REASONS}
+    for (reason, counter), key in keys.items():
+        counts[reason][counter] = values.get(key, 0)
+    return counts
+
+
+def reset_rejected_counts():
+    cache.delete_many(
+        [
+            REJECTED_KEY.format(reason, counter)
+            for reason in REASONS
+            for counter in COUNTERS
+        ]
+    )
+
+
+class ImageUploadHandler(FileUploadHandler):
+    """
+    A pass-through upload handler that aborts invalid image uploads early.
+
+    It must come first in request.upload_handlers: chunks it accepts go on to
+    the memory and temporary file handlers unchanged, which still build the
+    UploadedFile.
+    """
+
+    # Small chunks, so that an oversize upload is cut off close to the limit
+    chunk_size = 8 * 1024
+
+    def handle_raw_input(
+        self, input_data, META, content_length, boundary, encoding=None
+    ):
+        self.body_length = content_length
+        self.read = 0
+        if content_length > MAX_SIZE + MULTIPART_OVERHEAD:
+            self.reject(TOO_LARGE)
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.head = b""
+
+    def receive_data_chunk(self, raw_data, start):
+        self.read += len(raw_data)
+        if len(self.head) < MAGIC_LENGTH:
+            # A multipart chunk may be shorter than the magic bytes
+            self.head += raw_data[: MAGIC_LENGTH - len(self.head)]
+            if len(self.head) == MAGIC_LENGTH and not is_image_header(self.head):
+                self.reject(NOT_IMAGE)
+        if start + len(raw_data) > MAX_SIZE:
+            self.reject(TOO_LARGE)
+        return raw_data
+
+    def file_complete(self, file_size):
+        if file_size < MAGIC_LENGTH and not is_image_header(self.head):
+            self.reject(NOT_IMAGE)
+        # The next handler returns the file
+        return None
+
+    def reject(self, reason):
+        count_rejected(reason, self.body_length, self.read)
+        logger.info(
+            "Rejected %s upload after %s of %s bytes",
+            reason,
+            self.read,
+            self.body_length,
+        )
+        if reason == TOO_LARGE:
+            message = f"Image file can not be larger than {MAX_IMAGE_SIZE_KB}KB!"
+        else:
+            message = "Upload a valid image. The file is not a JPEG, PNG, GIF or WebP."
+        # Raised from within the parser, so the rest of the body is never read
+        raise ValidationError({"image": [message]}, code=reason)
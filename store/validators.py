@@ -1,9 +1,11 @@
 from django.core.exceptions import ValidationError
 
+MAX_IMAGE_SIZE_KB = 50
+
 
 def validate_file_size(file):
-    max_size_kb = 50
+    max_size_kb = MAX_IMAGE_SIZE_KB
 
-    # 1MB --> 1024KB 
+    # 1MB --> 1024KB
     if file.size > max_size_kb * 1024:
         raise ValidationError(f"Image file can not be larger than {max_size_kb}KB!")
@@ -1,24 +1,52 @@
-from django.db.models import Count
+from uuid import UUID
+from django.core.cache import cache
+from django.db.models import Count, Prefetch, Q
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from rest_framework import status
+from rest_framework.exceptions import NotFound
 from rest_framework.mixins import (
     CreateModelMixin,
     DestroyModelMixin,
     RetrieveModelMixin,
 )
-from rest_framework.viewsets import ModelViewSet, GenericViewSet
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.viewsets import ModelViewSet, GenericViewSet, ViewSet
+from rest_framework.filters import OrderingFilter
+from rest_framework.generics import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 
 
+from .caching import (
+    CART_SUMMARY_TIMEOUT,
+    COLLECTIONS,
+    INVENTORY,
+    PRODUCTS,
+    VersionedCacheMixin,
+    cart_summary_key,
+    get_inventories,
+    inventory_namespace,
+    product_namespace,
+    review_namespace,
+)
+from .carts import RedisCartStore
+from .customers import get_customer_id
 from .filters import ProductFilter
-from .pagination import ProductPagination
+from .idempotency import idempotent
+from .pagination import (
+    OrderCursorPagination,
+    ProductCursorPagination,
+    ProductPagination,
+    ReviewCursorPagination,
+)
+from .search import ProductSearchFilter
+from .uploads import ImageUploadHandler
 from .models import (
     Cart,
     CartItem,
     Customer,
+    CustomerCollectionSpend,
+    CustomerProductHistory,
     Order,
     Product,
     Collection,
@@ -32,34 +60,206 @@ from .permissions import (
     IsAdminOrReadOnly,
 )
 from .serializers import (
+    MAX_BULK_IDS,
     AddCartItemSerializer,
+    BulkAddCartItemSerializer,
     CartItemSerializer,
     CartSerializer,
+    CartSummarySerializer,
     CreateOrderSerializer,
+    CustomerHistorySerializer,
     CustomerSerializer,
     OrderSerializer,
+    OrderSummarySerializer,
+    PriceBucketsSerializer,
+    ProductIdsSerializer,
+    RedisAddCartItemSerializer,
     ProductSerializer,
     ProductImageSerializer,
     CollectionSerializer,
     ReviewSerializer,
     UpdateCartItemSerializer,
     UpdateOrderSerializer,
+    sparse_fields,
 )
 
 
-class ProductViewSet(ModelViewSet):
-    queryset = Product.objects.prefetch_related("product_images").all()
+class ProductViewSet(VersionedCacheMixin, ModelViewSet):
+    cache_namespaces = [PRODUCTS]
+    queryset = Product.objects.all()
     serializer_class = ProductSerializer
-    filter_backends = [SearchFilter, DjangoFilterBackend, OrderingFilter]
+    filter_backends = [ProductSearchFilter, DjangoFilterBackend, OrderingFilter]
     filterset_class = ProductFilter
     pagination_class = ProductPagination
     permission_classes = [IsAdminOrReadOnly]
-    search_fields = ["title", "description"]
     ordering_fields = ["unit_price", "last_update"]
+    # Lower bounds of the unit_price facet buckets, the last one is open-ended
+    price_buckets = "0,10,25,50,100"
+
+    @property
+    def paginator(self):
+        # ?pagination=cursor (and every link it hands out, which carry ?cursor=)
+        # switches the catalog to keyset pagination.
+        if not hasattr(self, "_paginator"):
+            params = self.request.query_params
+            if "cursor" in params or params.get("pagination") == "cursor":
+                self._paginator = ProductCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def get_queryset(self):
+        # Only pay for the images, the rating and the description when they
+        # are rendered
+        fields = sparse_fields(self.request, ProductSerializer.Meta.fields)
+        queryset = super().get_queryset()
+        if "product_images" in fields:
+            queryset = queryset.prefetch_related("product_images")
+        if "rating" in fields:
+            queryset = queryset.select_related("rating")
+        if "description" not in fields:
+            queryset = queryset.defer("description")
+        return queryset
 
     def get_serializer_context(self):
         return {"request": self.request}
 
+    def get_cache_namespaces(self):
+        if self.action == "retrieve":
+            return self.cache_namespaces + [product_namespace(self.kwargs["pk"])]
+        return self.cache_namespaces
+
+    def get_volatile_namespaces(self):
+        fields = sparse_fields(self.request, ProductSerializer.Meta.fields)
+        if self.action == "facets" or "inventory" not in fields:
+            return []
+        if self.action == "retrieve":
+            return [inventory_namespace(self.kwargs["pk"])]
+        ids = dict.fromkeys(self.request.query_params.get("ids", "").split(","))
+        if "ids" in self.request.query_params and len(ids) <= MAX_BULK_IDS:
+            return [inventory_namespace(pk) for pk in ids]
+        # A page may hold any product
+        return [INVENTORY]
+
+    def fill_volatile(self, data, fresh):
+        # Every order changes the inventory, so it is read per product instead
+        # of being cached with the responses
+        fields = sparse_fields(self.request, ProductSerializer.Meta.fields)
+        products = data["results"] if "results" in data else [data]
+        products = [product for product in products if "inventory" in product]
+        if not products:
+            return
+        if fresh:
+            # Just read with the rest, so no query is needed for the entries
+            current = {product["id"]: product["inventory"] for product in products}
+
+            def load(product_ids):
+                return {pk: current[pk] for pk in product_ids}
+
+        else:
+            load = self.load_inventories
+        inventories = get_inventories([product["id"] for product in products], load)
+        for product in products:
+            product["inventory"] = inventories.get(product["id"], product["inventory"])
+        if "id" not in fields:
+            # Only rendered for the lookup above
+            for product in products:
+                del product["id"]
+
+    def load_inventories(self, product_ids):
+        return dict(
+            Product.objects.filter(pk__in=product_ids).values_list("pk", "inventory")
+        )
+
+    def list(self, request, *args, **kwargs):
+        if "ids" in request.query_params:
+            return self.cached_response(self.bulk_response, request)
+        return super().list(request, *args, **kwargs)
+
+    @action(detail=False)
+    def facets(self, request):
+        return self.cached_response(self.facets_response, request)
+
+    def facets_response(self, request):
+        # Clear the ordering: it would otherwise end up in the GROUP BY
+        queryset = self.filter_queryset(Product.objects.all()).order_by()
+        bounds = self.get_price_buckets(request)
+
+        collections = (
+            queryset.values("collection_id", "collection__title")
+            .annotate(count=Count("id"))
+            .order_by("collection__title")
+        )
+        buckets = list(zip(bounds, bounds[1:] + [None]))
+        prices = queryset.aggregate(
+            **{
+                f"bucket_{i}": Count(
+                    "id",
+                    filter=Q(unit_price__gte=low)
+                    & (Q(unit_price__lt=high) if high is not None else Q()),
+                )
+                for i, (low, high) in enumerate(buckets)
+            }
+        )
+        return Response(
+            {
+                "collections": [
+                    {
+                        "id": row["collection_id"],
+                        "title": row["collection__title"],
+                        "count": row["count"],
+                    }
+                    for row in collections
+                ],
+                "unit_price": [
+                    {"min": low, "max": high, "count": prices[f"bucket_{i}"]}
+                    for i, (low, high) in enumerate(buckets)
+                ],
+            }
+        )
+
+    def get_price_buckets(self, request):
+        serializer = PriceBucketsSerializer(
+            data={
+                "bounds": request.query_params.get(
+                    "price_buckets", self.price_buckets
+                ).split(",")
+            }
+        )
+        serializer.is_valid(raise_exception=True)
+        return sorted(set(serializer.validated_data["bounds"]))
+
+    # POST so that large id lists do not have to fit in a URL; it only reads.
+    @action(
+        detail=False,
+        methods=["POST"],
+        url_path="bulk-get",
+        permission_classes=[AllowAny],
+    )
+    def bulk_get(self, request):
+        return self.bulk_response(request)
+
+    def bulk_response(self, request):
+        if request.method == "GET":
+            data = {"ids": request.query_params["ids"].split(",")}
+        else:
+            data = request.data
+        serializer = ProductIdsSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        ids = list(dict.fromkeys(serializer.validated_data["ids"]))
+
+        # One id__in query (plus the image prefetch), then back to request order
+        products = {
+            product.id: product for product in self.get_queryset().filter(id__in=ids)
+        }
+        found = [products[pk] for pk in ids if pk in products]
+        return Response(
+            {
+                "results": self.get_serializer(found, many=True).data,
+                "missing": [pk for pk in ids if pk not in products],
+            }
+        )
+
     def destroy(self, request, *args, **kwargs):
 
         if OrderItem.objects.filter(product_id=kwargs["pk"]).count() > 0:
@@ -72,8 +272,9 @@ class ProductViewSet(ModelViewSet):
         return super().destroy(request, *args, **kwargs)
 
 
-class CollectionViewSet(ModelViewSet):
-    queryset = Collection.objects.annotate(products_count=Count("products")).all()
+class CollectionViewSet(VersionedCacheMixin, ModelViewSet):
+    cache_namespaces = [COLLECTIONS]
+    queryset = Collection.objects.all()
     serializer_class = CollectionSerializer
     permission_classes = [IsAdminOrReadOnly]
 
@@ -88,12 +289,16 @@ class CollectionViewSet(ModelViewSet):
         return super().destroy(request, *args, **kwargs)
 
 
-class ReviewViewSet(ModelViewSet):
+class ReviewViewSet(VersionedCacheMixin, ModelViewSet):
+    pagination_class = ReviewCursorPagination
     serializer_class = ReviewSerializer
 
     def get_queryset(self):
         return Review.objects.filter(product_id=self.kwargs["product_pk"]).all()
 
+    def get_cache_namespaces(self):
+        return [review_namespace(self.kwargs["product_pk"])]
+
     def get_serializer_context(self):
         return {"product_id": self.kwargs["product_pk"]}
 
@@ -101,9 +306,27 @@ class ReviewViewSet(ModelViewSet):
 class CartViewSet(
     CreateModelMixin, DestroyModelMixin, RetrieveModelMixin, GenericViewSet
 ):
-    queryset = Cart.objects.prefetch_related("items__product").all()
+    queryset = Cart.objects.with_totals().prefetch_related(
+        Prefetch(
+            "items", queryset=CartItem.objects.with_totals().select_related("product")
+        )
+    )
     serializer_class = CartSerializer
 
+    @action(detail=True)
+    def summary(self, request, pk):
+        # Cached until the next write to the cart's items
+        try:
+            key = cart_summary_key(pk)
+        except ValueError:
+            raise NotFound()
+        data = cache.get(key)
+        if data is None:
+            cart = get_object_or_404(Cart.objects.with_totals(), pk=pk)
+            data = CartSummarySerializer(cart).data
+            cache.set(key, data, CART_SUMMARY_TIMEOUT)
+        return Response(data)
+
 
 class CartItemViewSet(ModelViewSet):
     http_method_names = ["get", "post", "patch", "delete"]
@@ -125,20 +348,185 @@ class CartItemViewSet(ModelViewSet):
             .all()
         )
 
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        Cart.objects.touch(instance.cart_id)
+
+    @action(detail=False, methods=["POST"])
+    @idempotent
+    def bulk(self, request, cart_pk):
+        serializer = BulkAddCartItemSerializer(
+            data=request.data, context=self.get_serializer_context()
+        )
+        serializer.is_valid(raise_exception=True)
+        cart_items = serializer.save()
+        return Response(CartItemSerializer(cart_items, many=True).data)
+
+
+class RedisCartMixin:
+    """
+    Shared helpers of the cart viewsets used when carts live in Redis.
+
+    Cart items are addressed by their product id there, since a product appears
+    at most once in a cart.
+    """
+
+    def get_store(self):
+        return RedisCartStore()
+
+    def get_cart_id(self, value):
+        try:
+            return UUID(str(value))
+        except ValueError:
+            raise NotFound()
+
+    def get_items(self, cart_id):
+        items = self.get_store().items(cart_id)
+        if items is None:
+            raise NotFound()
+        return items
+
+    def build_cart_items(self, items):
+        """
+        Turn {product_id: quantity} into unsaved CartItem instances that the
+        regular serializers can render, with one query for the products.
+        """
+        products = Product.objects.only("id", "title", "unit_price").in_bulk(items)
+        return [
+            CartItem(id=product_id, product=products[product_id], quantity=quantity)
+            for product_id, quantity in items.items()
+            if product_id in products
+        ]
+
+
+class RedisCartViewSet(RedisCartMixin, ViewSet):
+    def create(self, request):
+        cart_id = self.get_store().create()
+        return Response(
+            {"id": cart_id, "items": [], "total_price": 0},
+            status=status.HTTP_201_CREATED,
+        )
+
+    def retrieve(self, request, pk):
+        cart_id = self.get_cart_id(pk)
+        cart_items = self.build_cart_items(self.get_items(cart_id))
+        return Response(
+            {
+                "id": cart_id,
+                "items": CartItemSerializer(cart_items, many=True).data,
+                "total_price": sum(
+                    item.quantity * item.product.unit_price for item in cart_items
+                ),
+            }
+        )
+
+    @action(detail=True)
+    def summary(self, request, pk):
+        cart_id = self.get_cart_id(pk)
+        cart_items = self.build_cart_items(self.get_items(cart_id))
+        return Response(
+            {
+                "id": cart_id,
+                "item_count": len(cart_items),
+                "total_quantity": sum(item.quantity for item in cart_items),
+                "total_price": sum(
+                    item.quantity * item.product.unit_price for item in cart_items
+                ),
+            }
+        )
+
+    def destroy(self, request, pk):
+        cart_id = self.get_cart_id(pk)
+        self.get_items(cart_id)
+        self.get_store().delete(cart_id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class RedisCartItemViewSet(RedisCartMixin, ViewSet):
+    http_method_names = ["get", "post", "patch", "delete"]
+
+    def get_product_id(self, items, pk):
+        try:
+            product_id = int(pk)
+        except ValueError:
+            raise NotFound()
+        if product_id not in items:
+            raise NotFound()
+        return product_id
+
+    def list(self, request, cart_pk):
+        items = self.get_items(self.get_cart_id(cart_pk))
+        return Response(
+            CartItemSerializer(self.build_cart_items(items), many=True).data
+        )
+
+    def retrieve(self, request, cart_pk, pk):
+        items = self.get_items(self.get_cart_id(cart_pk))
+        product_id = self.get_product_id(items, pk)
+        cart_items = self.build_cart_items({product_id: items[product_id]})
+        if not cart_items:
+            raise NotFound()
+        return Response(CartItemSerializer(cart_items[0]).data)
+
+    @idempotent
+    def create(self, request, cart_pk):
+        cart_id = self.get_cart_id(cart_pk)
+        self.get_items(cart_id)
+        serializer = RedisAddCartItemSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        product_id = serializer.validated_data["product_id"]
+        quantity = self.get_store().add(
+            cart_id, product_id, serializer.validated_data["quantity"]
+        )
+        return Response(
+            {"id": product_id, "product_id": product_id, "quantity": quantity},
+            status=status.HTTP_201_CREATED,
+        )
+
+    @action(detail=False, methods=["POST"])
+    @idempotent
+    def bulk(self, request, cart_pk):
+        cart_id = self.get_cart_id(cart_pk)
+        self.get_items(cart_id)
+        serializer = BulkAddCartItemSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        quantities = self.get_store().add_many(cart_id, serializer.get_quantities())
+        return Response(
+            CartItemSerializer(self.build_cart_items(quantities), many=True).data
+        )
+
+    def partial_update(self, request, cart_pk, pk):
+        cart_id = self.get_cart_id(cart_pk)
+        product_id = self.get_product_id(self.get_items(cart_id), pk)
+        serializer = UpdateCartItemSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        self.get_store().set(cart_id, product_id, serializer.validated_data["quantity"])
+        return Response(serializer.data)
+
+    def destroy(self, request, cart_pk, pk):
+        cart_id = self.get_cart_id(cart_pk)
+        product_id = self.get_product_id(self.get_items(cart_id), pk)
+        self.get_store().remove(cart_id, product_id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 
 class CustomerViewSet(ModelViewSet):
     queryset = Customer.objects.all()
     serializer_class = CustomerSerializer
     permission_classes = [CustomDjangoModelPermission]
 
-    # Create a custom method called "me" and "history". We can make it available on the  
+    # Create a custom method called "me" and "history". We can make it available on the
     # instance/detail(pk) requests or collection/list() requests.
-    # NOTE: All methods are called actions, so we can say here in this view 
-    # we have the create action(made available via CreateModelMixins), 
+    # NOTE: All methods are called actions, so we can say here in this view
+    # we have the create action(made available via CreateModelMixins),
     # update action(made available via UpdateModelMixin).
     @action(detail=False, methods=["GET", "PUT"], permission_classes=[IsAuthenticated])
     def me(self, request):
-        customer = Customer.objects.get(user_id=request.user.id)
+        customer = Customer.objects.get(pk=get_customer_id(request))
         if request.method == "GET":
             serializer = CustomerSerializer(instance=customer)
             return Response(serializer.data)
@@ -150,20 +538,48 @@ class CustomerViewSet(ModelViewSet):
 
     @action(detail=True, permission_classes=[ViewCustomerHistoryPermission])
     def history(self, request, pk):
-        return Response("Ok")
+        # Read from the rollup tables, a few rows per product or collection
+        # bought however many orders the customer placed
+        customer = get_object_or_404(
+            Customer.objects.prefetch_related(
+                Prefetch(
+                    "product_history",
+                    queryset=CustomerProductHistory.objects.select_related(
+                        "product"
+                    ).order_by("-last_purchased_at"),
+                ),
+                Prefetch(
+                    "collection_spend",
+                    queryset=CustomerCollectionSpend.objects.select_related(
+                        "collection"
+                    ).order_by("-spend"),
+                ),
+            ),
+            pk=pk,
+        )
+        return Response(CustomerHistorySerializer(customer).data)
 
 
 class OrderViewSet(ModelViewSet):
     http_method_names = ["get", "post", "patch", "delete", "head", "options"]
+    pagination_class = OrderCursorPagination
 
     def get_permissions(self):
         if self.request.method in ["PATCH", "DELETE"]:
             return [IsAdminUser()]
         return [IsAuthenticated()]
 
+    @property
+    def summary(self):
+        # ?summary=true lists totals instead of the nested order items
+        return (
+            self.action == "list" and self.request.query_params.get("summary") == "true"
+        )
+
+    @idempotent
     def create(self, request, *args, **kwargs):
         serializer = CreateOrderSerializer(
-            data=request.data, context={"user_id": self.request.user.id}
+            data=request.data, context={"customer_id": get_customer_id(request)}
         )
         serializer.is_valid(raise_exception=True)
         order = serializer.save()
@@ -175,22 +591,36 @@ class OrderViewSet(ModelViewSet):
             return CreateOrderSerializer
         elif self.request.method == "PATCH":
             return UpdateOrderSerializer
+        elif self.summary:
+            return OrderSummarySerializer
         return OrderSerializer
 
     def get_queryset(self):
         user = self.request.user
-        if user.is_staff:
-            return Order.objects.prefetch_related(
-                "order_items", "order_items__product"
-            ).all()
+        if self.summary:
+            queryset = Order.objects.all()
+        else:
+            # One query for the items of a whole page, with their products
+            queryset = Order.objects.prefetch_related(
+                Prefetch(
+                    "order_items",
+                    queryset=OrderItem.objects.select_related("product"),
+                )
+            )
 
-        customer_id = Customer.objects.only("id").get(user_id=user.id)
-        return Order.objects.filter(customer_id=customer_id)
+        if not user.is_staff:
+            queryset = queryset.filter(customer_id=get_customer_id(self.request))
+        return queryset.order_by("-placed_at", "-id")
 
 
 class ProductImageViewSet(ModelViewSet):
     serializer_class = ProductImageSerializer
 
+    def initialize_request(self, request, *args, **kwargs):
+        # Before anything reads the body, so uploads are checked as they stream
+        request.upload_handlers.insert(0, ImageUploadHandler(request))
+        return super().initialize_request(request, *args, **kwargs)
+
     def get_serializer_context(self):
         return {"product_id": self.kwargs["product_pk"]}
 
@@ -14,7 +14,7 @@ import os
 from datetime import timedelta
 from pathlib import Path
 from celery.schedules import crontab
-
+from corsheaders.defaults import default_headers
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
@@ -55,6 +55,8 @@ CORS_ALLOWED_ORIGINS = [
     "http://localhost:8001",
     "http://127.0.0.1:8001",
 ]
+# Retried POSTs to the store are deduplicated by it (store.idempotency)
+CORS_ALLOW_HEADERS = [*default_headers, "idempotency-key"]
 
 
 MIDDLEWARE = [
@@ -132,6 +134,9 @@ STATIC_ROOT = os.path.join(BASE_DIR, "static")
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
+# An internal nginx location aliasing MEDIA_ROOT (e.g. "/protected-media/"):
+# media responses then hand the file off to nginx with X-Accel-Redirect
+MEDIA_ACCEL_REDIRECT = os.environ.get("MEDIA_ACCEL_REDIRECT")
 
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
@@ -168,6 +173,12 @@ ADMINS = [
     ("James", "adminjames@easybuy.com"),
 ]
 
+# Where carts are kept: "database" (the store_cart tables) or "redis" (hashes in the
+# default cache's Redis, written behind to the tables by store.tasks.persist_carts)
+STORE_CART_BACKEND = os.environ.get("STORE_CART_BACKEND", "database")
+# Carts untouched for this many days are purged by store.tasks.purge_abandoned_carts
+STORE_ABANDONED_CART_DAYS = int(os.environ.get("STORE_ABANDONED_CART_DAYS", 30))
+
 CELERY_BEAT_SCHEDULE = {
     "notify_customers": {
         "task": "pages.tasks.notify_customers",
@@ -175,7 +186,19 @@ CELERY_BEAT_SCHEDULE = {
         # 'schedule': crontab(day_of_week=1, hour=9, minute=30)
         "schedule": 5,
         "args": ["Hello and Welcome to the team Fachiis"],
-    }
+    },
+    "persist_carts": {
+        "task": "store.tasks.persist_carts",
+        "schedule": 30,
+    },
+    "relay_events": {
+        "task": "store.tasks.relay_events",
+        "schedule": 60,
+    },
+    "purge_abandoned_carts": {
+        "task": "store.tasks.purge_abandoned_carts",
+        "schedule": crontab(hour=3, minute=0),
+    },
 }
 
 LOGGING = {
@@ -13,11 +13,14 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 
+from core.views import TokenObtainPairView
+from store.media import serve_media
+
 admin.site.site_header = "Storefront Admin"
 admin.site.index_title = "Admin"
 
@@ -27,10 +30,13 @@ urlpatterns = [
     path("home/", include("pages.urls")),
     path("api/v1/store/", include("store.urls")),
     path("auth/", include("djoser.urls")),
+    # Ahead of djoser's own jwt-create, to issue tokens with the customer id
+    path("auth/jwt/create/", TokenObtainPairView.as_view(), name="jwt-create"),
     path("auth/", include("djoser.urls.jwt")),
     path("__debug__", include("debug_toolbar.urls")),
+    # Also in production: the view hands the bytes off to nginx or sendfile()
+    path(f"{settings.MEDIA_URL.strip('/')}/<path:path>", serve_media, name="media"),
 ]
 
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
     urlpatterns += [path("silk/", include("silk.urls", namespace="silk"))]